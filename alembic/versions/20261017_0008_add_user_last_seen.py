@@ -0,0 +1,28 @@
+"""add users.last_seen_at
+
+Revision ID: 20261017_0008
+Revises: 7a428b8e8dac
+Create Date: 2026-10-17 10:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0008"
+down_revision: str | None = "7a428b8e8dac"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Время последней активности, периодически сбрасывается из буфера heartbeat
+    op.add_column("users", sa.Column("last_seen_at", sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("users", "last_seen_at")
@@ -0,0 +1,46 @@
+"""add chat_members.last_read_message_id
+
+Revision ID: 20261017_0009
+Revises: 20261017_0008
+Create Date: 2026-10-17 12:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0009"
+down_revision: str | None = "20261017_0008"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Отметка прочтения участника вместо строки message_reads на каждое сообщение
+    op.add_column("chat_members", sa.Column("last_read_message_id", sa.Integer(), nullable=True))
+    # Непрочитанные считаются диапазоном по (chat_id, id)
+    op.create_index("ix_messages_chat_id_id", "messages", ["chat_id", "id"])
+
+    # Отметка - последнее прочитанное сообщение чата из уже накопленных прочтений
+    op.execute(
+        """
+        UPDATE chat_members AS cm
+        SET last_read_message_id = reads.last_read_message_id
+        FROM (
+            SELECT m.chat_id, mr.user_id, MAX(mr.message_id) AS last_read_message_id
+            FROM message_reads AS mr
+            JOIN messages AS m ON m.id = mr.message_id
+            GROUP BY m.chat_id, mr.user_id
+        ) AS reads
+        WHERE cm.chat_id = reads.chat_id AND cm.user_id = reads.user_id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_chat_id_id", table_name="messages")
+    op.drop_column("chat_members", "last_read_message_id")
@@ -0,0 +1,48 @@
+"""add messages.read_count
+
+Revision ID: 20261017_0010
+Revises: 20261017_0009
+Create Date: 2026-10-17 14:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0010"
+down_revision: str | None = "20261017_0009"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Счетчик прочтений, чтобы статус "read" не требовал пересчета по отметкам участников
+    op.add_column(
+        "messages",
+        sa.Column("read_count", sa.Integer(), nullable=False, server_default="0"),
+    )
+
+    op.execute(
+        """
+        UPDATE messages AS m
+        SET read_count = reads.read_count
+        FROM (
+            SELECT m.id, COUNT(*) AS read_count
+            FROM messages AS m
+            JOIN chat_members AS cm
+              ON cm.chat_id = m.chat_id
+             AND cm.user_id != COALESCE(m.author_id, 0)
+             AND cm.last_read_message_id >= m.id
+            GROUP BY m.id
+        ) AS reads
+        WHERE m.id = reads.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("messages", "read_count")
@@ -0,0 +1,34 @@
+"""add messages (chat_id, ts DESC, id DESC) index
+
+Revision ID: 20261017_0011
+Revises: 20261017_0010
+Create Date: 2026-10-17 16:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0011"
+down_revision: str | None = "20261017_0010"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Keyset-пагинация истории по (ts, id); старый индекс (chat_id, ts) - его префикс
+    op.create_index(
+        "ix_messages_chat_ts_id",
+        "messages",
+        ["chat_id", sa.text("ts DESC"), sa.text("id DESC")],
+    )
+    op.drop_index("ix_messages_chat_ts", table_name="messages")
+
+
+def downgrade() -> None:
+    op.create_index("ix_messages_chat_ts", "messages", ["chat_id", "ts"])
+    op.drop_index("ix_messages_chat_ts_id", table_name="messages")
@@ -0,0 +1,51 @@
+"""add chats.version and messages.version
+
+Revision ID: 20261017_0012
+Revises: 20261017_0011
+Create Date: 2026-10-17 18:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0012"
+down_revision: str | None = "20261017_0011"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Версии изменений для дельта-синхронизации GET /chats/{id}/changes
+    op.add_column("chats", sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"))
+    op.add_column("messages", sa.Column("version", sa.BigInteger(), nullable=False, server_default="0"))
+
+    # Существующие сообщения получают версии по порядку id внутри чата
+    op.execute(
+        """
+        UPDATE messages AS m
+        SET version = numbered.version
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS version
+            FROM messages
+        ) AS numbered
+        WHERE m.id = numbered.id
+        """
+    )
+    op.execute(
+        """
+        UPDATE chats
+        SET version = COALESCE((SELECT MAX(version) FROM messages WHERE messages.chat_id = chats.id), 0)
+        """
+    )
+    op.create_index("ix_messages_chat_version", "messages", ["chat_id", "version"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_chat_version", table_name="messages")
+    op.drop_column("messages", "version")
+    op.drop_column("chats", "version")
@@ -0,0 +1,52 @@
+"""add messages.seq and chats.last_message_seq
+
+Revision ID: 20261017_0013
+Revises: 20261017_0012
+Create Date: 2026-10-17 20:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+
+from alembic import op
+
+revision: str = "20261017_0013"
+down_revision: str | None = "20261017_0012"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Номера сообщений внутри чата без пропусков
+    op.add_column("chats", sa.Column("last_message_seq", sa.BigInteger(), nullable=False, server_default="0"))
+    op.add_column("messages", sa.Column("seq", sa.BigInteger(), nullable=True))
+
+    # Существующие сообщения нумеруются по порядку id внутри чата
+    op.execute(
+        """
+        UPDATE messages AS m
+        SET seq = numbered.seq
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS seq
+            FROM messages
+        ) AS numbered
+        WHERE m.id = numbered.id
+        """
+    )
+    op.execute(
+        """
+        UPDATE chats
+        SET last_message_seq = COALESCE((SELECT MAX(seq) FROM messages WHERE messages.chat_id = chats.id), 0)
+        """
+    )
+    op.alter_column("messages", "seq", nullable=False)
+    op.create_unique_constraint("uq_message_chat_seq", "messages", ["chat_id", "seq"])
+
+
+def downgrade() -> None:
+    op.drop_constraint("uq_message_chat_seq", "messages", type_="unique")
+    op.drop_column("messages", "seq")
+    op.drop_column("chats", "last_message_seq")
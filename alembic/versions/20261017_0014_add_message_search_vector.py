@@ -0,0 +1,44 @@
+"""add messages.search_vector with GIN index
+
+Revision ID: 20261017_0014
+Revises: 20261017_0013
+Create Date: 2026-10-17 22:00:00
+
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+revision: str = "20261017_0014"
+down_revision: str | None = "20261017_0013"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    # Полнотекстовый поиск вместо ILIKE. Выражение зафиксировано здесь, а не взято
+    # из модели и настроек: повтор истории миграций всегда дает ту же схему
+    op.add_column(
+        "messages",
+        sa.Column(
+            "search_vector",
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('russian'::regconfig, coalesce(content, ''))", persisted=True),
+        ),
+    )
+    op.create_index(
+        "ix_messages_search_vector",
+        "messages",
+        ["search_vector"],
+        postgresql_using="gin",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_search_vector", table_name="messages")
+    op.drop_column("messages", "search_vector")
@@ -28,10 +28,12 @@ async def get_idempotency_service(redis: Redis = Depends(get_redis)) -> Idempote
     return IdempotencyService(redis)
 
 
-async def get_current_user(
-    session: AsyncSession = Depends(get_session),
-    authorization: str = Header(None, alias="Authorization"),
-) -> int:
+async def get_current_user_id(authorization: str = Header(None, alias="Authorization")) -> int:
+    """user_id из access токена без запроса к БД.
+
+    Для горячих путей вроде heartbeat: подпись и срок токена проверяются,
+    существование пользователя - нет (токен живет access_token_expires_minutes).
+    """
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing token")
     token = authorization.split()[1]
@@ -43,9 +45,15 @@ async def get_current_user(
     subject = payload.get("sub")
     if subject is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return int(subject)
 
+
+async def get_current_user(
+    session: AsyncSession = Depends(get_session),
+    user_id: int = Depends(get_current_user_id),
+) -> int:
     repo = UserRepository(session)
-    user = await repo.get(int(subject))
+    user = await repo.get(user_id)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     return user.id
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api.dependencies import get_current_user, get_redis, get_session
 from app.api.utils import require_idempotency
 from app.domain.models import Chat
 from app.repositories.chat import ChatMemberRepository, ChatRepository
+from app.repositories.message import MessageRepository
 from app.schemas.chat import (
     AddMemberRequest,
     ChatCreate,
@@ -16,9 +17,11 @@ from app.schemas.chat import (
     DirectMessageCreate,
     RemoveMemberRequest,
 )
+from app.schemas.message import MessageChangesResponse, MessageRead
 from app.services.chat import ChatService
 from app.services.idempotency import IdempotencyService
 from app.services.message import MessageService
+from app.services.presence import PresenceService
 
 router = APIRouter()
 
@@ -33,8 +36,10 @@ async def get_chat_or_404(chat_id: int, session: AsyncSession) -> Chat:
 
 @router.get("", response_model=list[ChatRead])
 async def list_chats(
+    with_presence: bool = Query(False, description="Добавить онлайн-статусы участников"),
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> list[ChatRead]:
     from app.repositories.message import MessageRepository
     from app.repositories.message_read import MessageReadRepository
@@ -45,6 +50,12 @@ async def list_chats(
     
     chats = await repo.list_for_user(current_user)
     
+    # Статусы всех участников всех чатов одним запросом к Redis
+    statuses = {}
+    if with_presence:
+        participant_ids = [member.user_id for chat in chats for member in chat.members]
+        statuses = await PresenceService(redis).get_multiple_users_status(participant_ids)
+    
     result = []
     for chat in chats:
         chat_dict = {
@@ -68,6 +79,8 @@ async def list_chats(
         # Получаем количество непрочитанных сообщений
         unread_count = await message_read_repo.get_unread_count(chat.id, current_user)
         chat_dict['unreadCount'] = unread_count
+        if with_presence:
+            chat_dict['presence'] = [statuses[member.user_id] for member in chat.members]
         
         result.append(ChatRead.model_validate(chat_dict))
     
@@ -80,9 +93,10 @@ async def create_chat(
     current_user: int = Depends(get_current_user),
     idempotency: tuple[str, IdempotencyService] = Depends(require_idempotency),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> ChatRead:
     key, service = idempotency
-    chat_service = ChatService(session)
+    chat_service = ChatService(session, redis)
     member_ids = list(dict.fromkeys([current_user, *payload.member_ids]))
     chat = await chat_service.create_chat(
         title=payload.title, 
@@ -152,9 +166,10 @@ async def create_or_get_direct_message(
     payload: DirectMessageCreate,
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> ChatRead:
     """Создать или получить личную переписку с пользователем"""
-    chat_service = ChatService(session)
+    chat_service = ChatService(session, redis)
     
     # Проверяем, что пользователь не пытается создать чат с самим собой
     if payload.user_id == current_user:
@@ -197,11 +212,41 @@ async def mark_chat_as_read(
     return {"message_ids": message_ids}
 
 
+@router.get("/{chat_id}/changes", response_model=MessageChangesResponse)
+async def get_chat_changes(
+    chat_id: int,
+    since: int = Query(0, ge=0, description="Версия из предыдущего ответа"),
+    limit: int = Query(100, ge=1, le=500),
+    current_user: int = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
+) -> MessageChangesResponse:
+    """
+    Изменения сообщений чата после версии since: новые, измененные (правки,
+    статус, реакции) и удаленные сообщения.
+    """
+    member_repo = ChatMemberRepository(session)
+    member = await member_repo.get_member(chat_id=chat_id, user_id=current_user)
+    if member is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
+    
+    changes = await MessageRepository(session).list_changes(chat_id, since, limit=limit)
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return MessageChangesResponse(
+        messages=[MessageRead.model_validate(m) for m in changes if not m.is_deleted],
+        deleted_ids=[m.id for m in changes if m.is_deleted],
+        version=changes[-1].version if changes else since,
+        has_more=has_more,
+    )
+
+
 @router.get("/{chat_id}/members", response_model=list[ChatMemberRead])
 async def get_chat_members(
     chat_id: int,
+    with_presence: bool = Query(False, description="Добавить онлайн-статусы участников"),
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> list[ChatMemberRead]:
     """
     Получить список участников чата
@@ -214,13 +259,18 @@ async def get_chat_members(
     
     # Получаем список участников
     members = await member_repo.list_members(chat_id)
+    statuses = {}
+    if with_presence:
+        statuses = await PresenceService(redis).get_multiple_users_status(m.user_id for m in members)
     
     return [
         ChatMemberRead(
             user_id=m.user_id,
             role=m.role,
             joined_at=m.joined_at.isoformat(),
-            user=m.user
+            last_read_message_id=m.last_read_message_id,
+            user=m.user,
+            presence=statuses.get(m.user_id),
         )
         for m in members
     ]
@@ -232,6 +282,7 @@ async def add_chat_member(
     payload: AddMemberRequest,
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> dict[str, str]:
     """
     Добавить участника в чат (только для админов группового чата)
@@ -245,7 +296,7 @@ async def add_chat_member(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
     
     try:
-        chat_service = ChatService(session)
+        chat_service = ChatService(session, redis)
         await chat_service.add_member(chat, payload.user_id, current_user)
         return {"message": "Member added successfully"}
     except ValueError as e:
@@ -261,6 +312,7 @@ async def remove_chat_member(
     user_id: int,
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
 ) -> None:
     """
     Удалить участника из чата (только для админов группового чата)
@@ -274,7 +326,7 @@ async def remove_chat_member(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
     
     try:
-        chat_service = ChatService(session)
+        chat_service = ChatService(session, redis)
         await chat_service.remove_member(chat, user_id, current_user)
     except ValueError as e:
         raise HTTPException(
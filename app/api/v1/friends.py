@@ -1,13 +1,15 @@
 from __future__ import annotations
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.api.dependencies import get_current_user, get_session
+from app.api.dependencies import get_current_user, get_redis, get_session
 from app.repositories.friend import FriendRepository
 from app.repositories.user import UserRepository
 from app.schemas.friend import FriendRequest, FriendStatusUpdate, FriendWithUser
 from app.schemas.user import UserRead
+from app.services.presence import PresenceService
 
 router = APIRouter()
 
@@ -104,6 +106,7 @@ async def update_friend_status(
     payload: FriendStatusUpdate,
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis: Redis = Depends(get_redis),
 ) -> dict[str, str]:
     """
     Принять или заблокировать запрос в друзья.
@@ -139,6 +142,9 @@ async def update_friend_status(
     
     await friend_repo.update_status(friendship, payload.status)
     await session.commit()
+    if payload.status == "accepted":
+        # Друзья видят статус друг друга
+        await PresenceService(redis).invalidate_audience([current_user, friend_id])
     
     action = "accepted" if payload.status == "accepted" else "blocked"
     return {"message": f"Friend request {action}"}
@@ -161,6 +167,7 @@ async def remove_friend(
     friend_id: int,
     current_user: int = Depends(get_current_user),
     session: AsyncSession = Depends(get_session),
+    redis: Redis = Depends(get_redis),
 ) -> None:
     """Удалить из друзей или отменить запрос"""
     friend_repo = FriendRepository(session)
@@ -172,5 +179,8 @@ async def remove_friend(
             detail="Friendship not found",
         )
     
+    was_accepted = friendship.status == "accepted"
     await friend_repo.delete(friendship)
     await session.commit()
+    if was_accepted:
+        await PresenceService(redis).invalidate_audience([current_user, friend_id])
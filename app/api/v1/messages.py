@@ -1,16 +1,23 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.api.dependencies import get_current_user, get_redis, get_session
 from app.api.utils import require_idempotency
 from app.repositories.chat import ChatMemberRepository
-from app.repositories.message import MessageRepository
+from app.repositories.message import (
+    MessageRepository,
+    decode_cursor,
+    decode_search_cursor,
+    encode_cursor,
+    encode_search_cursor,
+)
 from app.schemas.message import (
     MessageCreate,
     MessageListResponse,
     MessageRead,
+    MessageSearchResult,
     MessageUpdate,
     ReactionCreate,
     ReactionRead,
@@ -24,31 +31,97 @@ router = APIRouter()
 @router.get("", response_model=MessageListResponse)
 async def list_messages(
     chat_id: int,
-    limit: int = 50,
+    limit: int = Query(50, ge=1),
+    before: str | None = None,
+    after: str | None = None,
+    around_id: int | None = None,
+    after_seq: int | None = Query(None, ge=0),
     before_id: int | None = None,
     session: AsyncSession = Depends(get_session),
+    redis = Depends(get_redis),
     current_user: int = Depends(get_current_user),
 ) -> MessageListResponse:
-    """Получить список сообщений с пагинацией (cursor-based)"""
+    """Получить список сообщений с пагинацией (keyset по ts и id).
+
+    - before: курсор, страница сообщений старше него (по умолчанию - самые новые)
+    - after: курсор, страница сообщений новее него
+    - around_id: страница вокруг сообщения, например цели ответа
+    - after_seq: сообщения с seq больше заданного, включая удаленные (докачка пропуска)
+    - before_id: устаревший курсор по ID сообщения
+    """
+    if sum(param is not None for param in (before, after, around_id, after_seq, before_id)) > 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only one of before, after, around_id, after_seq, before_id is allowed",
+        )
     member_repo = ChatMemberRepository(session)
     member = await member_repo.get_member(chat_id=chat_id, user_id=current_user)
     if member is None:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
     
     repo = MessageRepository(session)
-    messages_raw = await repo.list_for_chat(chat_id, limit=limit, before_id=before_id)
-    
-    # Определяем, есть ли еще сообщения
-    has_more = len(messages_raw) > limit
-    messages = messages_raw[:limit]  # Берем только limit сообщений
-    
-    # Определяем next_cursor для следующей страницы
-    next_cursor = messages[-1].id if has_more and messages else None
+    try:
+        before_key = decode_cursor(before) if before is not None else None
+        after_key = decode_cursor(after) if after is not None else None
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
+
+    if around_id is not None:
+        target = await repo.get_with_reactions(around_id)
+        if target is None or target.chat_id != chat_id:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+        key = (target.ts, target.id)
+        older_limit = (limit - 1) // 2
+        older_raw = await repo.list_for_chat(chat_id, limit=older_limit, before=key)
+        newer_raw = await repo.list_for_chat(chat_id, limit=limit - 1 - older_limit, after=key)
+        older = older_raw[:older_limit]
+        newer = newer_raw[: limit - 1 - older_limit]
+        middle = [] if target.is_deleted else [target]
+        messages = [*reversed(newer), *middle, *older]
+        has_more = len(older_raw) > len(older)
+        has_newer = len(newer_raw) > len(newer)
+    elif after_key is not None or after_seq is not None:
+        if after_seq is not None:
+            newer_raw = await repo.list_by_seq(chat_id, after_seq, limit=limit)
+        else:
+            newer_raw = await repo.list_for_chat(chat_id, limit=limit, after=after_key)
+        has_newer = len(newer_raw) > limit
+        messages = list(reversed(newer_raw[:limit]))
+        if after_seq is not None:
+            # seq идут без пропусков: старше страницы есть сообщения 1..after_seq
+            has_more = after_seq > 0
+        elif messages:
+            has_more = await repo.exists_beyond(chat_id, (messages[-1].ts, messages[-1].id), newer=False)
+        else:
+            has_more = await repo.exists_beyond(chat_id, after_key, newer=False, inclusive=True)
+    elif before_key is None and before_id is None:
+        # Самая новая страница: из кэша последних сообщений чата
+        messages, has_more = await MessageService(session, redis).list_recent_page(chat_id, limit)
+        has_newer = False
+    else:
+        messages_raw = await repo.list_for_chat(chat_id, limit=limit, before=before_key, before_id=before_id)
+        # Определяем, есть ли еще сообщения
+        has_more = len(messages_raw) > limit
+        messages = messages_raw[:limit]  # Берем только limit сообщений
+        if messages:
+            has_newer = await repo.exists_beyond(chat_id, (messages[0].ts, messages[0].id), newer=True)
+        else:
+            # Пустая страница: новее нее все, что от курсора и дальше
+            if before_key is None:
+                cursor = await repo.get(before_id)
+                before_key = (cursor.ts, cursor.id) if cursor is not None and cursor.chat_id == chat_id else None
+            has_newer = before_key is not None and await repo.exists_beyond(
+                chat_id, before_key, newer=True, inclusive=True
+            )
     
     return MessageListResponse(
         messages=[MessageRead.model_validate(msg) for msg in messages],
         has_more=has_more,
-        next_cursor=next_cursor,
+        # Для следующей страницы по старому параметру before_id
+        next_cursor=messages[-1].id if has_more and messages else None,
+        has_newer=has_newer,
+        before_cursor=encode_cursor(messages[-1]) if has_more and messages else None,
+        after_cursor=encode_cursor(messages[0]) if has_newer and messages else None,
     )
 
 
@@ -185,22 +258,26 @@ async def remove_reaction(
     await message_service.remove_reaction(message_id, current_user, emoji)
 
 
-@router.get("/search", response_model=list[MessageRead])
+@router.get("/search", response_model=list[MessageSearchResult])
 async def search_messages(
     chat_id: int,
     query: str,
-    limit: int = 50,
+    response: Response,
+    limit: int = Query(50, ge=1),
+    cursor: str | None = None,
     offset: int = 0,
     session: AsyncSession = Depends(get_session),
     current_user: int = Depends(get_current_user),
-) -> list[MessageRead]:
+) -> list[MessageSearchResult]:
     """
-    Поиск сообщений в чате по тексту.
+    Полнотекстовый поиск сообщений в чате, по убыванию релевантности.
     Query параметры:
     - chat_id: ID чата для поиска
-    - query: Поисковый запрос (минимум 1 символ)
+    - query: Поисковый запрос (минимум 1 символ), синтаксис websearch: слова,
+      "точная фраза", -исключить, or
     - limit: Максимальное количество результатов (по умолчанию 50)
-    - offset: Смещение для пагинации (по умолчанию 0)
+    - cursor: Курсор следующей страницы из заголовка X-Next-Cursor
+    - offset: Смещение для пагинации (устаревший, вместо него cursor)
     """
     # Проверяем, что поисковый запрос не пустой
     if not query or len(query.strip()) == 0:
@@ -208,6 +285,10 @@ async def search_messages(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Search query cannot be empty",
         )
+    try:
+        after = decode_search_cursor(cursor) if cursor is not None else None
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
     
     # Проверяем доступ к чату
     member_repo = ChatMemberRepository(session)
@@ -217,6 +298,14 @@ async def search_messages(
     
     # Выполняем поиск
     repo = MessageRepository(session)
-    messages = await repo.search_in_chat(chat_id, query.strip(), limit=limit, offset=offset)
-    
-    return [MessageRead.model_validate(msg) for msg in messages]
+    found = await repo.search_in_chat(chat_id, query.strip(), limit=limit, after=after, offset=offset)
+    results = [
+        MessageSearchResult.model_validate(
+            {**MessageRead.model_validate(message).model_dump(), "rank": rank, "snippet": snippet}
+        )
+        for message, rank, snippet in found[:limit]
+    ]
+    if len(found) > limit:
+        # Курсор в заголовке: тело ответа остается списком, как и раньше
+        response.headers["X-Next-Cursor"] = encode_search_cursor(results[-1].rank, results[-1].id)
+    return results
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, status
 from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.api.dependencies import get_current_user, get_redis
+from app.api.dependencies import get_current_user, get_current_user_id, get_redis, get_session
+from app.repositories.chat import ChatMemberRepository
 from app.schemas.message import TypingIndicator
-from app.schemas.presence import UserPresence
-from app.services.presence import PresenceService, TypingService
+from app.schemas.presence import PresenceBulkRequest, UserPresence
+from app.services.presence import PresenceService, TypingService, heartbeats
 
 router = APIRouter()
 
@@ -15,41 +17,66 @@ router = APIRouter()
 async def get_my_presence(
     current_user: int = Depends(get_current_user),
     redis: Redis = Depends(get_redis),
+    session: AsyncSession = Depends(get_session),
 ) -> UserPresence:
     """Получить свой онлайн статус"""
-    service = PresenceService(redis)
+    service = PresenceService(redis, session)
     status_data = await service.get_user_status(current_user)
     return UserPresence(**status_data)
 
 
+@router.post("/bulk", response_model=list[UserPresence])
+async def get_bulk_presence(
+    payload: PresenceBulkRequest,
+    current_user: int = Depends(get_current_user),
+    redis: Redis = Depends(get_redis),
+    session: AsyncSession = Depends(get_session),
+) -> list[UserPresence]:
+    """Получить статусы нескольких пользователей за один запрос к Redis"""
+    service = PresenceService(redis, session)
+    statuses = await service.get_multiple_users_status(payload.user_ids)
+    return [UserPresence(**status_data) for status_data in statuses.values()]
+
+
 @router.get("/{user_id}", response_model=UserPresence)
 async def get_user_presence(
     user_id: int,
     redis: Redis = Depends(get_redis),
+    session: AsyncSession = Depends(get_session),
 ) -> UserPresence:
     """Получить онлайн статус пользователя"""
-    service = PresenceService(redis)
+    service = PresenceService(redis, session)
     status_data = await service.get_user_status(user_id)
     return UserPresence(**status_data)
 
 
 @router.post("/heartbeat", status_code=204)
 async def heartbeat(
-    current_user: int = Depends(get_current_user),
-    redis: Redis = Depends(get_redis),
+    current_user: int = Depends(get_current_user_id),
 ) -> None:
-    """Обновить статус активности (heartbeat)"""
-    service = PresenceService(redis)
-    await service.heartbeat(current_user)
+    """Обновить статус активности (heartbeat).
+
+    Без походов в БД и Redis: отметка попадает в буфер воркера и
+    сбрасывается пачкой. Ставит online и клиенту без WebSocket.
+    """
+    heartbeats.record(current_user, http=True)
+
+
+async def ensure_chat_member(chat_id: int, user_id: int, session: AsyncSession) -> None:
+    member = await ChatMemberRepository(session).get_member(chat_id=chat_id, user_id=user_id)
+    if member is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Access denied")
 
 
 @router.post("/typing", status_code=204)
 async def set_typing(
     payload: TypingIndicator,
     current_user: int = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
     redis: Redis = Depends(get_redis),
 ) -> None:
     """Установить/снять индикатор набора текста в чате"""
+    await ensure_chat_member(payload.chat_id, current_user, session)
     service = TypingService(redis)
     if payload.is_typing:
         await service.start_typing(payload.chat_id, current_user)
@@ -60,8 +87,11 @@ async def set_typing(
 @router.get("/typing/{chat_id}", response_model=list[int])
 async def get_typing_users(
     chat_id: int,
+    current_user: int = Depends(get_current_user),
+    session: AsyncSession = Depends(get_session),
     redis: Redis = Depends(get_redis),
 ) -> list[int]:
     """Получить список пользователей, печатающих в чате"""
+    await ensure_chat_member(chat_id, current_user, session)
     service = TypingService(redis)
     return await service.get_typing_users(chat_id)
@@ -1,56 +1,210 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import logging
-from typing import Dict
+import time
 
-from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect, status
-from redis.asyncio import Redis
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect, status
 
-from app.api.dependencies import get_redis, get_session
+from app.api.ws_commands import CommandContext, handle_frame
 from app.core import jwt
 from app.core.config import settings
+from app.db.session import AsyncSessionMaker
+from app.repositories.chat import ChatMemberRepository
 from app.repositories.user import UserRepository
-from app.services.presence import PresenceService
+from app.services.events import EventLog
+from app.services.gateway import ENCODINGS, Connection, Event, hub, registry
+from app.services.online import NODE_ID, OnlineIndex
+from app.services.presence import PresenceService, TypingService, heartbeats
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# Глобальный словарь активных WebSocket соединений: user_id -> WebSocket
-active_connections: Dict[int, WebSocket] = {}
+TYPING_ROSTER_LOCK_KEY = "typing:roster:lock"
 
 
-async def authenticate_websocket(token: str, session: AsyncSession) -> int | None:
-    """Валидация токена и получение user_id"""
+async def authenticate_websocket(token: str) -> int | None:
+    """Валидация токена и получение user_id.
+
+    Сессия БД живёт только на время проверки пользователя: соединение из пула
+    возвращается сразу после рукопожатия, а не держится всё время жизни сокета.
+    """
     try:
         payload = jwt.decode(token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm])
-        subject = payload.get("sub")
-        if subject is None:
-            return None
-        
+    except jwt.JWTError:
+        return None
+
+    subject = payload.get("sub")
+    if subject is None:
+        return None
+
+    async with AsyncSessionMaker() as session:
         repo = UserRepository(session)
         user = await repo.get(int(subject))
         if user is None:
             return None
-        
         return user.id
-    except jwt.JWTError:
+
+
+async def load_chat_ids(user_id: int) -> list[int]:
+    """Чаты пользователя для подписки шлюза на их каналы (короткая сессия БД)"""
+    async with AsyncSessionMaker() as session:
+        return await ChatMemberRepository(session).list_chat_ids(user_id)
+
+
+async def set_presence(user_id: int, online: bool) -> None:
+    """Сменить статус пользователя.
+
+    Сессия нужна только при промахе кэша аудитории presence: соединение из пула
+    берется лишь тогда и сразу возвращается.
+    """
+    async with AsyncSessionMaker() as session:
+        service = PresenceService(hub.redis, session)
+        if online:
+            await service.set_user_online(user_id)
+        else:
+            await service.set_user_offline(user_id)
+
+
+async def load_presence_snapshot(user_id: int) -> Event | None:
+    """Событие presence.snapshot со статусами контактов пользователя.
+
+    Без снимка соединение работает дальше: клиент может запросить статусы сам.
+    """
+    try:
+        async with AsyncSessionMaker() as session:
+            users = await PresenceService(hub.redis, session).get_snapshot(user_id)
+    except Exception:
+        logger.exception(f"Failed to load presence snapshot for user {user_id}")
         return None
+    for user in users:
+        if user["last_seen"] is not None:
+            user["last_seen"] = user["last_seen"].isoformat()
+    return Event(json.dumps({"event": "presence.snapshot", "data": {"users": users}}))
+
+
+async def run_online_heartbeat() -> None:
+    """Heartbeat узла в индексе онлайн-пользователей и уборка упавших узлов.
+
+    Запускается в lifespan приложения, по одной задаче на воркер.
+    """
+    online = OnlineIndex(hub.redis)
+    while True:
+        try:
+            if await online.heartbeat():
+                # Узел посчитали упавшим (долгая пауза): заново отмечаем своих пользователей
+                # (reap уже разослал им offline)
+                for user_id in registry.user_ids():
+                    if await online.add(user_id):
+                        await set_presence(user_id, online=True)
+            for user_id in await online.reap():
+                await set_presence(user_id, online=False)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Online index heartbeat failed")
+        await asyncio.sleep(settings.online_heartbeat_seconds)
+
+
+async def run_typing_rosters() -> None:
+    """Периодическая рассылка typing.roster.
+
+    Задача есть в каждом воркере, но за период рассылку делает только тот,
+    кто первым взял короткую блокировку в Redis.
+    """
+    interval = settings.typing_roster_interval_ms
+    while True:
+        try:
+            redis = hub.redis
+            if await redis.set(TYPING_ROSTER_LOCK_KEY, NODE_ID, nx=True, px=interval):
+                await TypingService(redis).publish_rosters()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Typing roster publish failed")
+        await asyncio.sleep(interval / 1000)
+
+
+async def flush_heartbeats(persist: bool) -> None:
+    """Сбросить буфер heartbeat в Redis и, если persist, last_seen в Postgres"""
+    await heartbeats.flush_redis(hub.redis)
+    if persist:
+        async with AsyncSessionMaker() as session:
+            await heartbeats.flush_db(session)
+
+
+async def run_heartbeat_flush() -> None:
+    """Периодический сброс буфера heartbeat воркера"""
+    persisted_at = time.monotonic()
+    while True:
+        await asyncio.sleep(settings.presence_flush_seconds)
+        persist = time.monotonic() - persisted_at >= settings.presence_persist_seconds
+        try:
+            await flush_heartbeats(persist)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Heartbeat flush failed")
+        if persist:
+            persisted_at = time.monotonic()
+
+
+async def shutdown_online_node() -> None:
+    """Остановка воркера: сбросить буфер heartbeat и снять узел из индекса"""
+    try:
+        await flush_heartbeats(persist=True)
+    except Exception:
+        logger.exception("Failed to flush heartbeats on shutdown")
+    try:
+        for user_id in await OnlineIndex(hub.redis).drop_node():
+            await set_presence(user_id, online=False)
+    except Exception:
+        logger.exception("Failed to remove gateway node from online index")
+
+
+async def _receive_commands(websocket: WebSocket, connection: Connection) -> None:
+    """Читать команды клиента до закрытия сокета.
+
+    Команды одного соединения выполняются последовательно, ответы (ack) идут
+    через ту же очередь отправки, что и события.
+    """
+    context = CommandContext(connection)
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        await handle_frame(context, message)
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
     token: str = Query(...),
-    redis: Redis = Depends(get_redis),
-    session: AsyncSession = Depends(get_session),
+    batch_ms: int = Query(0),
+    encoding: str = Query("json"),
+    last_event_id: int | None = Query(None),
 ) -> None:
     """
     WebSocket endpoint для получения событий в реальном времени.
     Требует токен в query параметре: ws://localhost:8000/ws?token=<access_token>
+    Необязательный batch_ms (10-50) включает пакетную отправку: события за окно
+    приходят одним кадром с JSON-массивом.
+    encoding=msgpack включает бинарные кадры MessagePack вместо JSON.
+    Первым кадром приходит presence.snapshot со статусами контактов.
+    last_event_id - id последнего полученного события: пропущенные за время
+    переподключения события придут сразу после снимка (или resync, если разрыв
+    слишком велик).
+    Клиент может слать команды (message.send, typing, read, heartbeat),
+    на каждую с id приходит событие ack.
     """
+    if encoding not in ENCODINGS:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        logger.warning(f"WebSocket connection rejected: unsupported encoding {encoding}")
+        return
+    
     # Валидация токена
-    user_id = await authenticate_websocket(token, session)
+    user_id = await authenticate_websocket(token)
     if user_id is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         logger.warning("WebSocket connection rejected: invalid token")
@@ -58,47 +212,66 @@ async def websocket_endpoint(
     
     # Принимаем соединение
     await websocket.accept()
-    active_connections[user_id] = websocket
+    if batch_ms > 0:
+        batch_ms = min(max(batch_ms, settings.ws_batch_min_ms), settings.ws_batch_max_ms)
+    connection = Connection(websocket, user_id, batch_ms=max(batch_ms, 0), encoding=encoding)
     logger.info(f"WebSocket connected: user_id={user_id}")
     
-    # Устанавливаем пользователя онлайн
-    presence_service = PresenceService(redis)
-    await presence_service.set_user_online(user_id)
+    # Общий клиент Redis процесса вместо отдельного пула на каждый сокет
+    redis = hub.redis
+    online = OnlineIndex(redis)
     
-    # Подписываемся на персональный канал пользователя
-    pubsub = redis.pubsub()
-    channel = f"ws:user:{user_id}"
-    await pubsub.subscribe(channel)
-    
-    # Маркер активного WebSocket соединения для scan_iter
-    ws_marker_key = f"ws:user:{user_id}"
-    await redis.setex(ws_marker_key, 3600, "connected")  # 1 час TTL
+    # Регистрируем соединение; подписка на ws:user:{id} одна на пользователя,
+    # сколько бы у него ни было вкладок и устройств. Каналы ws:chat:{id}
+    # подписываются для чатов пользователя, которых процесс еще не слушает
+    chat_ids = [] if registry.connections_for(user_id) else await load_chat_ids(user_id)
+    # Живые события придерживаются, пока не уйдут снимок presence и докачка
+    connection.hold()
     
+    tasks: list[asyncio.Task] = []
     try:
-        async for message in pubsub.listen():
-            if message["type"] != "message":
-                continue
-            
-            data = message["data"]
-            if isinstance(data, bytes):
-                data = data.decode("utf-8")
-            
-            await websocket.send_text(data)
-            logger.debug(f"Sent WebSocket event to user {user_id}")
-            
+        # Внутри try: если подписка не удалась, finally все равно снимет соединение
+        is_first = await registry.add(connection, chat_ids)
+        # Снимок и докачка читаются уже после подписки, чтобы между ними
+        # и живыми событиями не было окна
+        snapshot = await load_presence_snapshot(user_id)
+        replayed: list[Event] = []
+        resync = False
+        if last_event_id is not None:
+            payloads, resync = await EventLog(redis).read_since(
+                user_id, registry.chats_for(user_id), last_event_id
+            )
+            replayed = [Event(payload) for payload in payloads]
+        connection.resume(replayed, resync, snapshot=snapshot)
+        # Онлайн - только когда у пользователя появилось первое соединение
+        # во всем кластере, а не на этом узле
+        if is_first and await online.add(user_id):
+            await set_presence(user_id, online=True)
+        
+        tasks = [
+            asyncio.create_task(connection.pump()),
+            asyncio.create_task(_receive_commands(websocket, connection)),
+        ]
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+        logger.info(f"WebSocket disconnected: user_id={user_id}")
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected: user_id={user_id}")
     finally:
-        # Очищаем соединение
-        active_connections.pop(user_id, None)
-        await pubsub.unsubscribe(channel)
-        await pubsub.close()
-        
-        # Удаляем маркер активного соединения
-        ws_marker_key = f"ws:user:{user_id}"
-        await redis.delete(ws_marker_key)
+        for task in tasks:
+            task.cancel()
         
-        # Устанавливаем пользователя оффлайн
-        await presence_service.set_user_offline(user_id)
+        # Очищаем соединение
+        is_last = await registry.remove(connection)
+        if is_last:
+            went_offline = await online.remove(user_id)
+            if registry.connections_for(user_id):
+                # Пока снимали, пользователь успел переподключиться к этому узлу
+                await online.add(user_id)
+                went_offline = False
+            # Оффлайн только когда закрыт последний сокет пользователя в кластере
+            if went_offline:
+                await set_presence(user_id, online=False)
         
         logger.info(f"WebSocket cleanup completed for user_id={user_id}")
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import json
+import logging
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from datetime import timedelta
+
+import msgpack
+from pydantic import BaseModel, ValidationError
+
+from app.db.session import AsyncSessionMaker
+from app.repositories.chat import ChatMemberRepository
+from app.schemas.message import MessageCreate, MessageRead, TypingIndicator
+from app.services.gateway import Connection, Event, hub, registry
+from app.services.idempotency import IdempotencyService
+from app.services.message import MessageService
+from app.services.presence import TypingService, heartbeats
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних ответов помнить на соединение для повторов с тем же id
+RECENT_ACKS_LIMIT = 256
+
+
+class CommandError(Exception):
+    pass
+
+
+class ChatCommand(BaseModel):
+    chat_id: int
+
+
+class CommandContext:
+    """Состояние команд одного соединения: недавние ответы для дедупликации повторов"""
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.recent_acks: OrderedDict[str, Event] = OrderedDict()
+
+
+async def handle_frame(context: CommandContext, message: dict) -> None:
+    """Разобрать входящий кадр клиента и выполнить команду.
+
+    Формат: {"id": "<request id>", "type": "<команда>", "data": {...}}.
+    На каждую команду с id отправляется {"event": "ack", "data": {"request_id", "ok", ...}}.
+    """
+    try:
+        if message.get("bytes") is not None:
+            command = msgpack.unpackb(message["bytes"])
+        else:
+            command = json.loads(message.get("text") or "")
+    except (ValueError, msgpack.UnpackException):
+        logger.debug(f"Malformed WebSocket command from user {context.connection.user_id}")
+        return
+    if not isinstance(command, dict):
+        return
+
+    request_id = command.get("id")
+    request_id = str(request_id) if request_id is not None else None
+    if request_id is not None and request_id in context.recent_acks:
+        # Повтор уже выполненной команды: отвечаем прежним результатом
+        context.connection.deliver(context.recent_acks[request_id])
+        return
+
+    handler = COMMANDS.get(command.get("type"))
+    try:
+        if handler is None:
+            raise CommandError("Unknown command")
+        data = command.get("data") or {}
+        if not isinstance(data, dict):
+            raise CommandError("Command data must be an object")
+        result = await handler(context.connection.user_id, data, request_id)
+        ack = {"request_id": request_id, "ok": True, "result": result}
+    except ValidationError as exc:
+        ack = {"request_id": request_id, "ok": False, "error": exc.errors(include_url=False)}
+    except (CommandError, ValueError) as exc:
+        ack = {"request_id": request_id, "ok": False, "error": str(exc)}
+    except Exception:
+        logger.exception(f"WebSocket command {command.get('type')} failed")
+        ack = {"request_id": request_id, "ok": False, "error": "Internal server error"}
+
+    if request_id is None:
+        return
+    event = Event(json.dumps({"event": "ack", "data": ack}, default=str))
+    context.recent_acks[request_id] = event
+    if len(context.recent_acks) > RECENT_ACKS_LIMIT:
+        context.recent_acks.popitem(last=False)
+    context.connection.deliver(event)
+
+
+async def send_message(user_id: int, data: dict, request_id: str | None) -> dict:
+    payload = MessageCreate.model_validate(data)
+    redis = hub.redis
+    if request_id is not None:
+        # Повтор после переподключения приходит уже на другое соединение
+        idempotency = IdempotencyService(redis)
+        key = f"ws:{user_id}:{request_id}"
+        if not await idempotency.check_and_store(key, "pending", timedelta(minutes=5)):
+            raise CommandError("Duplicate request")
+
+    async with AsyncSessionMaker() as session:
+        member = await ChatMemberRepository(session).get_member(chat_id=payload.chat_id, user_id=user_id)
+        if member is None:
+            raise CommandError("Access denied")
+        message = await MessageService(session, redis).create_message(
+            chat_id=payload.chat_id,
+            author_id=user_id,
+            type=payload.type,
+            content=payload.content,
+            payload=payload.payload,
+            reply_to_id=payload.reply_to_id,
+        )
+        result = MessageRead.model_validate(message).model_dump(mode="json")
+
+    if request_id is not None:
+        await idempotency.mark_completed(key)
+    return result
+
+
+async def set_typing(user_id: int, data: dict, request_id: str | None) -> None:
+    payload = TypingIndicator.model_validate(data)
+    # Членство берем из реестра шлюза, без похода в БД
+    if payload.chat_id not in registry.chats_for(user_id):
+        raise CommandError("Access denied")
+    service = TypingService(hub.redis)
+    if payload.is_typing:
+        await service.start_typing(payload.chat_id, user_id)
+    else:
+        await service.stop_typing(payload.chat_id, user_id)
+
+
+async def mark_read(user_id: int, data: dict, request_id: str | None) -> dict:
+    payload = ChatCommand.model_validate(data)
+    async with AsyncSessionMaker() as session:
+        member = await ChatMemberRepository(session).get_member(chat_id=payload.chat_id, user_id=user_id)
+        if member is None:
+            raise CommandError("Access denied")
+        message_ids = await MessageService(session, hub.redis).mark_messages_as_read(payload.chat_id, user_id)
+    return {"message_ids": message_ids}
+
+
+async def heartbeat(user_id: int, data: dict, request_id: str | None) -> None:
+    heartbeats.record(user_id)
+
+
+COMMANDS: dict[str, Callable[[int, dict, str | None], Awaitable[object]]] = {
+    "message.send": send_message,
+    "typing": set_typing,
+    "read": mark_read,
+    "heartbeat": heartbeat,
+}
@@ -27,6 +27,39 @@ class Settings(BaseSettings):
     s3_secret_key: str = "minioadmin"
     s3_bucket: str = "attachments"
     rq_redis_url: str = "redis://localhost:6379/1"
+    # WebSocket шлюз: очередь исходящих кадров на соединение
+    ws_send_queue_size: int = 256
+    ws_droppable_events: list[str] = ["typing", "typing.roster", "user:presence"]
+    ws_coalesce_events: bool = True
+    # Допустимое окно пакетной отправки (?batch_ms=) в миллисекундах
+    ws_batch_min_ms: int = 10
+    ws_batch_max_ms: int = 50
+    # Потоки событий для докачки после переподключения (?last_event_id=)
+    ws_stream_maxlen: int = 1000
+    ws_stream_ttl_seconds: int = 60 * 60 * 24
+    ws_replay_limit: int = 200
+    # Кэш аудитории presence (соучастники чатов и друзья пользователя)
+    presence_audience_ttl_seconds: int = 600
+    # Индекс онлайн-пользователей: heartbeat узлов шлюза и срок, после которого
+    # узел без heartbeat считается упавшим
+    online_heartbeat_seconds: int = 15
+    online_node_ttl_seconds: int = 45
+    # Сколько живет индикатор набора текста без повторного start_typing
+    typing_ttl_seconds: int = 10
+    # Период сводного события typing.roster для чатов, где кто-то печатает
+    typing_roster_interval_ms: int = 3000
+    # Буфер heartbeat: сброс в Redis и сохранение last_seen в Postgres
+    presence_flush_seconds: int = 5
+    presence_persist_seconds: int = 60
+    # Кэш последних сообщений чата в Redis (первая страница истории без Postgres)
+    message_cache_size: int = 100
+    message_cache_ttl_seconds: int = 60 * 60
+    # Конфигурация полнотекстового поиска Postgres (russian, english, simple, ...).
+    # Должна совпадать с языком генерируемой колонки messages.search_vector
+    # (миграция 20261017_0014 создает ее с russian). Смена значения требует
+    # новой миграции, пересоздающей колонку с тем же языком, иначе запросы
+    # будут разбираться не той конфигурацией, что и проиндексированный текст
+    message_search_language: str = "russian"
 
 
 @lru_cache
@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import os
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class Counter:
+    """Монотонный счетчик с метками (значения хранятся в памяти процесса)"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = defaultdict(float)
+        _registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        self.values[_label_values(self.labels, labels)] += amount
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Текущее значение (может расти и убывать)"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_label_values(self.labels, labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.values[_label_values(self.labels, labels)] -= amount
+
+
+class Histogram:
+    """Распределение значений по корзинам (для задержек)"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...],
+        labels: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # Для каждой комбинации меток: счетчики по корзинам (+Inf последней), сумма
+        self.values: dict[tuple[str, ...], list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_values(self.labels, labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        samples = []
+        bounds = [*(_format_value(bound) for bound in self.buckets), "+Inf"]
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", (*self.labels, "le"), (*key, bound), cumulative))
+            samples.append((f"{self.name}_sum", self.labels, key, total))
+            samples.append((f"{self.name}_count", self.labels, key, cumulative))
+        return samples
+
+
+def _label_values(names: tuple[str, ...], labels: dict[str, str]) -> tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in names)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus.
+
+    Значения живут в памяти воркера, поэтому у каждого ряда есть метка worker
+    (pid процесса): при нескольких воркерах uvicorn ряды не перемешиваются.
+    """
+    worker = str(os.getpid())
+    lines: list[str] = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        samples = metric.samples()
+        if not samples and not metric.labels and metric.type != "histogram":
+            samples = [(metric.name, (), (), 0.0)]
+        for name, label_names, label_values, value in samples:
+            labels = ",".join(
+                f'{label}="{_escape(label_value)}"'
+                for label, label_value in zip(("worker", *label_names), (worker, *label_values))
+            )
+            lines.append(f"{name}{{{labels}}} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+_registry: list[Counter | Gauge | Histogram] = []
+
+# Корзины задержки доставки события: от миллисекунд до секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# WebSocket шлюз
+ws_connections = Gauge(
+    "ws_connections",
+    "Open WebSocket connections in this worker",
+)
+ws_connected_users = Gauge(
+    "ws_connected_users",
+    "Users with at least one WebSocket connection in this worker",
+)
+ws_pubsub_channels = Gauge(
+    "ws_pubsub_channels",
+    "Redis pub/sub channels this worker is subscribed to",
+)
+ws_pubsub_subscribes = Counter(
+    "ws_pubsub_subscribe_total",
+    "SUBSCRIBE commands sent to Redis by the shared pub/sub connection",
+    labels=("kind",),
+)
+ws_pubsub_unsubscribes = Counter(
+    "ws_pubsub_unsubscribe_total",
+    "UNSUBSCRIBE commands sent to Redis by the shared pub/sub connection",
+    labels=("kind",),
+)
+ws_events_received = Counter(
+    "ws_events_received_total",
+    "Events received from Redis pub/sub by this worker",
+    labels=("event",),
+)
+ws_events_sent = Counter(
+    "ws_events_sent_total",
+    "Events written to WebSocket connections (one per recipient socket)",
+    labels=("event",),
+)
+ws_events_published = Counter(
+    "ws_events_published_total",
+    "Events published to Redis by this worker",
+    labels=("event",),
+)
+ws_events_unrouted = Counter(
+    "ws_events_unrouted_total",
+    "Events published to channels with no subscribed gateway",
+    labels=("event",),
+)
+ws_publish_to_send_seconds = Histogram(
+    "ws_publish_to_send_seconds",
+    "Time from publishing an event to writing it to a socket",
+    buckets=LATENCY_BUCKETS,
+)
+ws_dispatch_to_send_seconds = Histogram(
+    "ws_dispatch_to_send_seconds",
+    "Time from receiving an event from Redis to writing it to a socket",
+    buckets=LATENCY_BUCKETS,
+)
+ws_send_queue_depth = Gauge(
+    "ws_send_queue_depth",
+    "Frames waiting in outbound WebSocket queues of this worker",
+)
+ws_send_queue_evictions = Counter(
+    "ws_send_queue_evictions_total",
+    "Outbound frames evicted from full WebSocket queues",
+    labels=("reason",),
+)
+ws_slow_consumer_disconnects = Counter(
+    "ws_slow_consumer_disconnects_total",
+    "WebSocket connections closed because their outbound queue overflowed",
+)
@@ -2,13 +2,30 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from sqlalchemy import Boolean, ForeignKey, Index, String, Text, UniqueConstraint, func
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Computed,
+    ForeignKey,
+    Index,
+    String,
+    Text,
+    UniqueConstraint,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from app.core.config import settings
 from app.db.base import Base
 
 
+def search_vector_expression(language: str) -> str:
+    """Выражение генерируемой колонки messages.search_vector"""
+    return f"to_tsvector('{language}'::regconfig, coalesce(content, ''))"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -19,6 +36,7 @@ class User(Base):
     tag: Mapped[str] = mapped_column(String(32), unique=True, index=True, nullable=False)
     avatar_url: Mapped[str | None] = mapped_column(String(1024), nullable=True)
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    last_seen_at: Mapped[datetime | None] = mapped_column(nullable=True)
 
     memberships: Mapped[list["ChatMember"]] = relationship(back_populates="user", cascade="all, delete-orphan")
     messages: Mapped[list["Message"]] = relationship(back_populates="author")
@@ -31,6 +49,11 @@ class Chat(Base):
     title: Mapped[str] = mapped_column(String(255), nullable=False)
     is_group: Mapped[bool] = mapped_column(Boolean, default=True, server_default="true")
     created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    # Версия изменений сообщений чата: растет при каждом создании, правке, удалении,
+    # смене статуса и реакции; сообщение хранит версию своего последнего изменения
+    version: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0", nullable=False)
+    # seq последнего сообщения чата: номера идут подряд без пропусков
+    last_message_seq: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0", nullable=False)
 
     members: Mapped[list["ChatMember"]] = relationship(back_populates="chat", cascade="all, delete-orphan")
     messages: Mapped[list["Message"]] = relationship(back_populates="chat", cascade="all, delete-orphan")
@@ -45,6 +68,8 @@ class ChatMember(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
     role: Mapped[str] = mapped_column(String(50), default="member", server_default="member")
     joined_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    # Отметка прочтения: все сообщения чата с id <= ее прочитаны участником
+    last_read_message_id: Mapped[int | None] = mapped_column(nullable=True)
 
     chat: Mapped[Chat] = relationship(back_populates="members")
     user: Mapped[User] = relationship(back_populates="memberships")
@@ -53,7 +78,13 @@ class ChatMember(Base):
 class Message(Base):
     __tablename__ = "messages"
     __table_args__ = (
-        Index("ix_messages_chat_ts", "chat_id", "ts"),
+        # Страницы истории: WHERE chat_id = ? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC
+        Index("ix_messages_chat_ts_id", "chat_id", text("ts DESC"), text("id DESC")),
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # Дельта-синхронизация: изменения чата после версии
+        Index("ix_messages_chat_version", "chat_id", "version"),
+        UniqueConstraint("chat_id", "seq", name="uq_message_chat_seq"),
+        Index("ix_messages_search_vector", "search_vector", postgresql_using="gin"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -63,6 +94,11 @@ class Message(Base):
     content: Mapped[str | None] = mapped_column(Text, nullable=True)
     payload: Mapped[dict | None] = mapped_column(JSONB, nullable=True)
     status: Mapped[str] = mapped_column(String(20), nullable=False, server_default="delivered", index=True)
+    # Сколько участников, кроме автора, прочитали сообщение (растет вместе с отметками прочтения)
+    read_count: Mapped[int] = mapped_column(default=0, server_default="0", nullable=False)
+    version: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0", nullable=False)
+    # Номер сообщения в чате (1, 2, 3, ...): по пропускам клиент видит потерянные сообщения
+    seq: Mapped[int] = mapped_column(BigInteger, nullable=False)
     ts: Mapped[datetime] = mapped_column(server_default=func.now(), index=True)
     
     # Новые поля
@@ -70,6 +106,12 @@ class Message(Base):
     is_deleted: Mapped[bool] = mapped_column(Boolean, default=False, server_default="false", index=True)
     deleted_at: Mapped[datetime | None] = mapped_column(nullable=True)
     updated_at: Mapped[datetime | None] = mapped_column(onupdate=func.now(), nullable=True)
+    # Полнотекстовый индекс текста; отложенная, чтобы не читаться вместе с сообщением
+    search_vector: Mapped[str | None] = mapped_column(
+        TSVECTOR,
+        Computed(search_vector_expression(settings.message_search_language), persisted=True),
+        deferred=True,
+    )
 
     chat: Mapped[Chat] = relationship(back_populates="messages")
     author: Mapped[User | None] = relationship(back_populates="messages")
@@ -80,6 +122,8 @@ class Message(Base):
     reply_to: Mapped["Message | None"] = relationship("Message", remote_side=[id], foreign_keys=[reply_to_id])
 
 
+# Прочтения по строке на сообщение и пользователя больше не пишутся: их заменила
+# отметка ChatMember.last_read_message_id, заполненная миграцией из этой таблицы
 class MessageRead(Base):
     __tablename__ = "message_reads"
     __table_args__ = (
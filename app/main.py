@@ -2,20 +2,47 @@ from __future__ import annotations
 
 import asyncio
 import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from app.api.router import api_router
 from app.api.ws import router as ws_router
+from app.api.ws import (
+    run_heartbeat_flush,
+    run_online_heartbeat,
+    run_typing_rosters,
+    shutdown_online_node,
+)
+from app.core import metrics
 from app.core.config import settings
+from app.services.gateway import hub
 
 # На Windows psycopg требует SelectorEventLoop вместо ProactorEventLoop
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-app = FastAPI(title=settings.app_name, version=settings.app_version)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    tasks = [
+        asyncio.create_task(run_online_heartbeat(), name="online-heartbeat"),
+        asyncio.create_task(run_typing_rosters(), name="typing-rosters"),
+        asyncio.create_task(run_heartbeat_flush(), name="heartbeat-flush"),
+    ]
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await shutdown_online_node()
+    # Закрываем общий pub/sub процесса для WebSocket шлюза
+    await hub.close()
+
+
+app = FastAPI(title=settings.app_name, version=settings.app_version, lifespan=lifespan)
 
 
 # Глобальный обработчик исключений с CORS заголовками
@@ -50,5 +77,11 @@ async def health() -> dict[str, str]:
     return {"status": "ok"}
 
 
+@app.get("/metrics", tags=["health"], response_class=PlainTextResponse)
+async def metrics_endpoint() -> PlainTextResponse:
+    """Метрики воркера в текстовом формате Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(api_router, prefix="/api")
 app.include_router(ws_router)
@@ -83,6 +83,23 @@ class ChatMemberRepository(Repository[ChatMember]):
         result = await self.session.execute(stmt)
         return [row[0] for row in result]
     
+    async def list_chat_ids(self, user_id: int) -> list[int]:
+        """Получить список chat_id всех чатов пользователя"""
+        stmt = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+        result = await self.session.execute(stmt)
+        return [row[0] for row in result]
+    
+    async def list_co_member_ids(self, user_id: int) -> list[int]:
+        """Получить user_id всех, кто состоит хотя бы в одном общем чате с пользователем"""
+        own_chats = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+        stmt = (
+            select(ChatMember.user_id)
+            .where(ChatMember.chat_id.in_(own_chats), ChatMember.user_id != user_id)
+            .distinct()
+        )
+        result = await self.session.execute(stmt)
+        return [row[0] for row in result]
+    
     async def list_members(self, chat_id: int) -> list[ChatMember]:
         """Получить список всех участников чата с информацией о пользователях"""
         stmt = (
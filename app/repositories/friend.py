@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from sqlalchemy import and_, or_, select
+from sqlalchemy import and_, case, or_, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
@@ -74,6 +74,17 @@ class FriendRepository(Repository[Friend]):
         users_result = await self.session.scalars(user_stmt)
         return list(users_result)
 
+    async def list_friend_ids(self, user_id: int, status: str = "accepted") -> list[int]:
+        """Получить ID друзей пользователя без загрузки самих пользователей"""
+        stmt = select(
+            case((Friend.user_id == user_id, Friend.friend_id), else_=Friend.user_id)
+        ).where(
+            or_(Friend.user_id == user_id, Friend.friend_id == user_id),
+            Friend.status == status,
+        )
+        result = await self.session.execute(stmt)
+        return [row[0] for row in result]
+
     async def list_pending_requests(self, user_id: int) -> list[tuple[Friend, User]]:
         """
         Получить список входящих запросов в друзья.
@@ -1,14 +1,67 @@
 from __future__ import annotations
 
+import base64
+import html
 from datetime import datetime
 
-from sqlalchemy import select, update
+from sqlalchemy import Float, Integer, any_, bindparam, case, cast, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import ARRAY, REGCONFIG
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
-from app.domain.models import Message
+from app.core.config import settings
+from app.domain.models import Chat, ChatMember, Message
 from app.repositories.base import Repository
 
+# Ключ сортировки истории: ts не уникален, id разрешает равенство
+MessageKey = tuple[datetime, int]
+# Ключ сортировки результатов поиска: релевантность, затем id
+SearchKey = tuple[float, int]
+
+# Фрагменты результатов поиска: Postgres обрамляет совпадения управляющими
+# символами, а <mark> подставляется уже после экранирования HTML
+_MARK_START, _MARK_STOP = "\x02", "\x03"
+SNIPPET_OPTIONS = f"StartSel={_MARK_START}, StopSel={_MARK_STOP}, MaxWords=30, MinWords=10, MaxFragments=2"
+
+
+def encode_cursor(message: Message) -> str:
+    """Непрозрачный курсор страницы: ключ (ts, id) сообщения в base64url"""
+    raw = f"{message.ts.isoformat()}|{message.id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> MessageKey:
+    """Ключ (ts, id) из курсора; ValueError, если курсор поврежден"""
+    try:
+        ts, message_id = _decode_parts(cursor)
+        return datetime.fromisoformat(ts), int(message_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    """Курсор страницы поиска: ключ (rank, id) последнего результата"""
+    raw = f"{rank!r}|{message_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> SearchKey:
+    """Ключ (rank, id) из курсора поиска; ValueError, если курсор поврежден"""
+    try:
+        rank, message_id = _decode_parts(cursor)
+        return float(rank), int(message_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+
+def render_snippet(headline: str) -> str:
+    """Фрагмент ts_headline в безопасный HTML с подсветкой <mark>"""
+    return html.escape(headline).replace(_MARK_START, "<mark>").replace(_MARK_STOP, "</mark>")
+
+
+def _decode_parts(cursor: str) -> list[str]:
+    return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+
 
 class MessageRepository(Repository[Message]):
     def __init__(self, session: AsyncSession):
@@ -32,6 +85,15 @@ class MessageRepository(Repository[Message]):
             payload=payload,
             reply_to_id=reply_to_id,
         )
+        # seq и версия берутся из строки чата одним UPDATE: блокировка держится
+        # до коммита, откат возвращает оба счетчика, поэтому seq идут без пропусков
+        stmt = (
+            update(Chat)
+            .where(Chat.id == chat_id)
+            .values(version=Chat.version + 1, last_message_seq=Chat.last_message_seq + 1)
+            .returning(Chat.version, Chat.last_message_seq)
+        )
+        message.version, message.seq = (await self.session.execute(stmt)).one()
         self.session.add(message)
         await self.session.flush()
         return message
@@ -41,30 +103,150 @@ class MessageRepository(Repository[Message]):
         chat_id: int,
         *,
         limit: int = 50,
+        before: MessageKey | None = None,
+        after: MessageKey | None = None,
         before_id: int | None = None,
         include_deleted: bool = False,
     ) -> list[Message]:
+        """Страница истории чата по ключу (ts, id), до limit + 1 сообщения.
+
+        Без after сообщения идут от новых к старым (до before, если задан),
+        с after - от старых к новым начиная сразу после него. Лишнее
+        сообщение сверх limit говорит, что в этом направлении есть еще.
+        Одним запросом по индексу ix_messages_chat_ts_id.
+        """
+        key = tuple_(Message.ts, Message.id)
         stmt = (
             select(Message)
             .where(Message.chat_id == chat_id)
             .options(selectinload(Message.reactions))
-            .order_by(Message.ts.desc())
             .limit(limit + 1)
         )
         
         if not include_deleted:
             stmt = stmt.where(Message.is_deleted == False)
         
-        if before_id is not None:
-            cursor_stmt = select(Message.ts).where(Message.id == before_id)
-            cursor_ts = await self.session.scalar(cursor_stmt)
-            if cursor_ts:
-                stmt = stmt.where(Message.ts < cursor_ts)
+        if after is not None:
+            stmt = stmt.where(key > tuple_(*after)).order_by(Message.ts.asc(), Message.id.asc())
+        else:
+            if before is not None:
+                stmt = stmt.where(key < tuple_(*before))
+            elif before_id is not None:
+                # Старый курсор по id: ts берется подзапросом в том же запросе
+                cursor_ts = select(Message.ts).where(Message.id == before_id).scalar_subquery()
+                stmt = stmt.where(key < tuple_(cursor_ts, before_id))
+            stmt = stmt.order_by(Message.ts.desc(), Message.id.desc())
         
         result = await self.session.scalars(stmt)
         return list(result)
 
+    async def exists_beyond(
+        self, chat_id: int, key: MessageKey, *, newer: bool, inclusive: bool = False
+    ) -> bool:
+        """Есть ли неудаленные сообщения новее (newer) или старше ключа (ts, id).
+
+        Флаги has_more / has_newer страницы в направлении, обратном листанию:
+        один EXISTS по индексу ix_messages_chat_ts_id.
+        """
+        row_key = tuple_(Message.ts, Message.id)
+        bound = tuple_(*key)
+        if newer:
+            condition = row_key >= bound if inclusive else row_key > bound
+        else:
+            condition = row_key <= bound if inclusive else row_key < bound
+        stmt = select(
+            select(Message.id)
+            .where(Message.chat_id == chat_id, Message.is_deleted == False, condition)
+            .exists()
+        )
+        return bool(await self.session.scalar(stmt))
+
+    async def reserve_versions(self, chat_id: int, count: int = 1) -> int:
+        """Зарезервировать count версий изменений чата, вернуть первую.
+
+        Строка чата заблокирована до конца транзакции, поэтому изменения
+        одного чата коммитятся в порядке версий и клиент, синхронизирующийся
+        по since, не пропустит меньшую версию, закоммиченную позже большей.
+        Версию резервируют до изменения строк messages: один порядок
+        блокировок (чат, затем сообщения) для всех записей.
+        """
+        stmt = (
+            update(Chat)
+            .where(Chat.id == chat_id)
+            .values(version=Chat.version + count)
+            .returning(Chat.version)
+        )
+        version = await self.session.scalar(stmt)
+        return version - count + 1
+
+    async def lock_versions(self, chat_id: int) -> None:
+        """Заблокировать версии чата заранее, если строки messages меняются до резервирования"""
+        stmt = select(Chat.id).where(Chat.id == chat_id).with_for_update(key_share=True)
+        await self.session.execute(stmt)
+
+    async def touch(self, message: Message) -> int:
+        """Новая версия сообщения без правки (например, изменились реакции)"""
+        version = await self.reserve_versions(message.chat_id)
+        stmt = (
+            update(Message)
+            .where(Message.id == message.id)
+            # updated_at не трогаем: это не правка сообщения
+            .values(version=version, updated_at=Message.updated_at)
+            .execution_options(synchronize_session=False)
+        )
+        await self.session.execute(stmt)
+        return version
+
+    async def list_changes(self, chat_id: int, since: int, *, limit: int = 100) -> list[Message]:
+        """Сообщения чата, измененные после версии since, по возрастанию версии (до limit + 1).
+
+        Удаленные тоже возвращаются: по ним клиент убирает сообщения у себя.
+        """
+        stmt = (
+            select(Message)
+            .where(Message.chat_id == chat_id, Message.version > since)
+            .options(selectinload(Message.reactions))
+            .order_by(Message.version)
+            .limit(limit + 1)
+        )
+        result = await self.session.scalars(stmt)
+        return list(result)
+
+    async def list_recent(self, chat_id: int, limit: int) -> tuple[list[Message], int]:
+        """Последние limit + 1 сообщений чата по seq (включая удаленные) и версия чата.
+
+        Версия читается тем же запросом, то есть из того же снимка, что и
+        сообщения: по ней кэш отличает устаревший снимок от свежего.
+        """
+        chat_version = select(Chat.version).where(Chat.id == chat_id).scalar_subquery()
+        stmt = (
+            select(Message, chat_version)
+            .where(Message.chat_id == chat_id)
+            .options(selectinload(Message.reactions))
+            .order_by(Message.seq.desc())
+            .limit(limit + 1)
+        )
+        rows = (await self.session.execute(stmt)).all()
+        version = rows[0][1] if rows else 0
+        return [row[0] for row in rows], version
+
+    async def list_by_seq(self, chat_id: int, after_seq: int, *, limit: int = 50) -> list[Message]:
+        """Сообщения чата с seq больше after_seq по возрастанию (до limit + 1).
+
+        Удаленные тоже возвращаются, чтобы в диапазоне не оставалось пропусков.
+        """
+        stmt = (
+            select(Message)
+            .where(Message.chat_id == chat_id, Message.seq > after_seq)
+            .options(selectinload(Message.reactions))
+            .order_by(Message.seq)
+            .limit(limit + 1)
+        )
+        result = await self.session.scalars(stmt)
+        return list(result)
+
     async def soft_delete(self, message: Message) -> Message:
+        message.version = await self.reserve_versions(message.chat_id)
         message.is_deleted = True
         message.deleted_at = datetime.utcnow()
         message.content = None
@@ -72,6 +254,47 @@ class MessageRepository(Repository[Message]):
         await self.session.flush()
         return message
 
+    async def mark_read_by_all(self, chat_id: int, message_ids: list[int]) -> list[Message]:
+        """Перевести в "read" сообщения, которые прочитали все участники чата, кроме автора.
+
+        Один условный UPDATE ... RETURNING по read_count: участники чата
+        считаются один раз на запрос, возвращаются только сообщения,
+        сменившие статус. message_ids должны идти по возрастанию без повторов.
+        """
+        if not message_ids:
+            return []
+        members = (
+            select(func.count())
+            .select_from(ChatMember)
+            .where(ChatMember.chat_id == chat_id)
+            .scalar_subquery()
+        )
+        author_is_member = (
+            select(ChatMember.id)
+            .where(ChatMember.chat_id == chat_id, ChatMember.user_id == Message.author_id)
+            .exists()
+        )
+        readers = members - case((author_is_member, 1), else_=0)
+        # Массив одним параметром: число параметров запроса не растет с числом сообщений
+        ids = bindparam("message_ids", message_ids, type_=ARRAY(Integer))
+        # Каждому сообщению своя версия из зарезервированного диапазона; версии
+        # кандидатов, не сменивших статус, просто пропадают
+        first_version = await self.reserve_versions(chat_id, len(message_ids))
+        stmt = (
+            update(Message)
+            .where(
+                Message.chat_id == chat_id,
+                Message.id == any_(ids),
+                Message.status != "read",
+                Message.read_count >= readers,
+            )
+            .values(status="read", version=first_version - 1 + func.array_position(ids, Message.id))
+            .returning(Message)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        result = await self.session.scalars(stmt)
+        return sorted(result, key=lambda message: message.id)
+
     async def get_with_reactions(self, message_id: int) -> Message | None:
         stmt = (
             select(Message)
@@ -87,27 +310,38 @@ class MessageRepository(Repository[Message]):
         query: str,
         *,
         limit: int = 50,
+        after: SearchKey | None = None,
         offset: int = 0,
-    ) -> list[Message]:
+    ) -> list[tuple[Message, float, str]]:
         """
-        Поиск сообщений в чате по тексту.
-        Использует ILIKE для поиска подстроки (case-insensitive).
+        Полнотекстовый поиск сообщений в чате (до limit + 1 результата).
+        Запрос в синтаксисе websearch ("точная фраза", -исключить, or), поиск
+        по индексу ix_messages_search_vector. Результаты по убыванию
+        релевантности: (сообщение, rank, фрагмент с подсветкой <mark>).
+        after - ключ (rank, id) последнего результата предыдущей страницы.
         """
+        language = cast(settings.message_search_language, REGCONFIG)
+        tsquery = func.websearch_to_tsquery(language, query)
+        rank = cast(func.ts_rank_cd(Message.search_vector, tsquery), Float)
+        snippet = func.ts_headline(language, func.coalesce(Message.content, ""), tsquery, SNIPPET_OPTIONS)
         stmt = (
-            select(Message)
+            select(Message, rank, snippet)
             .where(
                 Message.chat_id == chat_id,
                 Message.is_deleted == False,
-                Message.content.ilike(f"%{query}%")
+                Message.search_vector.bool_op("@@")(tsquery),
             )
             .options(selectinload(Message.reactions))
-            .order_by(Message.ts.desc())
-            .limit(limit)
-            .offset(offset)
+            .order_by(rank.desc(), Message.id.desc())
+            .limit(limit + 1)
         )
+        if after is not None:
+            stmt = stmt.where(tuple_(rank, Message.id) < tuple_(*after))
+        elif offset:
+            stmt = stmt.offset(offset)
         
-        result = await self.session.scalars(stmt)
-        return list(result)
+        result = await self.session.execute(stmt)
+        return [(message, rank, render_snippet(snippet)) for message, rank, snippet in result]
     
     async def get_last_message(self, chat_id: int) -> Message | None:
         """Получить последнее неудаленное сообщение в чате с автором"""
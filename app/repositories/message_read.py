@@ -1,71 +1,83 @@
 from __future__ import annotations
 
-from sqlalchemy import select
+from sqlalchemy import func, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.domain.models import MessageRead
+from app.domain.models import ChatMember, Message, MessageRead
 from app.repositories.base import Repository
 
 
 class MessageReadRepository(Repository[MessageRead]):
+    """Прочтения сообщений.
+
+    Прочтение хранится отметкой ChatMember.last_read_message_id: все сообщения
+    чата с id не больше отметки прочитаны участником. Message.read_count
+    считает участников, чья отметка уже дошла до сообщения.
+    """
+
     def __init__(self, session: AsyncSession):
         super().__init__(session, MessageRead)
 
-    async def mark_as_read(self, message_id: int, user_id: int) -> MessageRead:
-        """Отметить сообщение как прочитанное. Если уже отмечено - вернуть существующую запись."""
-        # Проверяем, не было ли уже отмечено
-        stmt = select(MessageRead).where(
-            MessageRead.message_id == message_id,
-            MessageRead.user_id == user_id
+    async def mark_chat_as_read(self, chat_id: int, user_id: int) -> tuple[int, list[int]] | None:
+        """Сдвинуть отметку прочтения участника на последнее сообщение чата.
+
+        Одним запросом: отметка сдвигается, а read_count чужих сообщений
+        из сдвинутого диапазона увеличивается на единицу. Возвращает
+        (новая отметка, ID прочитанных сообщений) или None, если новых чужих
+        сообщений нет. Строка участника блокируется до конца транзакции,
+        поэтому параллельные вызовы не посчитают одно прочтение дважды.
+        """
+        previous = (
+            select(ChatMember.id, func.coalesce(ChatMember.last_read_message_id, 0).label("last_read_message_id"))
+            .where(ChatMember.chat_id == chat_id, ChatMember.user_id == user_id)
+            .with_for_update()
+            .cte("previous")
         )
-        result = await self.session.scalar(stmt)
-        
-        if result is not None:
-            return result
-        
-        # Создаем новую запись
-        message_read = MessageRead(message_id=message_id, user_id=user_id)
-        self.session.add(message_read)
-        await self.session.flush()
-        return message_read
+        latest = select(func.max(Message.id)).where(Message.chat_id == chat_id).scalar_subquery()
+        advanced = (
+            update(ChatMember)
+            .where(ChatMember.id == previous.c.id, previous.c.last_read_message_id < latest)
+            .values(last_read_message_id=latest)
+            .returning(
+                previous.c.last_read_message_id.label("previous_id"),
+                ChatMember.last_read_message_id.label("last_read_id"),
+            )
+            .cte("advanced")
+        )
+        stmt = (
+            update(Message)
+            .where(
+                Message.chat_id == chat_id,
+                Message.id > advanced.c.previous_id,
+                Message.id <= advanced.c.last_read_id,
+                Message.author_id != user_id,
+            )
+            # updated_at не трогаем: прочтение не правка сообщения
+            .values(read_count=Message.read_count + 1, updated_at=Message.updated_at)
+            .returning(Message.id, advanced.c.last_read_id)
+            .execution_options(synchronize_session=False)
+        )
+        rows = (await self.session.execute(stmt)).all()
+        if not rows:
+            return None
+        return rows[0].last_read_id, sorted(row.id for row in rows)
 
-    async def get_unread_message_ids(self, chat_id: int, user_id: int) -> list[int]:
-        """Получить ID всех непрочитанных сообщений в чате для пользователя"""
-        from app.domain.models import Message
-        
-        # Подзапрос для прочитанных сообщений
-        read_subquery = select(MessageRead.message_id).where(
-            MessageRead.user_id == user_id
-        ).subquery()
-        
-        # Получаем ID сообщений, которые НЕ прочитаны пользователем
-        # И которые НЕ написаны этим пользователем (свои сообщения не считаются непрочитанными)
-        stmt = select(Message.id).where(
-            Message.chat_id == chat_id,
-            Message.author_id != user_id,
-            Message.id.not_in(select(read_subquery))
+    def _last_read_id(self, chat_id: int, user_id: int):
+        return func.coalesce(
+            select(ChatMember.last_read_message_id)
+            .where(ChatMember.chat_id == chat_id, ChatMember.user_id == user_id)
+            .scalar_subquery(),
+            0,
         )
-        
-        result = await self.session.scalars(stmt)
-        return list(result)
-    
+
     async def get_unread_count(self, chat_id: int, user_id: int) -> int:
         """Получить количество непрочитанных сообщений в чате для пользователя"""
-        from app.domain.models import Message
-        from sqlalchemy import func
-        
-        # Подзапрос для прочитанных сообщений
-        read_subquery = select(MessageRead.message_id).where(
-            MessageRead.user_id == user_id
-        ).subquery()
-        
-        # Подсчитываем непрочитанные сообщения
+        # Счет по диапазону индекса ix_messages_chat_id_id после отметки прочтения
         stmt = select(func.count(Message.id)).where(
             Message.chat_id == chat_id,
+            Message.id > self._last_read_id(chat_id, user_id),
             Message.author_id != user_id,
             Message.is_deleted == False,
-            Message.id.not_in(select(read_subquery))
         )
-        
         result = await self.session.scalar(stmt)
         return result or 0
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import re
+from datetime import UTC, datetime
 
-from sqlalchemy import select
+from sqlalchemy import bindparam, or_, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.domain.models import User
@@ -60,3 +61,38 @@ class UserRepository(Repository[User]):
         user.tag = new_tag.lower()
         await self.session.flush()
         return user
+
+    async def get_last_seen(self, user_ids: list[int]) -> dict[int, datetime]:
+        """Сохраненное время последней активности (пользователи без отметки не попадают)"""
+        stmt = select(User.id, User.last_seen_at).where(User.id.in_(user_ids), User.last_seen_at.is_not(None))
+        result = await self.session.execute(stmt)
+        # Колонка хранит UTC без часового пояса
+        return {user_id: last_seen_at.replace(tzinfo=UTC) for user_id, last_seen_at in result}
+
+    async def update_last_seen(self, last_seen: dict[int, datetime]) -> None:
+        """Сохранить время последней активности пачкой (одно выражение на всех).
+
+        Время только сдвигается вперед: данные от разных воркеров могут прийти
+        не по порядку.
+        """
+        if not last_seen:
+            return
+        table = User.__table__
+        stmt = (
+            update(table)
+            .where(
+                table.c.id == bindparam("user_id"),
+                or_(table.c.last_seen_at.is_(None), table.c.last_seen_at < bindparam("seen_at")),
+            )
+            .values(last_seen_at=bindparam("seen_at"))
+        )
+        await self.session.execute(
+            stmt, [{"user_id": user_id, "seen_at": _naive_utc(seen_at)} for user_id, seen_at in last_seen.items()]
+        )
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Время для колонки без часового пояса (в БД хранится UTC)"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(UTC).replace(tzinfo=None)
@@ -4,6 +4,7 @@ from datetime import datetime
 
 from pydantic import BaseModel
 
+from app.schemas.presence import UserPresence
 from app.schemas.user import UserRead
 
 
@@ -27,6 +28,7 @@ class ChatRead(BaseModel):
     lastMessageAuthor: str | None = None
     updatedAt: str | None = None
     unreadCount: int = 0
+    presence: list[UserPresence] | None = None  # статусы участников (?with_presence=true)
 
     model_config = {"from_attributes": True}
     
@@ -64,6 +66,8 @@ class ChatMemberRead(BaseModel):
     user_id: int
     role: str
     joined_at: str
+    last_read_message_id: int | None = None  # прочитаны все сообщения с id <= отметки
     user: UserRead
+    presence: UserPresence | None = None  # ?with_presence=true
     
     model_config = {"from_attributes": True}
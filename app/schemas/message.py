@@ -21,11 +21,14 @@ class MessageUpdate(BaseModel):
 class MessageRead(BaseModel):
     id: int
     chat_id: int
+    seq: int  # номер сообщения в чате, подряд без пропусков
     author_id: int | None
     type: str
     content: str | None
     payload: dict | None
     status: str  # delivered, read
+    read_count: int = 0  # сколько участников, кроме автора, прочитали
+    version: int = 0  # версия последнего изменения в чате (для GET /chats/{id}/changes)
     ts: datetime
     reply_to_id: int | None = None
     is_deleted: bool = False
@@ -37,10 +40,27 @@ class MessageRead(BaseModel):
 
 
 class MessageListResponse(BaseModel):
-    """Ответ с пагинацией для списка сообщений"""
+    """Ответ с пагинацией для списка сообщений (новые первыми)"""
     messages: list[MessageRead]
-    has_more: bool
-    next_cursor: int | None = None  # ID следующего сообщения для пагинации
+    has_more: bool  # есть ли сообщения старше страницы
+    next_cursor: int | None = None  # ID последнего сообщения для before_id (устаревший курсор)
+    has_newer: bool = False  # есть ли сообщения новее страницы
+    before_cursor: str | None = None  # курсор для before: следующая страница более старых
+    after_cursor: str | None = None  # курсор для after: страница более новых
+
+
+class MessageSearchResult(MessageRead):
+    """Результат поиска: сообщение с релевантностью и фрагментом"""
+    rank: float
+    snippet: str  # фрагмент текста, совпадения обрамлены <mark>...</mark>
+
+
+class MessageChangesResponse(BaseModel):
+    """Изменения сообщений чата после версии since (по возрастанию версии)"""
+    messages: list[MessageRead]  # созданные и измененные, с текущими реакциями
+    deleted_ids: list[int]  # удаленные после since
+    version: int  # передать как since в следующий запрос
+    has_more: bool  # изменений больше, чем limit: сразу запросить следующую страницу
 
 
 class ReactionCreate(BaseModel):
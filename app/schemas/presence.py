@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class UserPresence(BaseModel):
@@ -15,3 +15,8 @@ class UserPresence(BaseModel):
 class UserPresenceUpdate(BaseModel):
     """Обновление статуса пользователя"""
     status: str  # online, offline, away
+
+
+class PresenceBulkRequest(BaseModel):
+    """Запрос статусов нескольких пользователей"""
+    user_ids: list[int] = Field(..., max_length=1000)
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import logging
 
 from redis.asyncio import Redis
@@ -9,6 +8,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.domain.models import Chat
 from app.repositories.chat import ChatMemberRepository, ChatRepository
 from app.repositories.user import UserRepository
+from app.services.events import EventPublisher
+from app.services.presence import PresenceService
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +21,7 @@ class ChatService:
         self.chats = ChatRepository(session)
         self.members = ChatMemberRepository(session)
         self.users = UserRepository(session)
+        self.events = EventPublisher(redis) if redis is not None else None
 
     async def create_chat(self, *, title: str, is_group: bool, member_ids: list[int], creator_id: int) -> Chat:
         chat = await self.chats.create(title=title, is_group=is_group)
@@ -31,6 +33,8 @@ class ChatService:
             await self.members.create(chat_id=chat.id, user_id=user_id, role=role)
         
         await self.session.commit()
+        await self._invalidate_presence_audience(member_ids)
+        await self._publish_membership_event("chat.joined", chat.id, member_ids)
         # Перезагружаем чат с участниками
         chat = await self.chats.get(chat.id)
         return chat
@@ -45,17 +49,16 @@ class ChatService:
     async def delete_chat(self, chat: Chat, deleted_by: int) -> None:
         """Удалить чат и отправить WebSocket событие всем участникам"""
         chat_id = chat.id
-        
-        # Получаем список участников ДО удаления чата
-        participant_ids = await self.members.list_participant_ids(chat_id)
+        member_ids = await self.members.list_participant_ids(chat_id)
         
         # Удаляем чат
         await self.session.delete(chat)
         await self.session.commit()
+        await self._invalidate_presence_audience(member_ids)
         
-        # Отправляем WebSocket событие всем участникам
-        if self.redis:
-            await self._publish_chat_deleted_event(chat_id, deleted_by, participant_ids)
+        # Отправляем WebSocket событие в канал чата
+        if self.events:
+            await self._publish_chat_deleted_event(chat_id, deleted_by)
         else:
             logger.warning(f"Redis not available, chat.deleted event not sent for chat {chat_id}")
 
@@ -80,6 +83,8 @@ class ChatService:
         # Добавляем участника
         await self.members.create(chat_id=chat.id, user_id=user_id, role="member")
         await self.session.commit()
+        await self._invalidate_presence_audience(await self.members.list_participant_ids(chat.id))
+        await self._publish_membership_event("chat.joined", chat.id, [user_id])
     
     async def remove_member(self, chat: Chat, user_id: int, removed_by: int) -> None:
         """Удалить участника из чата. Только админы могут удалять из групповых чатов."""
@@ -101,6 +106,8 @@ class ChatService:
             raise ValueError("User is not a member of this chat")
         
         await self.session.commit()
+        await self._invalidate_presence_audience([user_id, *await self.members.list_participant_ids(chat.id)])
+        await self._publish_membership_event("chat.left", chat.id, [user_id])
 
     async def create_or_get_direct_message(self, user1_id: int, user2_id: int) -> Chat:
         """Создать или получить существующую личную переписку между двумя пользователями"""
@@ -128,27 +135,31 @@ class ChatService:
         await self.members.create(chat_id=chat.id, user_id=user2_id, role="member")
         
         await self.session.commit()
+        await self._invalidate_presence_audience([user1_id, user2_id])
+        await self._publish_membership_event("chat.joined", chat.id, [user1_id, user2_id])
         # Перезагружаем чат с участниками
         chat = await self.chats.get(chat.id)
         return chat
 
-    async def _publish_chat_deleted_event(
-        self, chat_id: int, deleted_by: int, participant_ids: list[int]
-    ) -> None:
-        """Отправить WebSocket событие chat.deleted всем участникам чата"""
-        payload = {
-            "event": "chat.deleted",
-            "data": {
-                "id": chat_id,
-                "deleted_by": deleted_by,
-            },
-        }
-        payload_json = json.dumps(payload)
-        
-        # Отправляем событие в персональный канал каждого участника
-        for user_id in participant_ids:
-            channel = f"ws:user:{user_id}"
-            await self.redis.publish(channel, payload_json)
-            logger.debug(f"Published chat.deleted to user {user_id} for chat {chat_id}")
-        
-        logger.info(f"Broadcast chat.deleted to {len(participant_ids)} participants for chat {chat_id}")
+    async def _publish_membership_event(self, event: str, chat_id: int, user_ids: list[int]) -> None:
+        """Сообщить пользователям (и их шлюзам) о входе в чат или выходе из него.
+
+        Шлюз по chat.joined / chat.left подписывает или отписывает соединения
+        пользователя от канала чата, поэтому событие идет в персональные каналы.
+        """
+        if not self.events:
+            logger.warning(f"Redis not available, {event} event not sent for chat {chat_id}")
+            return
+        await self.events.publish_to_users(user_ids, event, {"chat_id": chat_id})
+
+    async def _invalidate_presence_audience(self, user_ids: list[int]) -> None:
+        """Состав чата изменился: кэш аудитории presence участников устарел"""
+        if self.redis is None:
+            logger.warning("Redis not available, presence audience cache not invalidated")
+            return
+        await PresenceService(self.redis).invalidate_audience(user_ids)
+
+    async def _publish_chat_deleted_event(self, chat_id: int, deleted_by: int) -> None:
+        """Отправить WebSocket событие chat.deleted в канал чата"""
+        await self.events.publish_to_chat(chat_id, "chat.deleted", {"id": chat_id, "deleted_by": deleted_by})
+        logger.info(f"Broadcast chat.deleted to chat {chat_id}")
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+from collections.abc import Iterable
+
+from redis.asyncio import Redis
+
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+EVENT_SEQ_KEY = "ws:event_seq"
+EVENT_CHECKPOINTS_KEY = "ws:event_seq:hours"
+
+# Атомарно: присвоить событию глобальный id и время публикации (мс, часы Redis),
+# записать его в поток (с ограничением длины и TTL), отметить первый id текущего
+# часа и опубликовать в канал. Возвращает число подписчиков канала
+_PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local now = redis.call('TIME')
+local published_at = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local payload = '{"id": ' .. seq .. ', "published_at": ' .. string.format('%d', published_at)
+    .. ', ' .. string.sub(ARGV[1], 2)
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], seq .. '-0', 'e', payload)
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('ZADD', KEYS[3], 'NX', seq, math.floor(tonumber(now[1]) / 3600))
+redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -(tonumber(ARGV[4]) + 1))
+return redis.call('PUBLISH', ARGV[5], payload)
+"""
+
+
+def user_channel(user_id: int) -> str:
+    """Персональный канал пользователя: события, адресованные конкретному пользователю"""
+    return f"ws:user:{user_id}"
+
+
+def chat_channel(chat_id: int) -> str:
+    """Канал чата: одна публикация доходит до всех участников через шлюзы"""
+    return f"ws:chat:{chat_id}"
+
+
+def user_stream(user_id: int) -> str:
+    return f"ws:stream:user:{user_id}"
+
+
+def chat_stream(chat_id: int) -> str:
+    return f"ws:stream:chat:{chat_id}"
+
+
+def _checkpoint_hours() -> int:
+    return math.ceil(settings.ws_stream_ttl_seconds / 3600) + 1
+
+
+class EventPublisher:
+    """Публикация WebSocket событий в Redis.
+
+    События чата публикуются один раз в ws:chat:{id}; шлюзы подписаны на чаты
+    своих подключенных пользователей и сами раздают событие сокетам.
+    Персональные каналы остаются для событий, адресованных пользователю.
+
+    Каждое событие получает глобальный возрастающий id и сохраняется в
+    ограниченный поток Redis, чтобы переподключившийся клиент мог дочитать
+    пропущенное (см. EventLog).
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._script = redis.register_script(_PUBLISH_SCRIPT)
+
+    async def publish_to_chat(self, chat_id: int, event: str, data: dict) -> None:
+        receivers = await self._publish(self.redis, chat_stream(chat_id), chat_channel(chat_id), event, data)
+        _count_published(event, receivers)
+        logger.debug(f"Published {event} to chat {chat_id}")
+
+    async def publish_many_to_chat(self, chat_id: int, events: Iterable[tuple[str, dict]]) -> None:
+        """Несколько событий одного чата за один round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        names = []
+        for event, data in events:
+            await self._publish(pipe, chat_stream(chat_id), chat_channel(chat_id), event, data)
+            names.append(event)
+        if names:
+            for event, receivers in zip(names, await pipe.execute()):
+                _count_published(event, receivers)
+        logger.debug(f"Published {len(names)} events to chat {chat_id}")
+
+    async def publish_to_users(self, user_ids: Iterable[int], event: str, data: dict) -> None:
+        """Событие в персональные каналы пользователей (одним pipeline)"""
+        pipe = self.redis.pipeline(transaction=False)
+        count = 0
+        for user_id in user_ids:
+            await self._publish(pipe, user_stream(user_id), user_channel(user_id), event, data)
+            count += 1
+        if count:
+            for receivers in await pipe.execute():
+                _count_published(event, receivers)
+        logger.debug(f"Published {event} to {count} users")
+
+    async def publish_ephemeral_to_chat(self, chat_id: int, event: str, data: dict) -> None:
+        """Эфемерное событие чата (typing): только участникам онлайн, без записи в поток"""
+        receivers = await self.redis.publish(chat_channel(chat_id), json.dumps({"event": event, "data": data}))
+        _count_published(event, receivers)
+
+    async def publish_ephemeral_to_chats(self, event: str, data_by_chat: dict[int, dict]) -> None:
+        """Эфемерное событие в несколько чатов одним pipeline"""
+        if not data_by_chat:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for chat_id, data in data_by_chat.items():
+            pipe.publish(chat_channel(chat_id), json.dumps({"event": event, "data": data}))
+        for receivers in await pipe.execute():
+            _count_published(event, receivers)
+
+    async def publish_ephemeral_to_users(self, user_ids: Iterable[int], event: str, data: dict) -> None:
+        """Эфемерное событие (presence, typing) в персональные каналы без записи в поток.
+
+        У таких событий нет id: при переподключении они не дочитываются.
+        """
+        payload_json = json.dumps({"event": event, "data": data})
+        pipe = self.redis.pipeline(transaction=False)
+        count = 0
+        for user_id in user_ids:
+            pipe.publish(user_channel(user_id), payload_json)
+            count += 1
+        if count:
+            for receivers in await pipe.execute():
+                _count_published(event, receivers)
+        logger.debug(f"Published {event} to {count} users")
+
+    async def _publish(self, client, stream: str, channel: str, event: str, data: dict):
+        payload_json = json.dumps({"event": event, "data": data})
+        return await self._script(
+            keys=[EVENT_SEQ_KEY, stream, EVENT_CHECKPOINTS_KEY],
+            args=[
+                payload_json,
+                settings.ws_stream_maxlen,
+                settings.ws_stream_ttl_seconds,
+                _checkpoint_hours(),
+                channel,
+            ],
+            client=client,
+        )
+
+
+def _count_published(event: str, receivers: int) -> None:
+    metrics.ws_events_published.inc(event=event)
+    if not receivers:
+        # Ни один шлюз не слушает канал: получатели офлайн, событие только в потоке
+        metrics.ws_events_unrouted.inc(event=event)
+
+
+class EventLog:
+    """Чтение сохраненных событий для докачки после переподключения"""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+
+    async def read_since(
+        self, user_id: int, chat_ids: Iterable[int], last_event_id: int
+    ) -> tuple[list[str], bool]:
+        """События пользователя и его чатов с id > last_event_id, упорядоченные по id.
+
+        Второй элемент - признак того, что разрыв слишком велик (события уже
+        вытеснены из потоков или их больше лимита) и клиенту нужна полная
+        ресинхронизация. Все чтения идут одним MULTI, то есть на один снимок.
+        """
+        streams = [user_stream(user_id), *(chat_stream(chat_id) for chat_id in chat_ids)]
+        limit = settings.ws_replay_limit
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.time()
+        pipe.get(EVENT_SEQ_KEY)
+        pipe.zrange(EVENT_CHECKPOINTS_KEY, 0, -1, withscores=True)
+        for stream in streams:
+            pipe.xlen(stream)
+            pipe.xrange(stream, "-", "+", count=1)
+            pipe.xrange(stream, f"{last_event_id + 1}-0", "+", count=limit + 1)
+        now, current_seq, checkpoints, *per_stream = await pipe.execute()
+
+        current_seq = int(current_seq or 0)
+        if last_event_id >= current_seq:
+            return [], False
+
+        # События старше TTL потоков могли истечь вместе с ключом потока
+        horizon_hour = math.floor((int(now[0]) - settings.ws_stream_ttl_seconds) / 3600) + 1
+        horizon = min(
+            (int(seq) for hour, seq in checkpoints if int(hour) >= horizon_hour),
+            default=current_seq + 1,
+        )
+        resync = last_event_id + 1 < horizon
+
+        entries: list[tuple[int, str]] = []
+        for index in range(len(streams)):
+            length, first, tail = per_stream[index * 3:index * 3 + 3]
+            # Поток упирается в MAXLEN, а его начало уже позже last_event_id:
+            # часть нужных событий вытеснена
+            if first and length >= settings.ws_stream_maxlen and _entry_seq(first[0][0]) > last_event_id + 1:
+                resync = True
+            entries.extend((_entry_seq(entry_id), fields["e"]) for entry_id, fields in tail)
+
+        if len(entries) > limit:
+            resync = True
+        if resync:
+            return [], True
+
+        entries.sort()
+        return [payload for _, payload in entries], False
+
+
+def _entry_seq(entry_id: str) -> int:
+    return int(entry_id.split("-", 1)[0])
@@ -0,0 +1,596 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from collections.abc import Callable, Iterable
+
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect, status
+from redis.asyncio import Redis
+from redis.asyncio.client import PubSub
+from redis.exceptions import RedisError
+
+from app.core import metrics
+from app.core.config import settings
+from app.services.events import chat_channel, user_channel
+
+logger = logging.getLogger(__name__)
+
+
+class Event:
+    """Событие из Redis.
+
+    Разбирается один раз на процесс и один объект разделяется между всеми
+    получателями; исходная строка отправляется в сокеты без перекодирования.
+    """
+
+    __slots__ = ("_body", "_packed", "raw", "received_at")
+
+    def __init__(self, raw: str, received_at: float | None = None):
+        self.raw = raw
+        # Когда событие пришло из pub/sub (None у дочитанных из потока и служебных)
+        self.received_at = received_at
+        self._body: dict | None = None
+        self._packed: bytes | None = None
+
+    @property
+    def packed(self) -> bytes:
+        """MessagePack-представление; кодируется один раз на процесс"""
+        if self._packed is None:
+            self._packed = msgpack.packb(self.body)
+        return self._packed
+
+    @property
+    def body(self) -> dict:
+        if self._body is None:
+            try:
+                body = json.loads(self.raw)
+            except ValueError:
+                body = None
+            self._body = body if isinstance(body, dict) else {}
+        return self._body
+
+    @property
+    def id(self) -> int | None:
+        """Глобальный id сохраненного события (у эфемерных typing/presence его нет)"""
+        return self.body.get("id")
+
+    @property
+    def name(self) -> str | None:
+        return self.body.get("event")
+
+    @property
+    def published_at(self) -> float | None:
+        """Время публикации по часам Redis, секунды"""
+        published_at = self.body.get("published_at")
+        return published_at / 1000 if published_at is not None else None
+
+    @property
+    def data(self) -> dict:
+        data = self.body.get("data")
+        return data if isinstance(data, dict) else {}
+
+    @property
+    def coalesce_key(self) -> str | None:
+        """Ключ, по которому более новое событие заменяет более старое в очереди"""
+        name = self.name
+        data = self.data
+        if name in ("message.updated", "message.deleted"):
+            return f"message:{data.get('id')}"
+        if name == "user:presence":
+            return f"presence:{data.get('user_id')}"
+        if name == "typing":
+            return f"typing:{data.get('chatId')}:{data.get('userId')}"
+        if name == "typing.roster":
+            return f"typing.roster:{data.get('chatId')}"
+        return None
+
+
+Handler = Callable[[Event], None]
+
+
+class PubSubHub:
+    """Общий для процесса pub/sub-читатель Redis.
+
+    Вместо отдельного redis.pubsub() на каждый сокет держим одно соединение
+    на воркер: каналы подписываются при появлении первого получателя и
+    отписываются при уходе последнего, а сообщения маршрутизируются
+    обработчикам в памяти.
+    """
+
+    def __init__(self, redis_url: str):
+        self._redis_url = redis_url
+        self._redis: Redis | None = None
+        self._pubsub: PubSub | None = None
+        self._handlers: dict[str, set[Handler]] = {}
+        self._reader: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._has_channels = asyncio.Event()
+        self._closing = False
+
+    @property
+    def redis(self) -> Redis:
+        """Общий клиент Redis для обычных команд (presence, маркеры и т.д.)"""
+        if self._redis is None:
+            self._redis = Redis.from_url(self._redis_url, decode_responses=True)
+        return self._redis
+
+    @property
+    def channel_count(self) -> int:
+        return len(self._handlers)
+
+    async def subscribe(self, channel: str, handler: Handler) -> None:
+        """Добавить обработчик канала; SUBSCRIBE уходит в Redis только для нового канала"""
+        async with self._lock:
+            self._ensure_reader()
+            handlers = self._handlers.get(channel)
+            if handlers is None:
+                self._handlers[channel] = {handler}
+                try:
+                    await self._pubsub.subscribe(channel)
+                except BaseException:
+                    del self._handlers[channel]
+                    raise
+                metrics.ws_pubsub_subscribes.inc(kind=_channel_kind(channel))
+                metrics.ws_pubsub_channels.set(len(self._handlers))
+                self._has_channels.set()
+                logger.debug(f"PubSubHub subscribed to {channel}")
+            else:
+                handlers.add(handler)
+
+    async def unsubscribe(self, channel: str, handler: Handler) -> None:
+        """Убрать обработчик; UNSUBSCRIBE уходит в Redis, когда получателей не осталось"""
+        async with self._lock:
+            handlers = self._handlers.get(channel)
+            if handlers is None:
+                return
+            handlers.discard(handler)
+            if handlers:
+                return
+            del self._handlers[channel]
+            metrics.ws_pubsub_channels.set(len(self._handlers))
+            if self._pubsub is not None:
+                await self._pubsub.unsubscribe(channel)
+                metrics.ws_pubsub_unsubscribes.inc(kind=_channel_kind(channel))
+                logger.debug(f"PubSubHub unsubscribed from {channel}")
+            if not self._handlers:
+                self._has_channels.clear()
+
+    async def close(self) -> None:
+        """Остановить читателя и закрыть соединения (вызывается при остановке приложения)"""
+        if self._reader is not None:
+            # Флаг + пробуждение: redis-py может поглотить отмену внутри get_message
+            self._closing = True
+            self._has_channels.set()
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+            self._closing = False
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+        self._handlers.clear()
+        self._has_channels.clear()
+        metrics.ws_pubsub_channels.set(0)
+
+    def _ensure_reader(self) -> None:
+        if self._pubsub is None:
+            self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read_loop(), name="pubsub-hub-reader")
+
+    async def _read_loop(self) -> None:
+        while not self._closing:
+            await self._has_channels.wait()
+            if self._closing:
+                return
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (RedisError, OSError):
+                logger.exception("PubSubHub read failed, retrying")
+                await asyncio.sleep(1.0)
+                continue
+
+            if message is None or message["type"] != "message":
+                continue
+
+            channel = message["channel"]
+            data = message["data"]
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            self._dispatch(channel, Event(data, received_at=time.time()))
+
+    def _dispatch(self, channel: str, event: Event) -> None:
+        metrics.ws_events_received.inc(event=event.name or "")
+        for handler in tuple(self._handlers.get(channel, ())):
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"PubSubHub handler failed for channel {channel}")
+
+
+def _channel_kind(channel: str) -> str:
+    """ws:user:1 -> user, ws:chat:5 -> chat"""
+    parts = channel.split(":")
+    return parts[1] if len(parts) > 2 else channel
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих кадров одного соединения.
+
+    При переполнении по порядку: выбрасываются эфемерные события (typing,
+    presence), затем более новое событие заменяет устаревшее с тем же ключом,
+    и только потом очередь считается переполненной - соединение закрывается
+    с подсказкой клиенту выполнить полную ресинхронизацию.
+    """
+
+    def __init__(self, maxsize: int, droppable: Iterable[str], coalesce: bool = True):
+        self.maxsize = maxsize
+        self.droppable = frozenset(droppable)
+        self.coalesce = coalesce
+        self.overflowed = False
+        self._items: deque[Event] = deque()
+        self._ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, event: Event) -> bool:
+        """Поставить событие в очередь. False, если очередь переполнена"""
+        if self.overflowed:
+            return False
+        if len(self._items) >= self.maxsize and not self._make_room(event):
+            if event.name in self.droppable:
+                metrics.ws_send_queue_evictions.inc(reason="dropped")
+                return True
+            self._overflow()
+            return False
+        self._items.append(event)
+        metrics.ws_send_queue_depth.inc()
+        self._ready.set()
+        return True
+
+    async def get(self) -> Event | None:
+        """Следующее событие; None означает, что очередь переполнилась"""
+        while not self._items and not self.overflowed:
+            self._ready.clear()
+            await self._ready.wait()
+        if self.overflowed:
+            return None
+        metrics.ws_send_queue_depth.dec()
+        return self._items.popleft()
+
+    def drain(self) -> list[Event]:
+        """Забрать все накопившиеся события без ожидания"""
+        items = list(self._items)
+        self._items.clear()
+        metrics.ws_send_queue_depth.dec(len(items))
+        return items
+
+    def _make_room(self, event: Event) -> bool:
+        if event.name in self.droppable:
+            return False
+        for index, queued in enumerate(self._items):
+            if queued.name in self.droppable:
+                self._evict(index, "dropped")
+                return True
+        key = event.coalesce_key if self.coalesce else None
+        if key is not None:
+            for index, queued in enumerate(self._items):
+                if queued.coalesce_key == key:
+                    self._evict(index, "coalesced")
+                    return True
+        return False
+
+    def _evict(self, index: int, reason: str) -> None:
+        del self._items[index]
+        metrics.ws_send_queue_depth.dec()
+        metrics.ws_send_queue_evictions.inc(reason=reason)
+
+    def _overflow(self) -> None:
+        metrics.ws_send_queue_depth.dec(len(self._items))
+        metrics.ws_send_queue_evictions.inc(len(self._items) + 1, reason="overflow")
+        self._items.clear()
+        self.overflowed = True
+        self._ready.set()
+
+
+RESYNC_EVENT = Event(json.dumps({"event": "resync", "data": {"reason": "slow_consumer"}}))
+RESYNC_GAP_EVENT = Event(json.dumps({"event": "resync", "data": {"reason": "gap"}}))
+
+ENCODINGS = ("json", "msgpack")
+
+_packer = msgpack.Packer()
+
+
+class Connection:
+    """Одно WebSocket соединение пользователя (вкладка, телефон и т.д.)
+
+    batch_ms > 0 включает пакетный режим: события, накопившиеся за окно,
+    уходят одним кадром с массивом вместо отдельного кадра на событие.
+    encoding="msgpack" переключает соединение на бинарные кадры MessagePack.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, batch_ms: int = 0, encoding: str = "json"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.batch_window = batch_ms / 1000
+        self.encoding = encoding
+        self._held: list[Event] | None = None
+        self.queue = OutboundQueue(
+            settings.ws_send_queue_size,
+            droppable=settings.ws_droppable_events,
+            coalesce=settings.ws_coalesce_events,
+        )
+
+    def deliver(self, event: Event) -> None:
+        """Поставить событие в очередь отправки (вызывается из PubSubHub)"""
+        if self._held is not None:
+            self._held.append(event)
+            return
+        if not self.queue.put(event):
+            logger.debug(f"Outbound queue overflow for user {self.user_id}")
+
+    def hold(self) -> None:
+        """Придерживать живые события, пока не будет дочитан пропущенный хвост"""
+        self._held = []
+
+    def resume(self, replayed: list[Event] = (), resync: bool = False, snapshot: Event | None = None) -> None:
+        """Отправить снимок состояния и дочитанные события, затем придержанные живые без дубликатов"""
+        held, self._held = self._held or [], None
+        if snapshot is not None:
+            self.deliver(snapshot)
+        if resync:
+            self.deliver(RESYNC_GAP_EVENT)
+        replayed_ids = {event.id for event in replayed}
+        for event in replayed:
+            self.deliver(event)
+        for event in held:
+            if event.id is None or event.id not in replayed_ids:
+                self.deliver(event)
+
+    async def pump(self) -> None:
+        """Отправлять события из очереди в сокет"""
+        while True:
+            event = await self.queue.get()
+            if event is None:
+                await self._close_for_resync()
+                return
+            if not self.batch_window:
+                await self._send([event])
+                continue
+
+            # Копим события в течение окна и отправляем их одним кадром
+            await asyncio.sleep(self.batch_window)
+            batch = [event, *self.queue.drain()]
+            if self.queue.overflowed:
+                await self._close_for_resync()
+                return
+            await self._send(batch)
+
+    async def _send(self, events: list[Event]) -> None:
+        """Отправить события кадром в кодировке соединения.
+
+        Закодированные события общие для всех получателей: пакет собирается
+        склейкой готовых представлений без повторного кодирования.
+        """
+        if self.encoding == "msgpack":
+            if self.batch_window:
+                frame = _packer.pack_array_header(len(events)) + b"".join(e.packed for e in events)
+            else:
+                frame = events[0].packed
+            await self.websocket.send_bytes(frame)
+        elif self.batch_window:
+            await self.websocket.send_text("[" + ",".join(e.raw for e in events) + "]")
+        else:
+            await self.websocket.send_text(events[0].raw)
+        self._observe(events)
+
+    def _observe(self, events: list[Event]) -> None:
+        now = time.time()
+        for event in events:
+            metrics.ws_events_sent.inc(event=event.name or "")
+            # Задержку считаем только для живых событий, не для дочитанных
+            if event.received_at is None:
+                continue
+            metrics.ws_dispatch_to_send_seconds.observe(now - event.received_at)
+            published_at = event.published_at
+            if published_at is not None:
+                metrics.ws_publish_to_send_seconds.observe(max(now - published_at, 0.0))
+
+    async def _close_for_resync(self) -> None:
+        """Медленный клиент: подсказать полную ресинхронизацию и закрыть соединение"""
+        metrics.ws_slow_consumer_disconnects.inc()
+        logger.warning(f"Closing slow WebSocket consumer: user_id={self.user_id}")
+        try:
+            await asyncio.wait_for(self._send([RESYNC_EVENT]), timeout=5)
+            await self.websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="resync")
+        except (TimeoutError, WebSocketDisconnect, RuntimeError, OSError):
+            # Сокет уже закрыт или клиент не читает: закрывать нечего
+            logger.debug(f"Failed to close slow WebSocket consumer: user_id={self.user_id}")
+
+
+class ConnectionRegistry:
+    """Реестр соединений процесса: user_id -> все локальные сокеты пользователя.
+
+    На пользователя приходится одна подписка на ws:user:{id} независимо от
+    числа устройств; одно сообщение Redis раздаётся всем его сокетам.
+    Дополнительно реестр держит подписки на ws:chat:{id} для чатов, в которых
+    состоят подключенные к процессу пользователи, и раздаёт события чата
+    локальным участникам. Состав чатов обновляется по событиям chat.joined,
+    chat.left и chat.deleted.
+    """
+
+    def __init__(self, hub: PubSubHub):
+        self._hub = hub
+        self._connections: dict[int, set[Connection]] = {}
+        self._handlers: dict[int, Handler] = {}
+        self._user_chats: dict[int, set[int]] = {}
+        self._chat_members: dict[int, set[int]] = {}
+        self._chat_handlers: dict[int, Handler] = {}
+        # Фоновые обновления подписок: цикл событий держит задачи только по слабой ссылке
+        self._tasks: set[asyncio.Task] = set()
+
+    def connections_for(self, user_id: int) -> tuple[Connection, ...]:
+        return tuple(self._connections.get(user_id, ()))
+
+    def user_ids(self) -> tuple[int, ...]:
+        return tuple(self._connections)
+
+    def chats_for(self, user_id: int) -> tuple[int, ...]:
+        return tuple(self._user_chats.get(user_id, ()))
+
+    @property
+    def user_count(self) -> int:
+        return len(self._connections)
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self._connections.values())
+
+    async def add(self, connection: Connection, chat_ids: Iterable[int] = ()) -> bool:
+        """Зарегистрировать соединение. True, если это первое соединение пользователя в процессе.
+
+        Если подписаться не удалось, соединение снимается с учета, иначе
+        следующее подключение пользователя осталось бы без подписок.
+        """
+        user_id = connection.user_id
+        metrics.ws_connections.inc()
+        connections = self._connections.get(user_id)
+        if connections is not None:
+            connections.add(connection)
+            return False
+
+        metrics.ws_connected_users.inc()
+        self._connections[user_id] = {connection}
+        self._user_chats[user_id] = set()
+        handler = self._user_fanout(user_id)
+        self._handlers[user_id] = handler
+        try:
+            await self._hub.subscribe(user_channel(user_id), handler)
+            for chat_id in chat_ids:
+                await self.join_chat(user_id, chat_id)
+        except BaseException:
+            await self.remove(connection)
+            raise
+        return True
+
+    async def remove(self, connection: Connection) -> bool:
+        """Снять соединение с учёта. True, если у пользователя не осталось соединений"""
+        user_id = connection.user_id
+        connections = self._connections.get(user_id)
+        if connections is None or connection not in connections:
+            return False
+        connections.discard(connection)
+        metrics.ws_connections.dec()
+        if connections:
+            return False
+
+        metrics.ws_connected_users.dec()
+        # Состояние пользователя чистится целиком до первого await: переподключение
+        # во время отписки начинает с чистого листа и его подписки не затираются
+        del self._connections[user_id]
+        handler = self._handlers.pop(user_id)
+        released = [
+            (chat_id, self._release_chat_member(chat_id, user_id))
+            for chat_id in self._user_chats.pop(user_id, set())
+        ]
+        await self._hub.unsubscribe(user_channel(user_id), handler)
+        for chat_id, chat_handler in released:
+            if chat_handler is not None:
+                await self._hub.unsubscribe(chat_channel(chat_id), chat_handler)
+        return True
+
+    async def join_chat(self, user_id: int, chat_id: int) -> None:
+        """Начать доставлять пользователю события чата (если он подключен к процессу)"""
+        chats = self._user_chats.get(user_id)
+        if chats is None or chat_id in chats:
+            return
+        chats.add(chat_id)
+
+        members = self._chat_members.get(chat_id)
+        if members is not None:
+            members.add(user_id)
+            return
+        self._chat_members[chat_id] = {user_id}
+        handler = self._chat_fanout(chat_id)
+        self._chat_handlers[chat_id] = handler
+        try:
+            await self._hub.subscribe(chat_channel(chat_id), handler)
+        except BaseException:
+            chats.discard(chat_id)
+            self._release_chat_member(chat_id, user_id)
+            raise
+
+    async def leave_chat(self, user_id: int, chat_id: int) -> None:
+        """Перестать доставлять пользователю события чата"""
+        chats = self._user_chats.get(user_id)
+        if chats is None or chat_id not in chats:
+            return
+        chats.discard(chat_id)
+        handler = self._release_chat_member(chat_id, user_id)
+        if handler is not None:
+            await self._hub.unsubscribe(chat_channel(chat_id), handler)
+
+    def _release_chat_member(self, chat_id: int, user_id: int) -> Handler | None:
+        """Убрать пользователя из получателей чата. Обработчик чата, если получателей не осталось"""
+        members = self._chat_members.get(chat_id)
+        if members is None:
+            return None
+        members.discard(user_id)
+        if members:
+            return None
+        del self._chat_members[chat_id]
+        return self._chat_handlers.pop(chat_id)
+
+    async def _drop_chat(self, chat_id: int) -> None:
+        for user_id in tuple(self._chat_members.get(chat_id, ())):
+            await self.leave_chat(user_id, chat_id)
+
+    def _spawn(self, coro) -> None:
+        """Запустить обновление подписок в фоне, сохранив ссылку на задачу"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Chat subscription update failed", exc_info=task.exception())
+
+    def _deliver_to_user(self, user_id: int, event: Event) -> None:
+        for connection in self.connections_for(user_id):
+            connection.deliver(event)
+
+    def _user_fanout(self, user_id: int) -> Handler:
+        def deliver(event: Event) -> None:
+            self._deliver_to_user(user_id, event)
+            # Изменения состава чатов приходят в персональный канал пользователя
+            if event.name == "chat.joined":
+                self._spawn(self.join_chat(user_id, event.data["chat_id"]))
+            elif event.name == "chat.left":
+                self._spawn(self.leave_chat(user_id, event.data["chat_id"]))
+
+        return deliver
+
+    def _chat_fanout(self, chat_id: int) -> Handler:
+        def deliver(event: Event) -> None:
+            for user_id in tuple(self._chat_members.get(chat_id, ())):
+                self._deliver_to_user(user_id, event)
+            if event.name == "chat.deleted":
+                self._spawn(self._drop_chat(chat_id))
+
+        return deliver
+
+
+hub = PubSubHub(settings.redis_url)
+registry = ConnectionRegistry(hub)
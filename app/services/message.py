@@ -1,17 +1,21 @@
 from __future__ import annotations
 
-import json
 import logging
 
 from redis.asyncio import Redis
+from sqlalchemy import inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from app.core.config import settings
 from app.domain.models import Message, MessageReaction
 from app.repositories.chat import ChatMemberRepository
 from app.repositories.message import MessageRepository
 from app.repositories.message_read import MessageReadRepository
 from app.repositories.message_reaction import MessageReactionRepository
+from app.schemas.message import MessageRead
+from app.services.events import EventPublisher
+from app.services.message_cache import MessageCache, build_page, serialize
 
 VOICE_REQUIRED_KEYS = {"attachment_id", "duration_ms", "codec"}
 
@@ -26,6 +30,8 @@ class MessageService:
         self.chat_members = ChatMemberRepository(session)
         self.message_reads = MessageReadRepository(session)
         self.reactions = MessageReactionRepository(session)
+        self.events = EventPublisher(redis)
+        self.cache = MessageCache(redis)
 
     async def create_message(
         self,
@@ -57,21 +63,54 @@ class MessageService:
         await self.session.commit()
         # Явная загрузка reactions для избежания ошибки MissingGreenlet при сериализации
         await self.session.refresh(message, ["reactions"])
+        await self._cache_message(message)
         await self._publish_event("message.created", message)
         return message
 
+    async def list_recent_page(self, chat_id: int, limit: int) -> tuple[list[MessageRead], bool]:
+        """Первая страница истории (новые первыми) и has_more.
+
+        Отдается из кэша последних сообщений без Postgres; при промахе окно
+        заполняется одним запросом, из него же собирается страница.
+        """
+        try:
+            page = await self.cache.get_page(chat_id, limit)
+        except Exception:
+            logger.exception(f"Failed to read message cache for chat {chat_id}")
+            page = None
+        if page is not None:
+            return page
+
+        size = settings.message_cache_size
+        if limit <= size:
+            recent, version = await self.messages.list_recent(chat_id, size)
+            has_more = len(recent) > size
+            window = recent[:size]
+            try:
+                await self.cache.fill(chat_id, window, version, has_more)
+            except Exception:
+                logger.exception(f"Failed to fill message cache for chat {chat_id}")
+            page = build_page([serialize(message) for message in window], has_more, limit)
+            if page is not None:
+                return page
+
+        messages = await self.messages.list_for_chat(chat_id, limit=limit)
+        return [MessageRead.model_validate(m) for m in messages[:limit]], len(messages) > limit
+
     async def update_message(self, message: Message, *, content: str | None, payload: dict | None) -> Message:
         if message.is_deleted:
             raise ValueError("Cannot update deleted message")
         
         if payload is not None:
             self._validate_payload(message.type, payload)
+        message.version = await self.messages.reserve_versions(message.chat_id)
         if content is not None:
             message.content = content
         if payload is not None:
             message.payload = payload
         await self.session.commit()
         await self.session.refresh(message)
+        await self._cache_message(message)
         await self._publish_event("message.updated", message)
         return message
 
@@ -83,6 +122,7 @@ class MessageService:
         message = await self.messages.soft_delete(message)
         await self.session.commit()
         await self.session.refresh(message)
+        await self._cache_message(message)
         await self._publish_event("message.deleted", message)
         return message
 
@@ -95,17 +135,22 @@ class MessageService:
         if existing:
             raise ValueError("Reaction already exists")
         
+        # Получаем сообщение для определения участников чата
+        message = await self.messages.get(message_id)
+        if message is None:
+            raise ValueError("Message not found")
+        
+        # Реакции меняют версию сообщения для дельта-синхронизации
+        await self.messages.touch(message)
         reaction = await self.reactions.add_reaction(
             message_id=message_id, user_id=user_id, emoji=emoji
         )
         await self.session.commit()
         await self.session.refresh(reaction)
+        await self.session.refresh(message, ["version", "reactions"])
+        await self._cache_message(message)
         
-        # Получаем сообщение для определения участников чата
-        message = await self.messages.get(message_id)
-        if message:
-            await self._publish_reaction_event("reaction.added", message.chat_id, reaction)
-        
+        await self._publish_reaction_event("reaction.added", message.chat_id, reaction)
         return reaction
 
     async def remove_reaction(self, message_id: int, user_id: int, emoji: str) -> bool:
@@ -115,17 +160,23 @@ class MessageService:
         if not message:
             return False
         
+        # Версия резервируется до удаления; без реакции транзакция не коммитится
+        await self.messages.touch(message)
         success = await self.reactions.remove_reaction(
             message_id=message_id, user_id=user_id, emoji=emoji
         )
         
         if success:
             await self.session.commit()
+            await self.session.refresh(message, ["version", "reactions"])
+            await self._cache_message(message)
             await self._publish_reaction_event(
                 "reaction.removed",
                 message.chat_id,
                 {"message_id": message_id, "user_id": user_id, "emoji": emoji},
             )
+        else:
+            await self.session.rollback()
         
         return success
 
@@ -135,196 +186,134 @@ class MessageService:
                 missing = VOICE_REQUIRED_KEYS.difference(payload.keys() if payload else set())
                 raise ValueError(f"Voice message payload missing keys: {', '.join(sorted(missing))}")
 
+    async def _cache_message(self, message: Message) -> None:
+        """Записать изменение в кэш последних сообщений чата.
+
+        Ошибка кэша не ломает запрос: окно догонит следующая запись
+        или истечет по message_cache_ttl_seconds.
+        """
+        try:
+            if "reactions" in inspect(message).unloaded:
+                await self.session.refresh(message, ["reactions"])
+            await self.cache.store(message)
+        except Exception:
+            logger.exception(f"Failed to update message cache for message {message.id}")
+
     async def _publish_event(self, event: str, message: Message) -> None:
-        """Отправить WebSocket событие всем участникам чата"""
-        # Получаем всех участников чата
-        participant_ids = await self.chat_members.list_participant_ids(message.chat_id)
-        
-        # Формируем payload события
-        payload = {
-            "event": event,
-            "data": {
-                "id": message.id,
-                "chat_id": message.chat_id,
-                "author_id": message.author_id,
-                "type": message.type,
-                "content": message.content,
-                "payload": message.payload,
-                "status": message.status,
-                "ts": message.ts.isoformat(),
-                "reply_to_id": message.reply_to_id,
-                "is_deleted": message.is_deleted,
-                "deleted_at": message.deleted_at.isoformat() if message.deleted_at else None,
-                "updated_at": message.updated_at.isoformat() if message.updated_at else None,
-            },
+        """Отправить WebSocket событие всем участникам чата (одна публикация в канал чата)"""
+        data = {
+            "id": message.id,
+            "chat_id": message.chat_id,
+            "seq": message.seq,
+            "author_id": message.author_id,
+            "type": message.type,
+            "content": message.content,
+            "payload": message.payload,
+            "status": message.status,
+            "ts": message.ts.isoformat(),
+            "reply_to_id": message.reply_to_id,
+            "is_deleted": message.is_deleted,
+            "deleted_at": message.deleted_at.isoformat() if message.deleted_at else None,
+            "updated_at": message.updated_at.isoformat() if message.updated_at else None,
+            "version": message.version,
         }
-        payload_json = json.dumps(payload)
-        
-        # Отправляем событие в персональный канал каждого участника
-        for user_id in participant_ids:
-            channel = f"ws:user:{user_id}"
-            await self.redis.publish(channel, payload_json)
-            logger.debug(f"Published {event} to user {user_id} for message {message.id}")
-        
-        logger.info(f"Broadcast {event} to {len(participant_ids)} participants in chat {message.chat_id}")
+        await self.events.publish_to_chat(message.chat_id, event, data)
+        logger.info(f"Broadcast {event} to chat {message.chat_id} for message {message.id}")
 
     async def _publish_reaction_event(self, event: str, chat_id: int, data) -> None:
         """Отправить WebSocket событие о реакции всем участникам чата"""
-        participant_ids = await self.chat_members.list_participant_ids(chat_id)
-        
-        # Формируем payload для реакции
         if isinstance(data, MessageReaction):
-            payload = {
-                "event": event,
-                "data": {
-                    "id": data.id,
-                    "message_id": data.message_id,
-                    "user_id": data.user_id,
-                    "emoji": data.emoji,
-                    "created_at": data.created_at.isoformat(),
-                },
+            data = {
+                "id": data.id,
+                "message_id": data.message_id,
+                "user_id": data.user_id,
+                "emoji": data.emoji,
+                "created_at": data.created_at.isoformat(),
             }
-        else:
-            payload = {"event": event, "data": data}
         
-        payload_json = json.dumps(payload)
-        
-        for user_id in participant_ids:
-            channel = f"ws:user:{user_id}"
-            await self.redis.publish(channel, payload_json)
-            logger.debug(f"Published {event} to user {user_id}")
-        
-        logger.info(f"Broadcast {event} to {len(participant_ids)} participants in chat {chat_id}")
+        await self.events.publish_to_chat(chat_id, event, data)
+        logger.info(f"Broadcast {event} to chat {chat_id}")
 
     async def mark_messages_as_read(self, chat_id: int, user_id: int) -> list[int]:
         """
         Отметить все непрочитанные сообщения в чате как прочитанные для пользователя.
         Возвращает список ID прочитанных сообщений.
+
+        Прочтение - сдвиг отметки участника на последнее сообщение чата вместе
+        с увеличением read_count, статусы "read" выставляются одним UPDATE:
+        число запросов не зависит от числа непрочитанных.
         """
-        logger.info(f"\n========== MARK AS READ START ==========")
-        logger.info(f"Chat ID: {chat_id}, User ID: {user_id}")
-        
-        # Получаем ID всех непрочитанных сообщений
-        unread_message_ids = await self.message_reads.get_unread_message_ids(chat_id, user_id)
-        
-        logger.info(f"Unread messages found: {len(unread_message_ids)} - IDs: {unread_message_ids}")
-        
-        if not unread_message_ids:
-            logger.info(f"No unread messages, exiting")
-            logger.info(f"========== MARK AS READ END ==========\n")
+        # read_count меняет строки messages раньше, чем резервируются версии статусов
+        await self.messages.lock_versions(chat_id)
+        marked = await self.message_reads.mark_chat_as_read(chat_id, user_id)
+        if marked is None:
             return []
-        
-        # Отмечаем каждое сообщение как прочитанное в таблице message_reads
-        for message_id in unread_message_ids:
-            await self.message_reads.mark_as_read(message_id, user_id)
-        
-        # Обновляем статус сообщений на "read" в таблице messages
-        # Если ВСЕ участники чата прочитали сообщение
-        from app.domain.models import Message
-        from sqlalchemy import select, update
-        
-        # Получаем количество участников чата
-        participant_ids = await self.chat_members.list_participant_ids(chat_id)
-        total_participants = len(participant_ids)
-        
-        # Список сообщений, у которых изменился статус на "read"
-        updated_messages = []
-        
-        # Для каждого сообщения проверяем, прочитали ли его все участники (кроме автора)
-        for message_id in unread_message_ids:
-            message = await self.messages.get(message_id)
-            if not message:
-                logger.warning(f"Message {message_id} not found, skipping")
-                continue
-            
-            logger.info(f"Checking message {message_id}:")
-            logger.info(f"  Current status: {message.status}")
-            logger.info(f"  Author ID: {message.author_id}")
-            
-            # Считаем количество прочтений
-            from app.domain.models import MessageRead
-            stmt = select(MessageRead).where(MessageRead.message_id == message_id)
-            result = await self.session.scalars(stmt)
-            read_count = len(list(result))
-            
-            # Если все прочитали (участники минус автор = read_count)
-            expected_reads = total_participants - 1 if message.author_id in participant_ids else total_participants
-            
-            logger.info(f"  Read count: {read_count}/{expected_reads}")
-            
-            if read_count >= expected_reads:
-                old_status = message.status
-                message.status = "read"
-                updated_messages.append(message)
-                logger.info(f"  ✅ Status changed: {old_status} -> read")
-            else:
-                logger.info(f"  ⏳ Not all participants read yet, keeping status: {message.status}")
-        
+        last_read_id, read_message_ids = marked
+
+        # Статус "read" получают сообщения, которые прочитали все участники, кроме автора
+        updated_messages = await self.messages.mark_read_by_all(chat_id, read_message_ids)
         await self.session.commit()
-        
-        # Обновляем сообщения после коммита
-        for message in updated_messages:
-            await self.session.refresh(message)
-        
+        if updated_messages:
+            # Сменилось сразу много сообщений: окно кэша проще собрать заново.
+            # Рост одного read_count окно не сбрасывает, там он может отставать
+            try:
+                await self.cache.invalidate(chat_id, max(m.version for m in updated_messages))
+            except Exception:
+                logger.exception(f"Failed to invalidate message cache for chat {chat_id}")
+
         # Отправляем WebSocket событие всем участникам чата с обновленными сообщениями
-        await self._publish_read_event(chat_id, unread_message_ids, updated_messages)
-        
-        logger.info(f"Marked {len(unread_message_ids)} messages as read in chat {chat_id} for user {user_id}, {len(updated_messages)} changed to 'read'")
-        return unread_message_ids
+        await self._publish_read_event(chat_id, user_id, last_read_id, read_message_ids, updated_messages)
+
+        logger.info(
+            f"Marked {len(read_message_ids)} messages as read in chat {chat_id} for user {user_id}, "
+            f"{len(updated_messages)} changed to 'read'"
+        )
+        return read_message_ids
 
-    async def _publish_read_event(self, chat_id: int, message_ids: list[int], updated_messages: list) -> None:
+    async def _publish_read_event(
+        self,
+        chat_id: int,
+        user_id: int,
+        last_read_message_id: int,
+        message_ids: list[int],
+        updated_messages: list,
+    ) -> None:
         """Отправить WebSocket событие о прочитанных сообщениях всем участникам чата"""
-        logger.info(f"\n========== WEBSOCKET PUBLISH START ==========")
-        logger.info(f"Chat ID: {chat_id}")
-        logger.info(f"Message IDs: {message_ids}")
-        logger.info(f"Updated messages (status changed to 'read'): {len(updated_messages)}")
-        
-        # Получаем всех участников чата
-        participant_ids = await self.chat_members.list_participant_ids(chat_id)
-        logger.info(f"Participants: {participant_ids}")
-        
-        # Отправляем событие message.updated для каждого сообщения с обновленным статусом
-        for message in updated_messages:
-            logger.info(f"\nSending message.updated for message {message.id}:")
-            logger.info(f"  Status: {message.status}")
-            logger.info(f"  Content: {message.content[:30] if message.content else 'None'}...")
-            
-            payload = {
-                "event": "message.updated",
-                "data": {
+        # message.updated для каждого сообщения с обновленным статусом
+        events = [
+            (
+                "message.updated",
+                {
                     "id": message.id,
                     "chat_id": message.chat_id,
+                    "seq": message.seq,
                     "author_id": message.author_id,
                     "type": message.type,
                     "content": message.content,
                     "payload": message.payload,
                     "status": message.status,
+                    "read_count": message.read_count,
+                    "version": message.version,
                     "ts": message.ts.isoformat(),
                 },
-            }
-            payload_json = json.dumps(payload)
-            
-            # Отправляем всем участникам
-            for user_id in participant_ids:
-                channel = f"ws:user:{user_id}"
-                await self.redis.publish(channel, payload_json)
-                logger.info(f"  ✅ Published to user {user_id} on channel {channel}")
-        
+            )
+            for message in updated_messages
+        ]
         # Также отправляем обобщенное событие message.read для совместимости
-        logger.info(f"\nSending message.read event:")
-        payload = {
-            "event": "message.read",
-            "data": {
-                "chat_id": chat_id,
-                "message_ids": message_ids,
-            },
-        }
-        payload_json = json.dumps(payload)
-        
-        for user_id in participant_ids:
-            channel = f"ws:user:{user_id}"
-            await self.redis.publish(channel, payload_json)
-            logger.info(f"  ✅ Published to user {user_id}")
+        events.append(
+            (
+                "message.read",
+                {
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "last_read_message_id": last_read_message_id,
+                    "message_ids": message_ids,
+                },
+            )
+        )
         
-        logger.info(f"\n✅ TOTAL: Sent {len(updated_messages)} message.updated + 1 message.read to {len(participant_ids)} participants")
-        logger.info(f"========== WEBSOCKET PUBLISH END ==========\n")
+        # Все события уходят в канал чата одним pipeline
+        await self.events.publish_many_to_chat(chat_id, events)
+        logger.info(
+            f"Broadcast {len(updated_messages)} message.updated + 1 message.read to chat {chat_id}"
+        )
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import json
+from collections.abc import Sequence
+
+from redis.asyncio import Redis
+
+from app.core.config import settings
+from app.domain.models import Message
+from app.schemas.message import MessageRead
+
+# Служебные поля окна; остальные поля - seq сообщений
+_META_FIELDS = ("version", "has_more", "filled")
+
+# Заполнить окно снимком из БД. Снимок отбрасывается, если запись версии
+# новее его уже прошла через кэш (иначе он затер бы ее старыми данными)
+_FILL_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+if current > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'has_more', ARGV[2], 'filled', '1')
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+# Записать состояние сообщения (write-through). Версия запоминается даже без
+# окна, чтобы не дать заполнить его снимком старше этой записи
+_STORE_SCRIPT = """
+local version = tonumber(ARGV[1])
+if version > tonumber(redis.call('HGET', KEYS[1], 'version') or '0') then
+    redis.call('HSET', KEYS[1], 'version', ARGV[1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+if redis.call('HGET', KEYS[1], 'filled') ~= '1' then
+    return 0
+end
+local stored = redis.call('HGET', KEYS[1], ARGV[2])
+if stored then
+    if cjson.decode(stored)['version'] >= version then
+        return 0
+    end
+else
+    local seq = tonumber(ARGV[2])
+    local size = 0
+    local oldest
+    for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+        local field_seq = tonumber(field)
+        if field_seq then
+            size = size + 1
+            if oldest == nil or field_seq < oldest then
+                oldest = field_seq
+            end
+        end
+    end
+    -- Сообщение старше окна: окно его не хранит
+    if oldest ~= nil and size >= tonumber(ARGV[4]) and seq < oldest then
+        return 0
+    end
+    if oldest ~= nil and size >= tonumber(ARGV[4]) then
+        redis.call('HDEL', KEYS[1], tostring(oldest))
+        redis.call('HSET', KEYS[1], 'has_more', '1')
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+# Сбросить окно, сохранив версию (после массовых изменений вроде статуса "read")
+_INVALIDATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'version') or '0'
+if tonumber(ARGV[1]) > tonumber(current) then
+    current = ARGV[1]
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], 'version', current)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def cache_key(chat_id: int) -> str:
+    return f"messages:recent:{chat_id}"
+
+
+def serialize(message: Message) -> dict:
+    return MessageRead.model_validate(message).model_dump(mode="json")
+
+
+def build_page(entries: list[dict], has_more: bool, limit: int) -> tuple[list[MessageRead], bool] | None:
+    """Первая страница (новые первыми) и has_more из окна, или None, если окна не хватает"""
+    visible = [entry for entry in entries if not entry["is_deleted"]]
+    if len(visible) < limit and has_more:
+        # Удаления съели окно: страницу соберет БД
+        return None
+    visible.sort(key=lambda entry: (entry["ts"], entry["id"]), reverse=True)
+    page = [MessageRead.model_validate(entry) for entry in visible[:limit]]
+    return page, has_more or len(visible) > limit
+
+
+class MessageCache:
+    """Окно последних message_cache_size сообщений чата в Redis (HASH).
+
+    Поля окна - seq сообщений со значением MessageRead в JSON (удаленные
+    тоже хранятся, чтобы запоздавшая запись не вернула сообщение), плюс
+    version - последняя версия чата, прошедшая через кэш, has_more - есть ли
+    сообщения старше окна, filled - окно заполнено из БД.
+
+    MessageService пишет в окно каждое изменение (write-through); запись
+    со старой версией сообщения отбрасывается, так что порядок доставки
+    записей не важен.
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._fill = redis.register_script(_FILL_SCRIPT)
+        self._store = redis.register_script(_STORE_SCRIPT)
+        self._invalidate = redis.register_script(_INVALIDATE_SCRIPT)
+
+    async def get_page(self, chat_id: int, limit: int) -> tuple[list[MessageRead], bool] | None:
+        """Первая страница истории (новые первыми) и has_more, или None, если окна не хватает"""
+        if limit > settings.message_cache_size:
+            return None
+        window = await self.redis.hgetall(cache_key(chat_id))
+        if window.get("filled") != "1":
+            return None
+        entries = [json.loads(value) for field, value in window.items() if field not in _META_FIELDS]
+        return build_page(entries, window.get("has_more") == "1", limit)
+
+    async def fill(self, chat_id: int, messages: Sequence[Message], version: int, has_more: bool) -> bool:
+        """Заполнить окно снимком из БД, прочитанным при версии чата version"""
+        args: list[object] = [version, int(has_more), settings.message_cache_ttl_seconds]
+        for message in messages:
+            args.extend((message.seq, json.dumps(serialize(message))))
+        filled = await self._fill(keys=[cache_key(chat_id)], args=args)
+        return bool(filled)
+
+    async def store(self, message: Message) -> None:
+        """Записать новое состояние сообщения (реакции должны быть загружены)"""
+        await self._store(
+            keys=[cache_key(message.chat_id)],
+            args=[
+                message.version,
+                message.seq,
+                json.dumps(serialize(message)),
+                settings.message_cache_size,
+                settings.message_cache_ttl_seconds,
+            ],
+        )
+
+    async def invalidate(self, chat_id: int, version: int) -> None:
+        await self._invalidate(keys=[cache_key(chat_id)], args=[version, settings.message_cache_ttl_seconds])
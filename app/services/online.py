@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import logging
+import os
+import secrets
+import socket
+import time
+from collections.abc import Iterable
+
+from redis.asyncio import Redis
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+ONLINE_USERS_KEY = "online:users"
+ONLINE_NODES_KEY = "online:nodes"
+
+# Идентификатор процесса-шлюза; случайный суффикс отличает перезапуск с тем же pid
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+# Пользователь появился на узле. 1, если он стал онлайн глобально (первый узел).
+# online:nodes ведет только heartbeat: иначе подключение к снятому узлу
+# скрыло бы от heartbeat, что узел сняли, и его пользователи остались бы офлайн
+_ADD_SCRIPT = """
+if redis.call('SADD', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('HINCRBY', KEYS[2], ARGV[1], 1) == 1 then
+    return 1
+end
+return 0
+"""
+
+# Пользователь ушел с узла. 1, если он стал офлайн глобально (последний узел)
+_REMOVE_SCRIPT = """
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('HINCRBY', KEYS[2], ARGV[1], -1) <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Снять узел целиком (остановка или падение). Возвращает ушедших в офлайн
+_DROP_NODE_SCRIPT = """
+local offline = {}
+for _, user in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if redis.call('HINCRBY', KEYS[2], user, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], user)
+        table.insert(offline, user)
+    end
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return offline
+"""
+
+
+def node_key(node_id: str) -> str:
+    return f"online:node:{node_id}"
+
+
+class OnlineIndex:
+    """Индекс онлайн-пользователей, который ведут шлюзы.
+
+    online:node:{node} - пользователи с соединениями на узле (SET),
+    online:users - на скольких узлах пользователь подключен (HASH),
+    online:nodes - время последнего heartbeat узлов (ZSET).
+
+    Узел, переставший присылать heartbeat, считается упавшим: любой живой
+    узел снимает его пользователей (см. reap).
+    """
+
+    def __init__(self, redis: Redis, node_id: str = NODE_ID):
+        self.redis = redis
+        self.node_id = node_id
+        self._add = redis.register_script(_ADD_SCRIPT)
+        self._remove = redis.register_script(_REMOVE_SCRIPT)
+        self._drop_node = redis.register_script(_DROP_NODE_SCRIPT)
+
+    async def add(self, user_id: int) -> bool:
+        """Отметить пользователя на узле. True, если он стал онлайн глобально"""
+        became_online = await self._add(
+            keys=[node_key(self.node_id), ONLINE_USERS_KEY],
+            args=[user_id],
+        )
+        return bool(became_online)
+
+    async def remove(self, user_id: int) -> bool:
+        """Снять пользователя с узла. True, если он стал офлайн глобально"""
+        became_offline = await self._remove(
+            keys=[node_key(self.node_id), ONLINE_USERS_KEY, ONLINE_NODES_KEY],
+            args=[user_id],
+        )
+        return bool(became_offline)
+
+    async def heartbeat(self) -> bool:
+        """Продлить жизнь узла. True, если узел уже успели снять как упавший"""
+        added = await self.redis.zadd(ONLINE_NODES_KEY, {self.node_id: time.time()})
+        return bool(added)
+
+    async def reap(self) -> list[int]:
+        """Снять узлы без heartbeat дольше online_node_ttl_seconds.
+
+        Возвращает пользователей, которые из-за этого стали офлайн.
+        """
+        deadline = time.time() - settings.online_node_ttl_seconds
+        dead_nodes = await self.redis.zrangebyscore(ONLINE_NODES_KEY, "-inf", deadline)
+        offline: list[int] = []
+        for node_id in dead_nodes:
+            if node_id == self.node_id:
+                continue
+            offline.extend(await self.drop_node(node_id))
+            logger.warning(f"Reaped dead gateway node {node_id}")
+        return offline
+
+    async def drop_node(self, node_id: str | None = None) -> list[int]:
+        """Снять узел со всеми пользователями (по умолчанию - свой, при остановке)"""
+        node_id = node_id or self.node_id
+        offline = await self._drop_node(
+            keys=[node_key(node_id), ONLINE_USERS_KEY, ONLINE_NODES_KEY],
+            args=[node_id],
+        )
+        return [int(user_id) for user_id in offline]
+
+    async def is_online(self, user_id: int) -> bool:
+        return bool(await self.redis.hexists(ONLINE_USERS_KEY, user_id))
+
+    async def online_among(self, user_ids: Iterable[int]) -> set[int]:
+        """Кто из пользователей онлайн (один HMGET)"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        counts = await self.redis.hmget(ONLINE_USERS_KEY, user_ids)
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    async def list_online(self) -> list[int]:
+        return [int(user_id) for user_id in await self.redis.hkeys(ONLINE_USERS_KEY)]
+
+    async def count(self) -> int:
+        return await self.redis.hlen(ONLINE_USERS_KEY)
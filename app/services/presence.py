@@ -1,19 +1,57 @@
 from __future__ import annotations
 
-import json
 import logging
-from datetime import datetime, timedelta
+import time
+from collections.abc import Iterable
+from datetime import UTC, datetime
 
 from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.repositories.chat import ChatMemberRepository
+from app.repositories.friend import FriendRepository
+from app.repositories.user import UserRepository
+from app.services.events import EventPublisher
+from app.services.online import ONLINE_USERS_KEY, OnlineIndex
 
 logger = logging.getLogger(__name__)
 
+TYPING_ACTIVE_KEY = "typing:active"
+
+# Текущий ростер чата без истекших индикаторов; пустой чат выбывает из typing:active
+_ROSTER_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local users = redis.call('ZRANGE', KEYS[1], 0, -1)
+if #users == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+end
+return users
+"""
+
+# Heartbeat: last_seen пишется всегда, а статус online из WebSocket продлевается,
+# только пока у пользователя есть соединения. Иначе отложенный сброс буфера
+# вернул бы online пользователю, которого уже объявили офлайн. HTTP heartbeat
+# (ARGV[4] = 1) ставит online и без соединения: клиент может жить без сокета
+_HEARTBEAT_SCRIPT = """
+redis.call('SET', KEYS[3], ARGV[2])
+if ARGV[4] == '1' or redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('SET', KEYS[2], 'online', 'EX', ARGV[3])
+end
+return 1
+"""
+
+# Служебный элемент множества аудитории: отличает пустую аудиторию от промаха кэша
+AUDIENCE_PLACEHOLDER = 0
+
 
 class PresenceService:
     """Сервис для управления онлайн-статусом пользователей"""
 
-    def __init__(self, redis: Redis):
+    def __init__(self, redis: Redis, session: AsyncSession | None = None):
         self.redis = redis
+        self.session = session
+        self._heartbeat = redis.register_script(_HEARTBEAT_SCRIPT)
 
     async def set_user_online(self, user_id: int) -> None:
         """Установить пользователя онлайн"""
@@ -24,132 +62,286 @@ class PresenceService:
     async def set_user_offline(self, user_id: int) -> None:
         """Установить пользователя оффлайн"""
         key = f"presence:user:{user_id}"
+        # Отложенный heartbeat этого воркера не должен пережить уход в офлайн
+        heartbeats.discard(user_id)
         await self.redis.delete(key)
         await self._publish_presence_event(user_id, "offline")
 
     async def heartbeat(self, user_id: int) -> None:
         """Обновить последнюю активность пользователя (heartbeat)"""
-        key = f"presence:user:{user_id}"
-        last_seen_key = f"presence:last_seen:{user_id}"
-        
-        # Обновляем TTL для онлайн статуса
-        await self.redis.setex(key, 300, "online")
-        
-        # Сохраняем время последней активности
-        await self.redis.set(last_seen_key, datetime.utcnow().isoformat())
+        await self.heartbeat_many({user_id: datetime.now(tz=UTC)}, http_user_ids={user_id})
+
+    async def heartbeat_many(self, last_seen: dict[int, datetime], http_user_ids: Iterable[int] = ()) -> None:
+        """Записать пачку heartbeat одним pipeline.
+
+        http_user_ids - пользователи с HTTP heartbeat: им online ставится
+        даже без открытых соединений.
+        """
+        if not last_seen:
+            return
+        http_user_ids = set(http_user_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, seen_at in last_seen.items():
+            # Обновляем TTL для онлайн статуса и время последней активности
+            await self._heartbeat(
+                keys=[ONLINE_USERS_KEY, f"presence:user:{user_id}", f"presence:last_seen:{user_id}"],
+                args=[user_id, seen_at.isoformat(), 300, int(user_id in http_user_ids)],
+                client=pipe,
+            )
+        await pipe.execute()
 
     async def get_user_status(self, user_id: int) -> dict:
         """Получить статус пользователя"""
-        key = f"presence:user:{user_id}"
-        last_seen_key = f"presence:last_seen:{user_id}"
-        
-        status = await self.redis.get(key)
-        last_seen_str = await self.redis.get(last_seen_key)
-        
-        last_seen = None
-        if last_seen_str:
-            if isinstance(last_seen_str, bytes):
-                last_seen_str = last_seen_str.decode("utf-8")
-            last_seen = datetime.fromisoformat(last_seen_str)
-        
-        if status:
-            if isinstance(status, bytes):
-                status = status.decode("utf-8")
-            return {"user_id": user_id, "status": status, "last_seen": last_seen}
-        else:
-            return {"user_id": user_id, "status": "offline", "last_seen": last_seen}
-
-    async def get_multiple_users_status(self, user_ids: list[int]) -> dict[int, dict]:
-        """Получить статусы нескольких пользователей"""
-        result = {}
+        statuses = await self.get_multiple_users_status([user_id])
+        return statuses[user_id]
+
+    async def get_multiple_users_status(self, user_ids: Iterable[int]) -> dict[int, dict]:
+        """Получить статусы нескольких пользователей одним MGET.
+
+        Если last_seen в Redis нет (ключ потерян или еще не записан), берется
+        users.last_seen_at одним запросом - при наличии сессии БД.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        keys = []
         for user_id in user_ids:
-            result[user_id] = await self.get_user_status(user_id)
-        return result
+            keys.append(f"presence:user:{user_id}")
+            keys.append(f"presence:last_seen:{user_id}")
+        values = await self.redis.mget(keys)
+        statuses = values[0::2]
+        last_seen = values[1::2]
+
+        missing = [user_id for user_id, seen_at in zip(user_ids, last_seen) if seen_at is None]
+        if missing and self.session is not None:
+            stored = await UserRepository(self.session).get_last_seen(missing)
+            last_seen = [
+                stored[user_id].isoformat() if seen_at is None and user_id in stored else seen_at
+                for user_id, seen_at in zip(user_ids, last_seen)
+            ]
+        return {
+            user_id: _build_status(user_id, status, seen_at)
+            for user_id, status, seen_at in zip(user_ids, statuses, last_seen)
+        }
+
+    async def get_snapshot(self, user_id: int) -> list[dict]:
+        """Статусы всех контактов пользователя (соучастники чатов и друзья)"""
+        audience = await self.get_audience(user_id)
+        statuses = await self.get_multiple_users_status(sorted(audience))
+        return list(statuses.values())
+
+    async def get_audience(self, user_id: int) -> set[int]:
+        """Пользователи, которым видны изменения статуса: соучастники чатов и друзья.
+
+        Множество кэшируется в Redis (presence:audience:{id}) и сбрасывается при
+        изменении состава чатов и дружбы; TTL страхует от пропущенной инвалидации.
+        """
+        key = f"presence:audience:{user_id}"
+        members = await self.redis.smembers(key)
+        if members:
+            return {int(member) for member in members} - {AUDIENCE_PLACEHOLDER}
+        if self.session is None:
+            logger.warning(f"Presence audience of user {user_id} is not cached and no DB session given")
+            return set()
+
+        co_members = await ChatMemberRepository(self.session).list_co_member_ids(user_id)
+        friends = await FriendRepository(self.session).list_friend_ids(user_id)
+        audience = set(co_members) | set(friends)
+
+        # Заглушка, чтобы пустая аудитория тоже кэшировалась
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.sadd(key, AUDIENCE_PLACEHOLDER, *audience)
+        pipe.expire(key, settings.presence_audience_ttl_seconds)
+        await pipe.execute()
+        return audience
+
+    async def invalidate_audience(self, user_ids: Iterable[int]) -> None:
+        """Сбросить кэш аудитории (изменился состав чатов или дружба)"""
+        keys = [f"presence:audience:{user_id}" for user_id in set(user_ids)]
+        if keys:
+            await self.redis.delete(*keys)
 
     async def _publish_presence_event(self, user_id: int, status: str) -> None:
         """Отправить WebSocket событие об изменении статуса
         
-        Публикуем событие напрямую в персональные каналы всех активных пользователей,
-        так как мы не знаем, кто именно должен получить это обновление
+        Событие получают только пользователи, которые видят статус (соучастники
+        чатов и друзья), и сам пользователь для остальных своих устройств
         """
         last_seen = await self.redis.get(f"presence:last_seen:{user_id}")
         if isinstance(last_seen, bytes):
             last_seen = last_seen.decode("utf-8")
         
-        payload = {
-            "event": "user:presence",
-            "data": {
-                "user_id": user_id,
-                "status": status,
-                "last_seen": last_seen,
-            },
-        }
-        payload_json = json.dumps(payload)
-        
-        # Публикуем в общий канал для всех активных WebSocket соединений
-        # Каждое соединение имеет свой канал ws:user:{user_id}
-        # Найдем всех активных пользователей и отправим им обновление
-        pattern = "ws:user:*"
-        async for key in self.redis.scan_iter(match=pattern, count=100):
-            if isinstance(key, bytes):
-                key = key.decode("utf-8")
-            # Публикуем в персональный канал каждого активного пользователя
-            await self.redis.publish(key, payload_json)
-        
-        logger.debug(f"Published presence update for user {user_id}: {status}")
+        audience = await self.get_audience(user_id)
+        audience.add(user_id)
+        # Публикуем только тем, у кого есть открытые соединения
+        audience = await OnlineIndex(self.redis).online_among(audience)
+        await EventPublisher(self.redis).publish_ephemeral_to_users(
+            audience,
+            "user:presence",
+            {"user_id": user_id, "status": status, "last_seen": last_seen},
+        )
+        logger.debug(f"Published presence update for user {user_id} to {len(audience)} users: {status}")
+
+
+class HeartbeatBuffer:
+    """Буфер heartbeat воркера (write-behind).
+
+    Пинги клиентов только запоминаются в памяти; в Redis они уходят пачкой
+    раз в presence_flush_seconds, а last_seen в Postgres - раз в
+    presence_persist_seconds. Повторные пинги одного пользователя между
+    сбросами схлопываются в один.
+    """
+
+    def __init__(self):
+        self._redis_pending: dict[int, datetime] = {}
+        self._http_pending: set[int] = set()
+        self._db_pending: dict[int, datetime] = {}
+
+    def __len__(self) -> int:
+        return len(self._redis_pending)
+
+    def record(self, user_id: int, http: bool = False) -> None:
+        """Запомнить heartbeat. http - пинг POST /presence/heartbeat, он ставит online и без сокета"""
+        self._redis_pending[user_id] = datetime.now(tz=UTC)
+        if http:
+            self._http_pending.add(user_id)
+
+    def discard(self, user_id: int) -> None:
+        """Забыть несброшенный heartbeat (пользователь ушел в офлайн)"""
+        self._redis_pending.pop(user_id, None)
+        self._http_pending.discard(user_id)
+
+    async def flush_redis(self, redis: Redis) -> int:
+        """Записать накопленные heartbeat в Redis. Возвращает число пользователей"""
+        pending, self._redis_pending = self._redis_pending, {}
+        http_pending, self._http_pending = self._http_pending, set()
+        if not pending:
+            return 0
+        try:
+            await PresenceService(redis).heartbeat_many(pending, http_pending)
+        except Exception:
+            # Вернем в буфер, более свежие отметки важнее
+            self._redis_pending = {**pending, **self._redis_pending}
+            self._http_pending |= http_pending
+            raise
+        self._db_pending.update(pending)
+        return len(pending)
+
+    async def flush_db(self, session: AsyncSession) -> int:
+        """Сохранить last_seen в Postgres одним UPDATE. Возвращает число пользователей"""
+        pending, self._db_pending = self._db_pending, {}
+        if not pending:
+            return 0
+        try:
+            await UserRepository(session).update_last_seen(pending)
+            await session.commit()
+        except Exception:
+            self._db_pending = {**pending, **self._db_pending}
+            raise
+        return len(pending)
+
+
+heartbeats = HeartbeatBuffer()
+
+
+def _build_status(user_id: int, status: str | bytes | None, last_seen: str | bytes | None) -> dict:
+    if isinstance(status, bytes):
+        status = status.decode("utf-8")
+    if isinstance(last_seen, bytes):
+        last_seen = last_seen.decode("utf-8")
+    return {
+        "user_id": user_id,
+        "status": status or "offline",
+        "last_seen": datetime.fromisoformat(last_seen) if last_seen else None,
+    }
 
 
 class TypingService:
-    """Сервис для управления typing indicators"""
+    """Сервис для управления typing indicators
+
+    Состояние чата - один ZSET typing:chat:{id}: участник - user_id, score -
+    момент, когда индикатор истекает. Истекшие записи вычищаются при чтении.
+
+    Публикуются только переходы (начал / перестал печатать): повторные
+    start_typing в пределах typing_ttl_seconds лишь продлевают индикатор.
+    Чаты, где кто-то печатает, периодически получают одно сводное событие
+    typing.roster со всеми печатающими (см. publish_rosters).
+    """
 
     def __init__(self, redis: Redis):
         self.redis = redis
+        self._roster = redis.register_script(_ROSTER_SCRIPT)
 
-    async def start_typing(self, chat_id: int, user_id: int) -> None:
-        """Пользователь начал печатать"""
-        key = f"typing:chat:{chat_id}:user:{user_id}"
-        await self.redis.setex(key, 10, "typing")  # 10 секунд TTL
+    async def start_typing(self, chat_id: int, user_id: int) -> bool:
+        """Пользователь начал печатать. True, если событие было опубликовано"""
+        key = typing_key(chat_id)
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zadd(key, {user_id: now + settings.typing_ttl_seconds})
+        # Ключ живет не дольше самого свежего индикатора
+        pipe.expire(key, settings.typing_ttl_seconds)
+        pipe.sadd(TYPING_ACTIVE_KEY, chat_id)
+        _, added, _, _ = await pipe.execute()
+        if not added:
+            return False
         await self._publish_typing_event(chat_id, user_id, True)
+        return True
 
-    async def stop_typing(self, chat_id: int, user_id: int) -> None:
-        """Пользователь перестал печатать"""
-        key = f"typing:chat:{chat_id}:user:{user_id}"
-        await self.redis.delete(key)
+    async def stop_typing(self, chat_id: int, user_id: int) -> bool:
+        """Пользователь перестал печатать. True, если событие было опубликовано"""
+        if not await self.redis.zrem(typing_key(chat_id), user_id):
+            return False
         await self._publish_typing_event(chat_id, user_id, False)
+        return True
 
     async def get_typing_users(self, chat_id: int) -> list[int]:
         """Получить список пользователей, которые сейчас печатают в чате"""
-        pattern = f"typing:chat:{chat_id}:user:*"
-        keys = []
-        async for key in self.redis.scan_iter(match=pattern):
-            if isinstance(key, bytes):
-                key = key.decode("utf-8")
-            # Извлекаем user_id из ключа
-            user_id = int(key.split(":")[-1])
-            keys.append(user_id)
-        return keys
+        key = typing_key(chat_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(key, "-inf", time.time())
+        pipe.zrange(key, 0, -1)
+        _, user_ids = await pipe.execute()
+        return [int(user_id) for user_id in user_ids]
+
+    async def publish_rosters(self) -> int:
+        """Разослать typing.roster во все чаты, где кто-то печатает.
+
+        Чат, в котором никто больше не печатает, получает последний пустой
+        ростер и выбывает из typing:active. Возвращает число событий.
+        """
+        chat_ids = [int(chat_id) for chat_id in await self.redis.smembers(TYPING_ACTIVE_KEY)]
+        if not chat_ids:
+            return 0
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for chat_id in chat_ids:
+            await self._roster(keys=[typing_key(chat_id), TYPING_ACTIVE_KEY], args=[now, chat_id], client=pipe)
+        rosters = await pipe.execute()
+
+        await EventPublisher(self.redis).publish_ephemeral_to_chats(
+            "typing.roster",
+            {
+                chat_id: {"chatId": chat_id, "userIds": [int(user_id) for user_id in user_ids]}
+                for chat_id, user_ids in zip(chat_ids, rosters)
+            },
+        )
+        return len(chat_ids)
 
     async def _publish_typing_event(self, chat_id: int, user_id: int, is_typing: bool) -> None:
         """Отправить WebSocket событие о наборе текста
         
-        Публикуем событие в персональные каналы всех активных участников чата
+        Событие идет в канал чата: шлюзы доставляют его только участникам
         """
-        payload = {
-            "event": "typing",
-            "data": {
-                "chatId": chat_id,
-                "userId": user_id,
-                "isTyping": is_typing,
-            },
-        }
-        payload_json = json.dumps(payload)
-        
-        # Получаем список участников из Redis кэша или публикуем всем активным пользователям
-        # Для простоты публикуем всем активным - фронтенд сам отфильтрует по chatId
-        pattern = "ws:user:*"
-        async for key in self.redis.scan_iter(match=pattern, count=100):
-            if isinstance(key, bytes):
-                key = key.decode("utf-8")
-            await self.redis.publish(key, payload_json)
+        await EventPublisher(self.redis).publish_ephemeral_to_chat(
+            chat_id,
+            "typing",
+            {"chatId": chat_id, "userId": user_id, "isTyping": is_typing},
+        )
         
         logger.debug(f"Published typing event for user {user_id} in chat {chat_id}: {is_typing}")
+
+
+def typing_key(chat_id: int) -> str:
+    return f"typing:chat:{chat_id}"
@@ -0,0 +1,107 @@
+"""Общие фикстуры тестов на Postgres (TEST_DATABASE_URL).
+
+Модуль не собирается pytest: тестовые файлы подключают его через
+pytest_plugins после своих importorskip и проверки TEST_DATABASE_URL.
+"""
+
+from __future__ import annotations
+
+import os
+from collections.abc import AsyncIterator
+
+import fakeredis
+import httpx
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.api.dependencies import get_current_user, get_redis, get_session
+from app.db.base import Base
+from app.domain.models import Chat, ChatMember, User
+from app.main import app
+from app.repositories.message import MessageRepository
+
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest_asyncio.fixture
+async def engine():
+    engine = create_async_engine(DATABASE_URL)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            User.__table__.insert(),
+            [
+                {"id": user_id, "email": f"{user_id}@example.com", "password_hash": "x",
+                 "display_name": str(user_id), "tag": f"u{user_id}"}
+                for user_id in range(1, 4)
+            ],
+        )
+        # В обоих чатах участники 1, 2 и 3
+        await conn.execute(Chat.__table__.insert(), [{"id": 1, "title": "A"}, {"id": 2, "title": "B"}])
+        await conn.execute(
+            ChatMember.__table__.insert(),
+            [{"chat_id": chat_id, "user_id": user_id} for chat_id in (1, 2) for user_id in range(1, 4)],
+        )
+    yield engine
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await engine.dispose()
+
+
+@pytest_asyncio.fixture
+async def session(engine):
+    async with async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)() as session:
+        yield session
+
+
+@pytest_asyncio.fixture
+async def client(engine):
+    """HTTP-клиент API от имени пользователя 1: сессия на тестовой БД, fakeredis."""
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    async def override_session() -> AsyncIterator[AsyncSession]:
+        async with sessions() as session:
+            yield session
+
+    async def override_redis():
+        yield redis
+
+    app.dependency_overrides[get_session] = override_session
+    app.dependency_overrides[get_redis] = override_redis
+    app.dependency_overrides[get_current_user] = lambda: 1
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test/api/v1") as client:
+            yield client
+    finally:
+        app.dependency_overrides.clear()
+
+
+async def add_messages(
+    session: AsyncSession, chat_id: int, author_id: int, count: int, *, contents: list[str] | None = None
+) -> list[int]:
+    repo = MessageRepository(session)
+    ids = []
+    for index in range(count):
+        content = contents[index] if contents is not None else str(index)
+        message = await repo.create(chat_id=chat_id, author_id=author_id, type="text", content=content, payload=None)
+        ids.append(message.id)
+    await session.commit()
+    return ids
+
+
+async def count_statements(engine, action) -> int:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args) -> None:
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        await action()
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements)
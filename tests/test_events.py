@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+
+from app.core.config import settings
+from app.services.events import EventLog, EventPublisher
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.mark.asyncio
+async def test_replay_returns_missed_events_in_order(redis) -> None:
+    publisher = EventPublisher(redis)
+    await publisher.publish_to_chat(1, "message.created", {"id": 10})
+    await publisher.publish_to_users([7], "chat.joined", {"chat_id": 2})
+    await publisher.publish_to_chat(2, "message.created", {"id": 11})
+    await publisher.publish_to_chat(3, "message.created", {"id": 12})
+
+    payloads, resync = await EventLog(redis).read_since(7, [1, 2], last_event_id=1)
+
+    assert resync is False
+    events = [json.loads(payload) for payload in payloads]
+    assert [event["id"] for event in events] == [2, 3]
+    assert [event["event"] for event in events] == ["chat.joined", "message.created"]
+
+
+@pytest.mark.asyncio
+async def test_replay_asks_for_resync_when_stream_was_trimmed(redis, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "ws_stream_maxlen", 2)
+    publisher = EventPublisher(redis)
+    for message_id in range(5):
+        await publisher.publish_to_chat(1, "message.created", {"id": message_id})
+    await redis.xtrim("ws:stream:chat:1", maxlen=2, approximate=False)
+
+    payloads, resync = await EventLog(redis).read_since(7, [1], last_event_id=1)
+
+    assert resync is True
+    assert payloads == []
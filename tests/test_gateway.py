@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("fakeredis")
+pytest.importorskip("msgpack")
+
+import fakeredis
+import msgpack
+
+from app.services.gateway import Connection, ConnectionRegistry, Event, OutboundQueue, PubSubHub
+
+
+def make_hub() -> PubSubHub:
+    hub = PubSubHub("redis://fake")
+    hub._redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return hub
+
+
+async def wait_for(predicate, timeout: float = 2.0) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_hub_shares_one_subscription_between_sockets() -> None:
+    hub = make_hub()
+    first: list[Event] = []
+    second: list[Event] = []
+    try:
+        await hub.subscribe("ws:user:1", first.append)
+        await hub.subscribe("ws:user:1", second.append)
+        assert hub.channel_count == 1
+
+        await hub.redis.publish("ws:user:1", '{"event": "ping"}')
+        await wait_for(lambda: first and second)
+        assert first[0] is second[0]
+        assert first[0].raw == '{"event": "ping"}'
+
+        await hub.unsubscribe("ws:user:1", first.append)
+        assert hub.channel_count == 1
+        await hub.unsubscribe("ws:user:1", second.append)
+        assert hub.channel_count == 0
+    finally:
+        await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_registry_fans_out_to_every_device_of_user() -> None:
+    hub = make_hub()
+    registry = ConnectionRegistry(hub)
+    phone = Connection(websocket=None, user_id=7)
+    laptop = Connection(websocket=None, user_id=7)
+    try:
+        assert await registry.add(phone) is True
+        assert await registry.add(laptop) is False
+        assert hub.channel_count == 1
+
+        await hub.redis.publish("ws:user:7", '{"event": "ping"}')
+        await wait_for(lambda: len(phone.queue) == len(laptop.queue) == 1)
+
+        assert await registry.remove(phone) is False
+        assert await registry.remove(laptop) is True
+        assert hub.channel_count == 0
+    finally:
+        await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_chat_topic_reaches_local_members_until_they_leave() -> None:
+    hub = make_hub()
+    registry = ConnectionRegistry(hub)
+    alice = Connection(websocket=None, user_id=1)
+    bob = Connection(websocket=None, user_id=2)
+    try:
+        await registry.add(alice, chat_ids=[10])
+        await registry.add(bob, chat_ids=[10, 11])
+        assert hub.channel_count == 4  # 2 персональных + 2 чата
+
+        await hub.redis.publish("ws:chat:10", '{"event": "message.created", "data": {}}')
+        await wait_for(lambda: len(alice.queue) == len(bob.queue) == 1)
+
+        await hub.redis.publish("ws:user:2", '{"event": "chat.left", "data": {"chat_id": 11}}')
+        await wait_for(lambda: hub.channel_count == 3)
+
+        await hub.redis.publish("ws:chat:10", '{"event": "chat.deleted", "data": {"id": 10}}')
+        await wait_for(lambda: hub.channel_count == 2)
+        # Фоновые задачи подписок держатся реестром до завершения
+        await wait_for(lambda: not registry._tasks)
+    finally:
+        await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_subscribe_does_not_leave_stale_registration() -> None:
+    hub = make_hub()
+    registry = ConnectionRegistry(hub)
+    subscribe = hub.subscribe
+
+    async def failing_subscribe(channel, handler) -> None:
+        raise ConnectionError("redis is down")
+
+    try:
+        hub.subscribe = failing_subscribe
+        with pytest.raises(ConnectionError):
+            await registry.add(Connection(websocket=None, user_id=1), chat_ids=[10])
+        assert registry.user_ids() == ()
+
+        hub.subscribe = subscribe
+        assert await registry.add(Connection(websocket=None, user_id=1), chat_ids=[10]) is True
+        assert hub.channel_count == 2
+    finally:
+        await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_reconnect_during_unsubscribe_keeps_new_state() -> None:
+    hub = make_hub()
+    registry = ConnectionRegistry(hub)
+    old = Connection(websocket=None, user_id=1)
+    new = Connection(websocket=None, user_id=1)
+    unsubscribe = hub.unsubscribe
+    gate = asyncio.Event()
+
+    async def slow_unsubscribe(channel, handler) -> None:
+        await gate.wait()
+        await unsubscribe(channel, handler)
+
+    try:
+        await registry.add(old, chat_ids=[10])
+        hub.unsubscribe = slow_unsubscribe
+        removal = asyncio.create_task(registry.remove(old))
+        await asyncio.sleep(0)
+
+        # Пользователь переподключился, пока старое соединение отписывается
+        assert await registry.add(new, chat_ids=[10]) is True
+        gate.set()
+        assert await removal is True
+        hub.unsubscribe = unsubscribe
+
+        assert registry.chats_for(1) == (10,)
+        assert hub.channel_count == 2
+        await hub.redis.publish("ws:chat:10", '{"event": "message.created", "data": {}}')
+        await wait_for(lambda: len(new.queue) == 1)
+
+        # Выход из чата по-прежнему отписывает от него
+        await registry.leave_chat(1, 10)
+        assert hub.channel_count == 1
+    finally:
+        await hub.close()
+
+
+def event(name: str, **data) -> Event:
+    return Event(json.dumps({"event": name, "data": data}))
+
+
+def test_outbound_queue_drops_ephemeral_events_first() -> None:
+    queue = OutboundQueue(2, droppable={"typing"})
+    assert queue.put(event("typing", chatId=1, userId=2))
+    assert queue.put(event("message.created", id=1))
+    assert queue.put(event("message.created", id=2))
+    assert [queued.data["id"] for queued in queue._items] == [1, 2]
+    # Эфемерное событие при полной очереди просто отбрасывается
+    assert queue.put(event("typing", chatId=1, userId=2))
+    assert len(queue) == 2
+
+
+def test_outbound_queue_coalesces_then_overflows() -> None:
+    queue = OutboundQueue(2, droppable=())
+    assert queue.put(event("message.updated", id=1, content="a"))
+    assert queue.put(event("message.created", id=2))
+    assert queue.put(event("message.updated", id=1, content="b"))
+    assert [queued.data.get("content") for queued in queue._items] == [None, "b"]
+
+    assert not queue.put(event("message.created", id=3))
+    assert queue.overflowed
+    assert len(queue) == 0
+
+
+class RecordingWebSocket:
+    def __init__(self) -> None:
+        self.frames: list[str] = []
+
+    async def send_text(self, data: str) -> None:
+        self.frames.append(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        self.frames.append(data)
+
+
+@pytest.mark.asyncio
+async def test_batching_sends_one_array_frame_per_window() -> None:
+    websocket = RecordingWebSocket()
+    connection = Connection(websocket, user_id=1, batch_ms=10)
+    pump = asyncio.create_task(connection.pump())
+    try:
+        for message_id in (1, 2, 3):
+            connection.deliver(event("message.created", id=message_id))
+        await wait_for(lambda: websocket.frames)
+        await asyncio.sleep(0.05)
+    finally:
+        pump.cancel()
+
+    assert len(websocket.frames) == 1
+    assert [item["data"]["id"] for item in json.loads(websocket.frames[0])] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_msgpack_batch_reuses_shared_encodings() -> None:
+    websocket = RecordingWebSocket()
+    connection = Connection(websocket, user_id=1, batch_ms=10, encoding="msgpack")
+    shared = event("message.created", id=1)
+    pump = asyncio.create_task(connection.pump())
+    try:
+        connection.deliver(shared)
+        connection.deliver(event("reaction.added", message_id=1))
+        await wait_for(lambda: websocket.frames)
+    finally:
+        pump.cancel()
+
+    assert shared._packed is not None
+    assert msgpack.unpackb(websocket.frames[0]) == [
+        {"event": "message.created", "data": {"id": 1}},
+        {"event": "reaction.added", "data": {"message_id": 1}},
+    ]
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from datetime import UTC, datetime, timedelta
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+
+from app.core.config import settings
+from app.domain.models import Message
+from app.services.message_cache import MessageCache
+
+START = datetime(2026, 10, 17, 12, 0, 0, tzinfo=UTC)
+
+
+def make_message(seq: int, *, version: int | None = None, content: str | None = None, deleted: bool = False) -> Message:
+    return Message(
+        id=100 + seq,
+        chat_id=1,
+        seq=seq,
+        version=version if version is not None else seq,
+        author_id=1,
+        type="text",
+        content=content if content is not None else f"m{seq}",
+        payload=None,
+        status="delivered",
+        read_count=0,
+        ts=START + timedelta(seconds=seq),
+        is_deleted=deleted,
+        reactions=[],
+    )
+
+
+@pytest.fixture
+def cache(monkeypatch) -> MessageCache:
+    monkeypatch.setattr(settings, "message_cache_size", 3)
+    return MessageCache(fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+@pytest.mark.asyncio
+async def test_page_is_served_from_filled_window(cache) -> None:
+    assert await cache.get_page(1, 2) is None
+
+    assert await cache.fill(1, [make_message(seq) for seq in (3, 2, 1)], version=3, has_more=False)
+    page, has_more = await cache.get_page(1, 2)
+    assert [message.seq for message in page] == [3, 2]
+    assert has_more
+    page, has_more = await cache.get_page(1, 3)
+    assert [message.seq for message in page] == [3, 2, 1]
+    assert not has_more
+    # Больше окна кэш не отдает
+    assert await cache.get_page(1, 4) is None
+
+
+@pytest.mark.asyncio
+async def test_new_message_evicts_oldest(cache) -> None:
+    await cache.fill(1, [make_message(seq) for seq in (3, 2, 1)], version=3, has_more=False)
+    await cache.store(make_message(4))
+
+    page, has_more = await cache.get_page(1, 3)
+    assert [message.seq for message in page] == [4, 3, 2]
+    assert has_more
+    # Правка вытесненного сообщения в окно не попадает
+    await cache.store(make_message(1, version=5, content="edited"))
+    page, _ = await cache.get_page(1, 3)
+    assert [message.seq for message in page] == [4, 3, 2]
+
+
+@pytest.mark.asyncio
+async def test_stale_writes_are_ignored(cache) -> None:
+    await cache.fill(1, [make_message(seq) for seq in (2, 1)], version=2, has_more=False)
+    await cache.store(make_message(2, version=5, content="new"))
+    await cache.store(make_message(2, version=4, content="old"))
+    page, _ = await cache.get_page(1, 2)
+    assert page[0].content == "new"
+
+    # Удаление пришло раньше создания: создание не воскрешает сообщение
+    await cache.store(make_message(3, version=7, deleted=True))
+    await cache.store(make_message(3, version=6))
+    page, _ = await cache.get_page(1, 3)
+    assert [message.seq for message in page] == [2, 1]
+
+    # Снимок из БД старше прошедших через кэш записей отбрасывается
+    assert not await cache.fill(1, [make_message(1)], version=6, has_more=False)
+    await cache.invalidate(1, version=8)
+    assert await cache.get_page(1, 1) is None
+    assert not await cache.fill(1, [make_message(1)], version=7, has_more=False)
+    assert await cache.fill(1, [make_message(1)], version=8, has_more=False)
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("httpx")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.domain.models import Chat, Message
+from app.repositories.message import MessageRepository
+from app.services.message import MessageService
+
+# Версии резервируются под блокировкой строки чата (UPDATE ... RETURNING): синтаксис Postgres
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+from postgres_harness import add_messages
+
+pytest_plugins = ["postgres_harness"]
+
+
+async def chat_version(session, chat_id: int = 1) -> int:
+    return await session.scalar(
+        select(Chat.version).where(Chat.id == chat_id).execution_options(populate_existing=True)
+    )
+
+
+async def fetch_all_changes(client, since: int, limit: int) -> tuple[list[dict], int]:
+    """Пройти ленту изменений по has_more, как клиент; вернуть страницы и итоговую версию"""
+    pages = []
+    while True:
+        response = await client.get("/chats/1/changes", params={"since": since, "limit": limit})
+        assert response.status_code == 200, response.text
+        body = response.json()
+        pages.append(body)
+        since = body["version"]
+        if not body["has_more"]:
+            return pages, since
+
+
+@pytest.mark.asyncio
+async def test_every_change_takes_the_next_version(session) -> None:
+    service = MessageService(session, fakeredis.FakeAsyncRedis(decode_responses=True))
+    created = [
+        await service.create_message(chat_id=1, author_id=1, type="text", content=str(index), payload=None)
+        for index in range(3)
+    ]
+    assert [m.version for m in created] == [1, 2, 3]
+
+    target = created[2].id
+    edited = await service.update_message(created[0], content="edited", payload=None)
+    deleted = await service.delete_message(created[1])
+    await service.add_reaction(target, 2, "👍")
+    assert (edited.version, deleted.version) == (4, 5)
+    assert await session.scalar(select(Message.version).where(Message.id == target)) == 6
+
+    # Удаление несуществующей реакции откатывается вместе с резервом версии
+    assert await service.remove_reaction(target, 2, "🔥") is False
+    assert await chat_version(session) == 6
+    # Как в API: следующий запрос начинается с чистой сессии
+    session.expunge_all()
+    assert await service.remove_reaction(target, 2, "👍") is True
+    assert await chat_version(session) == 7
+
+    # У другого чата свой счетчик
+    other = await service.create_message(chat_id=2, author_id=1, type="text", content="x", payload=None)
+    assert other.version == 1
+
+
+@pytest.mark.asyncio
+async def test_changes_pages_return_every_message_once(session, client) -> None:
+    service = MessageService(session, fakeredis.FakeAsyncRedis(decode_responses=True))
+    ids = await add_messages(session, 1, 1, 7)
+    messages = {m.id: m for m in (await session.scalars(select(Message))).all()}
+    await service.update_message(messages[ids[0]], content="edited", payload=None)
+    await service.delete_message(messages[ids[3]])
+    await service.add_reaction(ids[5], 2, "👍")
+
+    pages, version = await fetch_all_changes(client, since=0, limit=3)
+
+    assert version == await chat_version(session) == 10
+    assert [page["has_more"] for page in pages] == [True, True, False]
+    seen = [m["id"] for page in pages for m in page["messages"]]
+    deleted = [message_id for page in pages for message_id in page["deleted_ids"]]
+    assert sorted(seen + deleted) == sorted(ids)
+    assert deleted == [ids[3]]
+    # Каждое сообщение - один раз, в последней версии
+    assert seen == [ids[1], ids[2], ids[4], ids[6], ids[0], ids[5]]
+    versions = [m["version"] for page in pages for m in page["messages"]]
+    assert versions == sorted(versions)
+    edited = next(m for page in pages for m in page["messages"] if m["id"] == ids[0])
+    assert edited["content"] == "edited"
+
+    # С последней версии изменений нет
+    response = await client.get("/chats/1/changes", params={"since": version})
+    assert response.json() == {"messages": [], "deleted_ids": [], "version": version, "has_more": False}
+
+    # Новые изменения приходят от сохраненной версии
+    await service.delete_message(messages[ids[6]])
+    pages, version = await fetch_all_changes(client, since=version, limit=3)
+    assert [(page["messages"], page["deleted_ids"]) for page in pages] == [([], [ids[6]])]
+    assert version == 11
+
+
+@pytest.mark.asyncio
+async def test_rolled_back_change_does_not_consume_a_version(engine, session, client) -> None:
+    ids = await add_messages(session, 1, 1, 3)
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with sessions() as writer, sessions() as sender:
+        # Правка зарезервировала версию 4 и держит строку чата
+        repo = MessageRepository(writer)
+        message = await writer.get(Message, ids[0])
+        message.version = await repo.reserve_versions(1)
+        message.content = "draft"
+        await writer.flush()
+        assert message.version == 4
+
+        # Параллельная отправка ждет блокировки чата, а не берет версию 5
+        send = asyncio.create_task(
+            MessageRepository(sender).create(chat_id=1, author_id=2, type="text", content="x", payload=None)
+        )
+        await asyncio.sleep(0.2)
+        assert not send.done()
+        response = await client.get("/chats/1/changes", params={"since": 3})
+        assert response.json()["version"] == 3
+
+        await writer.rollback()
+        created = await send
+        await sender.commit()
+
+    assert (created.version, created.seq) == (4, 4)
+    pages, version = await fetch_all_changes(client, since=3, limit=10)
+    assert [m["id"] for m in pages[0]["messages"]] == [created.id]
+    assert version == 4
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("httpx")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+from app.domain.models import Message
+from app.repositories.message import MessageRepository, encode_cursor
+
+# Курсоры (ts, id) сравниваются кортежами строк: синтаксис Postgres
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+from postgres_harness import add_messages
+
+pytest_plugins = ["postgres_harness"]
+
+
+async def fetch(client, **params) -> tuple[list[int], dict]:
+    response = await client.get("/messages", params={"chat_id": 1, **params})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    return [message["id"] for message in body["messages"]], body
+
+
+async def cursor(session, message_id: int) -> str:
+    return encode_cursor(await session.get(Message, message_id))
+
+
+async def delete(session, message_id: int) -> None:
+    await MessageRepository(session).soft_delete(await session.get(Message, message_id))
+    await session.commit()
+
+
+@pytest.mark.asyncio
+async def test_before_pages_walk_history_to_the_start(session, client) -> None:
+    # Одна транзакция - одинаковый ts: порядок держится на id
+    ids = await add_messages(session, 1, 1, 10)
+    await add_messages(session, 2, 1, 3)
+
+    page, body = await fetch(client, limit=4)
+    assert page == ids[:-5:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+
+    page, body = await fetch(client, limit=4, before=body["before_cursor"])
+    assert page == ids[5:1:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, True)
+
+    page, body = await fetch(client, limit=4, before=body["before_cursor"])
+    assert page == ids[1::-1]
+    assert (body["has_more"], body["has_newer"]) == (False, True)
+    assert body["before_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_before_page_reaching_the_newest_message_has_no_newer(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 6)
+    newest = await cursor(session, ids[-1])
+    await delete(session, ids[-1])
+
+    page, body = await fetch(client, limit=3, before=newest)
+    assert page == ids[4:1:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+    assert body["after_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_before_id_keeps_legacy_cursor(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 5)
+
+    page, body = await fetch(client, limit=2, before_id=ids[3])
+    assert page == [ids[2], ids[1]]
+    assert (body["has_more"], body["has_newer"], body["next_cursor"]) == (True, True, ids[1])
+
+    page, body = await fetch(client, limit=2, before_id=ids[1])
+    assert page == [ids[0]]
+    assert (body["has_more"], body["has_newer"], body["next_cursor"]) == (False, True, None)
+
+    # Пустая страница у самого старого: новее нее сам курсор
+    page, body = await fetch(client, limit=2, before_id=ids[0])
+    assert page == []
+    assert (body["has_more"], body["has_newer"]) == (False, True)
+
+
+@pytest.mark.asyncio
+async def test_after_pages_walk_to_the_newest(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 10)
+
+    page, body = await fetch(client, limit=4, after=await cursor(session, ids[1]))
+    assert page == ids[5:1:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, True)
+
+    page, body = await fetch(client, limit=4, after=body["after_cursor"])
+    assert page == ids[:5:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+    assert body["after_cursor"] is None
+
+    page, body = await fetch(client, limit=4, after=await cursor(session, ids[-1]))
+    assert page == []
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+
+
+@pytest.mark.asyncio
+async def test_after_page_from_the_oldest_message_has_no_more(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 4)
+    oldest = await cursor(session, ids[0])
+    await delete(session, ids[0])
+
+    page, body = await fetch(client, limit=2, after=oldest)
+    assert page == [ids[2], ids[1]]
+    assert (body["has_more"], body["has_newer"]) == (False, True)
+
+
+@pytest.mark.asyncio
+async def test_around_id_centers_the_target(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 9)
+
+    page, body = await fetch(client, limit=5, around_id=ids[4])
+    assert page == ids[6:1:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, True)
+
+    # У краев страница короче, флаг в сторону края снят
+    page, body = await fetch(client, limit=5, around_id=ids[-1])
+    assert page == ids[:-4:-1]
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+
+    page, body = await fetch(client, limit=5, around_id=ids[1])
+    assert page == ids[3::-1]
+    assert (body["has_more"], body["has_newer"]) == (False, True)
+
+    response = await client.get("/messages", params={"chat_id": 2, "around_id": ids[0]})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_after_seq_returns_the_gap_with_deleted_messages(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 10)
+    await delete(session, ids[7])
+
+    response = await client.get("/messages", params={"chat_id": 1, "after_seq": 6, "limit": 4})
+    body = response.json()
+    assert [(m["seq"], m["is_deleted"]) for m in body["messages"]] == [
+        (10, False), (9, False), (8, True), (7, False)
+    ]
+    # Осталось ровно limit: новее ничего нет, повторный запрос не нужен
+    assert (body["has_more"], body["has_newer"]) == (True, False)
+
+    response = await client.get("/messages", params={"chat_id": 1, "after_seq": 0, "limit": 4})
+    body = response.json()
+    assert [m["seq"] for m in body["messages"]] == [4, 3, 2, 1]
+    assert (body["has_more"], body["has_newer"]) == (False, True)
+
+
+@pytest.mark.asyncio
+async def test_only_one_paging_parameter_is_allowed(session, client) -> None:
+    ids = await add_messages(session, 1, 1, 2)
+
+    response = await client.get("/messages", params={"chat_id": 1, "after_seq": 0, "before_id": ids[1]})
+    assert response.status_code == 400
+    response = await client.get("/messages", params={"chat_id": 1, "before": "not-a-cursor"})
+    assert response.status_code == 400
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+from sqlalchemy import select
+
+from app.domain.models import ChatMember, Message
+from app.repositories.message_read import MessageReadRepository
+from app.services.message import MessageService
+
+# Запросы прочтения используют только синтаксис Postgres (CTE с UPDATE, ANY по массиву)
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+from postgres_harness import add_messages, count_statements
+
+pytest_plugins = ["postgres_harness"]
+
+
+@pytest.mark.asyncio
+async def test_mark_as_read_query_count_does_not_grow_with_backlog(engine, session) -> None:
+    await add_messages(session, 1, 1, 1)
+    await add_messages(session, 2, 1, 30)
+    service = MessageService(session, fakeredis.FakeAsyncRedis(decode_responses=True))
+    # Второй читатель переводит все сообщения в "read": меряем самый длинный путь
+    await service.mark_messages_as_read(1, 3)
+    await service.mark_messages_as_read(2, 3)
+
+    small = await count_statements(engine, lambda: service.mark_messages_as_read(1, 2))
+    large = await count_statements(engine, lambda: service.mark_messages_as_read(2, 2))
+
+    assert small == large
+    statuses = await session.scalars(select(Message.status).where(Message.chat_id == 2))
+    assert set(statuses) == {"read"}
+
+
+@pytest.mark.asyncio
+async def test_status_flips_after_every_other_member_has_read(session) -> None:
+    ids = await add_messages(session, 1, 1, 3)
+    own = await add_messages(session, 1, 2, 1)
+    service = MessageService(session, fakeredis.FakeAsyncRedis(decode_responses=True))
+    reads = MessageReadRepository(session)
+
+    # Свое сообщение участник не читает
+    assert await service.mark_messages_as_read(1, 2) == ids
+    assert await reads.get_unread_count(1, 2) == 0
+    assert await reads.get_unread_count(1, 3) == 4
+    member = await session.scalar(select(ChatMember).where(ChatMember.chat_id == 1, ChatMember.user_id == 2))
+    assert member.last_read_message_id == own[0]
+
+    messages = (await session.scalars(select(Message).order_by(Message.id).execution_options(populate_existing=True))).all()
+    assert [(m.read_count, m.status) for m in messages] == [(1, "delivered")] * 3 + [(0, "delivered")]
+
+    # Третий участник дочитал: сообщения автора 1 прочитаны всеми, кроме автора
+    assert await service.mark_messages_as_read(1, 3) == ids + own
+    messages = (await session.scalars(select(Message).order_by(Message.id).execution_options(populate_existing=True))).all()
+    assert [(m.read_count, m.status) for m in messages] == [(2, "read")] * 3 + [(1, "delivered")]
+    versions = [m.version for m in messages[:3]]
+    assert len(set(versions)) == 3
+
+    # Последний читатель сообщения own - участник 1; автора оно не ждет
+    assert await service.mark_messages_as_read(1, 1) == own
+    own_message = await session.get(Message, own[0], populate_existing=True)
+    assert (own_message.read_count, own_message.status) == (2, "read")
+
+
+@pytest.mark.asyncio
+async def test_repeat_mark_as_read_is_a_no_op(session) -> None:
+    await add_messages(session, 1, 1, 2)
+    reads = MessageReadRepository(session)
+
+    assert await reads.mark_chat_as_read(1, 2) is not None
+    await session.commit()
+    assert await reads.mark_chat_as_read(1, 2) is None
+    message = await session.scalar(select(Message).order_by(Message.id.desc()).execution_options(populate_existing=True))
+    assert message.read_count == 1
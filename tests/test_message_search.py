@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("httpx")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+from sqlalchemy import update
+
+from app.domain.models import Message
+from app.repositories.message import MessageRepository
+
+# Полнотекстовый поиск (tsvector, websearch_to_tsquery, ts_rank_cd) есть только в Postgres
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+from postgres_harness import add_messages
+
+pytest_plugins = ["postgres_harness"]
+
+
+async def search(client, query: str, **params) -> tuple[list[dict], str | None]:
+    response = await client.get("/messages/search", params={"chat_id": 1, "query": query, **params})
+    assert response.status_code == 200, response.text
+    return response.json(), response.headers.get("X-Next-Cursor")
+
+
+async def found_ids(client, query: str) -> list[int]:
+    results, _ = await search(client, query)
+    return [result["id"] for result in results]
+
+
+@pytest.mark.asyncio
+async def test_websearch_syntax(session, client) -> None:
+    texts = ["Встреча завтра в офисе", "Встречи переносятся", "Обед завтра", "Просто текст"]
+    meeting, moved, lunch, _ = await add_messages(session, 1, 1, len(texts), contents=texts)
+
+    # Словоформы сводятся к одной основе, регистр не важен
+    assert sorted(await found_ids(client, "встреча")) == [meeting, moved]
+    assert await found_ids(client, '"встреча завтра"') == [meeting]
+    assert await found_ids(client, "завтра -обед") == [meeting]
+    assert sorted(await found_ids(client, "обед or офис")) == [meeting, lunch]
+    assert await found_ids(client, "отпуск") == []
+
+    results, _ = await search(client, "обед")
+    assert results[0]["snippet"] == "<mark>Обед</mark> завтра"
+
+
+@pytest.mark.asyncio
+async def test_results_are_ordered_by_rank(session, client) -> None:
+    texts = ["кот", "кот и кот, снова кот", "кот и собака", "кот кот"]
+    once, thrice, with_dog, twice = await add_messages(session, 1, 1, len(texts), contents=texts)
+
+    results, cursor = await search(client, "кот")
+    assert [r["id"] for r in results][:2] == [thrice, twice]
+    assert {r["id"] for r in results[2:]} == {once, with_dog}
+    ranks = [r["rank"] for r in results]
+    assert ranks == sorted(ranks, reverse=True)
+    assert cursor is None
+
+
+@pytest.mark.asyncio
+async def test_cursor_pages_are_stable_across_equal_ranks(session, client) -> None:
+    texts = ["отчет готов"] * 7 + ["отчет готов, отчет отправлен"]
+    ids = await add_messages(session, 1, 1, len(texts), contents=texts)
+    await add_messages(session, 2, 1, 2, contents=["отчет готов"] * 2)
+
+    pages = []
+    cursor = None
+    while True:
+        params = {"limit": 3} if cursor is None else {"limit": 3, "cursor": cursor}
+        results, cursor = await search(client, "отчет", **params)
+        pages.append([r["id"] for r in results])
+        if cursor is None:
+            break
+
+    # Лучший результат первым, дальше равные по rank - по убыванию id, без повторов
+    assert pages == [[ids[7], ids[6], ids[5]], [ids[4], ids[3], ids[2]], [ids[1], ids[0]]]
+
+    response = await client.get("/messages/search", params={"chat_id": 1, "query": "отчет", "cursor": "bad"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_deleted_messages_are_not_found(session, client) -> None:
+    texts = ["пароль от wifi", "пароль: 12345", "пароль от почты"]
+    kept, removed, flagged = await add_messages(session, 1, 1, len(texts), contents=texts)
+    await MessageRepository(session).soft_delete(await session.get(Message, removed))
+    # Текст остался в строке (удалено до очистки content): отсекает сам фильтр is_deleted
+    await session.execute(update(Message).where(Message.id == flagged).values(is_deleted=True))
+    await session.commit()
+
+    assert await found_ids(client, "пароль") == [kept]
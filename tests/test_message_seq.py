@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("psycopg")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.domain.models import Chat, Message
+from app.repositories.message import MessageRepository
+from app.services.message import MessageService
+
+# seq выдается UPDATE ... RETURNING под блокировкой строки чата: синтаксис Postgres
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+if not DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+pytest_plugins = ["postgres_harness"]
+
+
+async def seqs(session, chat_id: int) -> list[int]:
+    return list(await session.scalars(select(Message.seq).where(Message.chat_id == chat_id).order_by(Message.id)))
+
+
+async def send(session, chat_id: int, content: str = "x") -> Message:
+    return await MessageRepository(session).create(
+        chat_id=chat_id, author_id=1, type="text", content=content, payload=None
+    )
+
+
+@pytest.mark.asyncio
+async def test_seq_is_gap_free_per_chat(session) -> None:
+    for chat_id in (1, 2, 1, 1, 2, 1):
+        await send(session, chat_id)
+        await session.commit()
+
+    assert await seqs(session, 1) == [1, 2, 3, 4]
+    assert await seqs(session, 2) == [1, 2]
+    last = await session.scalars(select(Chat.last_message_seq).order_by(Chat.id))
+    assert list(last) == [4, 2]
+
+
+@pytest.mark.asyncio
+async def test_rolled_back_send_frees_its_seq(session) -> None:
+    await send(session, 1)
+    await session.commit()
+
+    failed = await send(session, 1)
+    assert failed.seq == 2
+    await session.rollback()
+
+    assert (await send(session, 1)).seq == 2
+    await session.commit()
+    assert await seqs(session, 1) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_deleted_message_keeps_its_seq(session) -> None:
+    service = MessageService(session, fakeredis.FakeAsyncRedis(decode_responses=True))
+    first = await service.create_message(chat_id=1, author_id=1, type="text", content="a", payload=None)
+    await service.delete_message(first)
+
+    second = await service.create_message(chat_id=1, author_id=1, type="text", content="b", payload=None)
+    assert (first.seq, second.seq) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_sends_to_one_chat_get_distinct_seq(engine, session) -> None:
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    async def sender(author_id: int, count: int) -> list[int]:
+        result = []
+        for index in range(count):
+            # Каждая отправка - своя сессия, как отдельный запрос к API
+            async with sessions() as own:
+                message = await MessageService(own, redis).create_message(
+                    chat_id=1, author_id=author_id, type="text", content=str(index), payload=None
+                )
+                result.append(message.seq)
+        return result
+
+    first, second = await asyncio.gather(sender(1, 10), sender(2, 10))
+
+    assert first == sorted(first) and second == sorted(second)
+    assert sorted(first + second) == list(range(1, 21))
+    assert sorted(await seqs(session, 1)) == list(range(1, 21))
+    # id выдается уже под блокировкой чата: порядок по id совпадает с seq
+    assert await seqs(session, 1) == list(range(1, 21))
+
+
+@pytest.mark.asyncio
+async def test_second_send_waits_for_the_first_to_commit(engine) -> None:
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with sessions() as first, sessions() as second:
+        held = await send(first, 1)
+        waiting = asyncio.create_task(send(second, 1))
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+
+        await first.commit()
+        queued = await waiting
+        await second.commit()
+
+    assert (held.seq, queued.seq) == (1, 2)
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from datetime import UTC, datetime
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.domain.models import Message
+from app.repositories.message import (
+    decode_cursor,
+    decode_search_cursor,
+    encode_cursor,
+    encode_search_cursor,
+    render_snippet,
+)
+
+
+def test_cursor_roundtrip() -> None:
+    message = Message(id=42, ts=datetime(2026, 10, 17, 12, 30, 0, 123456, tzinfo=UTC))
+    cursor = encode_cursor(message)
+    assert "|" not in cursor and "=" not in cursor
+    assert decode_cursor(cursor) == (message.ts, 42)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "MjAyNi0xMC0xNw"])
+def test_invalid_cursor_is_rejected(cursor: str) -> None:
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_search_cursor_roundtrip() -> None:
+    cursor = encode_search_cursor(0.0607927, 7)
+    assert decode_search_cursor(cursor) == (0.0607927, 7)
+    with pytest.raises(ValueError):
+        decode_search_cursor(encode_cursor(Message(id=1, ts=datetime(2026, 10, 17, tzinfo=UTC))))
+
+
+def test_snippet_is_escaped_except_marks() -> None:
+    headline = "<b>x</b> \x02встреча\x03 & \x02пятница\x03"
+    assert render_snippet(headline) == "&lt;b&gt;x&lt;/b&gt; <mark>встреча</mark> &amp; <mark>пятница</mark>"
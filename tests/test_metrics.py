@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app.core import metrics
+
+
+def test_render_exposes_histogram_with_worker_label() -> None:
+    metrics.ws_dispatch_to_send_seconds.observe(0.003)
+    before = metrics.ws_dispatch_to_send_seconds.values[()][0][:]
+
+    text = metrics.render()
+
+    worker = f'worker="{os.getpid()}"'
+    assert "# TYPE ws_dispatch_to_send_seconds histogram" in text
+    assert f'ws_dispatch_to_send_seconds_bucket{{{worker},le="0.0025"}} {sum(before[:2])}' in text
+    assert f'ws_dispatch_to_send_seconds_bucket{{{worker},le="+Inf"}} {sum(before)}' in text
+    assert f"ws_connections{{{worker}}}" in text
+
+
+@pytest.mark.asyncio
+async def test_publish_to_channel_without_subscribers_is_counted() -> None:
+    pytest.importorskip("lupa")
+    fakeredis = pytest.importorskip("fakeredis")
+    from app.services.events import EventPublisher
+
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    published = metrics.ws_events_published.values[("message.created",)]
+    unrouted = metrics.ws_events_unrouted.values[("message.created",)]
+
+    await EventPublisher(redis).publish_to_chat(1, "message.created", {"id": 1})
+
+    assert metrics.ws_events_published.values[("message.created",)] == published + 1
+    assert metrics.ws_events_unrouted.values[("message.created",)] == unrouted + 1
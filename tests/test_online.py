@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+
+from app.services.online import ONLINE_NODES_KEY, OnlineIndex
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.mark.asyncio
+async def test_user_is_online_while_connected_to_any_node(redis) -> None:
+    node_a = OnlineIndex(redis, "a")
+    node_b = OnlineIndex(redis, "b")
+
+    assert await node_a.add(1) is True
+    assert await node_b.add(1) is False
+    assert await node_a.add(2) is True
+    assert await node_a.online_among([1, 2, 3]) == {1, 2}
+
+    assert await node_a.remove(1) is False
+    assert await node_a.is_online(1)
+    assert await node_b.remove(1) is True
+    assert not await node_b.is_online(1)
+    # Повторное снятие не уводит счетчик в минус
+    assert await node_b.remove(1) is False
+    assert await node_a.list_online() == [2]
+
+
+@pytest.mark.asyncio
+async def test_dead_node_is_reaped(redis) -> None:
+    node_a = OnlineIndex(redis, "a")
+    node_b = OnlineIndex(redis, "b")
+    await node_a.add(1)
+    await node_a.add(2)
+    await node_b.add(2)
+
+    # Узел a перестал присылать heartbeat
+    await redis.zadd(ONLINE_NODES_KEY, {"a": 0})
+    await node_b.heartbeat()
+
+    assert await node_b.reap() == [1]
+    assert await node_b.online_among([1, 2]) == {2}
+    assert await redis.zscore(ONLINE_NODES_KEY, "a") is None
+    assert await redis.exists("online:node:a") == 0
+
+    # Живой узел узнает, что его сняли, по heartbeat
+    assert await node_a.heartbeat() is True
+    assert await node_a.heartbeat() is False
+
+
+@pytest.mark.asyncio
+async def test_shutdown_drops_own_node(redis) -> None:
+    node_a = OnlineIndex(redis, "a")
+    await node_a.add(1)
+    await node_a.add(2)
+
+    assert sorted(await node_a.drop_node()) == [1, 2]
+    assert await node_a.count() == 0
+
+
+@pytest.mark.asyncio
+async def test_reaped_node_notices_reap_after_new_connection(redis) -> None:
+    node_a = OnlineIndex(redis, "a")
+    node_b = OnlineIndex(redis, "b")
+    await node_a.heartbeat()
+    await node_a.add(1)
+    await node_a.add(2)
+
+    await redis.zadd(ONLINE_NODES_KEY, {"a": 0})
+    assert sorted(await node_b.reap()) == [1, 2]
+
+    # Новое подключение до heartbeat не прячет снятие узла
+    assert await node_a.add(3) is True
+    assert await node_a.heartbeat() is True
+    readded = [user_id for user_id in (1, 2, 3) if await node_a.add(user_id)]
+    assert readded == [1, 2]
+    assert await node_a.online_among([1, 2, 3]) == {1, 2, 3}
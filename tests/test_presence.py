@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import json
+from datetime import UTC
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("pytest_asyncio")
+pytest.importorskip("aiosqlite")
+pytest.importorskip("lupa")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.domain.models import Chat, ChatMember, Friend, User
+from app.services.online import OnlineIndex
+from app.services.presence import HeartbeatBuffer, PresenceService, TypingService, heartbeats
+
+
+@pytest_asyncio.fixture
+async def session(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'presence.db'}")
+    async with engine.begin() as conn:
+        for table in (User.__table__, Chat.__table__, ChatMember.__table__, Friend.__table__):
+            await conn.run_sync(table.create)
+        await conn.execute(
+            User.__table__.insert(),
+            [
+                {"id": user_id, "email": f"{user_id}@example.com", "password_hash": "x",
+                 "display_name": str(user_id), "tag": f"u{user_id}"}
+                for user_id in range(1, 6)
+            ],
+        )
+        # 1 и 2 в общем чате, 1 и 3 друзья, у 1 и 4 запрос в друзья не принят, 5 - посторонний
+        await conn.execute(Chat.__table__.insert().values(id=1, title="Chat", is_group=True))
+        await conn.execute(ChatMember.__table__.insert(), [{"chat_id": 1, "user_id": 1}, {"chat_id": 1, "user_id": 2}])
+        await conn.execute(
+            Friend.__table__.insert(),
+            [
+                {"user_id": 3, "friend_id": 1, "status": "accepted"},
+                {"user_id": 1, "friend_id": 4, "status": "pending"},
+            ],
+        )
+    async with async_sessionmaker(engine, class_=AsyncSession)() as session:
+        yield session
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_presence_goes_only_to_chat_members_and_friends(session) -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    pubsub = redis.pubsub()
+    await pubsub.subscribe(*(f"ws:user:{user_id}" for user_id in range(1, 6)))
+    online = OnlineIndex(redis, "node-a")
+    for user_id in range(1, 6):
+        await online.add(user_id)
+
+    await PresenceService(redis, session).set_user_online(1)
+
+    received = set()
+    for _ in range(20):
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.05)
+        if message is None:
+            continue
+        assert json.loads(message["data"])["event"] == "user:presence"
+        received.add(message["channel"])
+    assert received == {"ws:user:1", "ws:user:2", "ws:user:3"}
+    await pubsub.aclose()
+
+
+@pytest.mark.asyncio
+async def test_audience_is_cached_until_invalidated(session) -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    service = PresenceService(redis, session)
+    assert await service.get_audience(5) == set()
+    assert await service.get_audience(1) == {2, 3}
+
+    await session.execute(ChatMember.__table__.insert().values(chat_id=1, user_id=5))
+    await session.commit()
+    # Без сессии аудитория берется только из кэша
+    assert await PresenceService(redis).get_audience(1) == {2, 3}
+    assert await PresenceService(redis).get_audience(5) == set()
+
+    await service.invalidate_audience([1, 2, 5])
+    assert await service.get_audience(1) == {2, 3, 5}
+    assert await service.get_audience(5) == {1, 2}
+
+
+@pytest.mark.asyncio
+async def test_bulk_status_reads_all_users_at_once() -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    service = PresenceService(redis)
+    await OnlineIndex(redis, "node-a").add(1)
+    await service.heartbeat(1)
+    await redis.set("presence:last_seen:2", "2024-03-26T12:00:00")
+
+    statuses = await service.get_multiple_users_status([1, 2, 3, 1])
+
+    assert list(statuses) == [1, 2, 3]
+    assert statuses[1]["status"] == "online"
+    assert statuses[2]["status"] == "offline"
+    assert statuses[2]["last_seen"].isoformat() == "2024-03-26T12:00:00"
+    assert statuses[3] == {"user_id": 3, "status": "offline", "last_seen": None}
+
+
+@pytest.mark.asyncio
+async def test_typing_state_is_one_sorted_set_per_chat() -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    pubsub = redis.pubsub()
+    await pubsub.subscribe("ws:chat:1", "ws:user:3")
+    service = TypingService(redis)
+
+    await service.start_typing(1, 2)
+    await service.start_typing(1, 3)
+    await service.stop_typing(1, 3)
+    assert await service.get_typing_users(1) == [2]
+    assert await redis.type("typing:chat:1") == "zset"
+
+    # Истекшие индикаторы вычищаются при чтении
+    await redis.zadd("typing:chat:1", {4: 0})
+    assert await service.get_typing_users(1) == [2]
+
+    channels = []
+    for _ in range(20):
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.05)
+        if message is not None:
+            channels.append(message["channel"])
+    # События идут только в канал чата, а не в персональные каналы
+    assert channels == ["ws:chat:1"] * 3
+    await pubsub.aclose()
+
+
+@pytest.mark.asyncio
+async def test_typing_publishes_only_transitions_and_periodic_roster() -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    pubsub = redis.pubsub()
+    await pubsub.subscribe("ws:chat:1")
+    service = TypingService(redis)
+
+    assert await service.start_typing(1, 2) is True
+    assert await service.start_typing(1, 2) is False
+    assert await service.start_typing(1, 3) is True
+    assert await service.stop_typing(1, 2) is True
+    assert await service.stop_typing(1, 2) is False
+
+    assert await service.publish_rosters() == 1
+    await service.stop_typing(1, 3)
+    # Последний пустой ростер, после него чат выбывает из рассылки
+    assert await service.publish_rosters() == 1
+    assert await service.publish_rosters() == 0
+
+    events = []
+    for _ in range(20):
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.05)
+        if message is not None:
+            events.append(json.loads(message["data"]))
+    assert [event["event"] for event in events] == [
+        "typing", "typing", "typing", "typing.roster", "typing", "typing.roster",
+    ]
+    assert events[3]["data"] == {"chatId": 1, "userIds": [3]}
+    assert events[5]["data"] == {"chatId": 1, "userIds": []}
+    await pubsub.aclose()
+
+
+@pytest.mark.asyncio
+async def test_heartbeats_are_buffered_and_flushed_in_batches(session) -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    online = OnlineIndex(redis, "node-a")
+    await online.add(1)
+    await online.add(2)
+    buffer = HeartbeatBuffer()
+    buffer.record(1)
+    buffer.record(2)
+    buffer.record(1)
+    assert await redis.exists("presence:user:1") == 0
+
+    assert await buffer.flush_redis(redis) == 2
+    assert len(buffer) == 0
+    statuses = await PresenceService(redis).get_multiple_users_status([1, 2])
+    assert {status["status"] for status in statuses.values()} == {"online"}
+
+    assert await buffer.flush_db(session) == 2
+    assert await buffer.flush_db(session) == 0
+    users = {user.id: user for user in (await session.scalars(select(User))).all()}
+    # В колонке UTC без часового пояса
+    assert users[1].last_seen_at.replace(tzinfo=UTC) == statuses[1]["last_seen"]
+    assert users[3].last_seen_at is None
+
+
+@pytest.mark.asyncio
+async def test_late_heartbeat_flush_does_not_revive_offline_user() -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    online = OnlineIndex(redis, "node-a")
+    await online.add(1)
+    await online.add(2)
+    heartbeats.record(1)
+    heartbeats.record(2)
+
+    # Последние сокеты закрылись до сброса буфера; офлайн пользователя 2
+    # объявил другой воркер, его буфер здесь не очищается
+    await online.remove(1)
+    await online.remove(2)
+    await PresenceService(redis).set_user_offline(1)
+    await redis.delete("presence:user:2")
+    assert await heartbeats.flush_redis(redis) == 1
+
+    statuses = await PresenceService(redis).get_multiple_users_status([1, 2])
+    assert statuses[1] == {"user_id": 1, "status": "offline", "last_seen": None}
+    assert statuses[2]["status"] == "offline"
+    assert statuses[2]["last_seen"] is not None
+
+
+@pytest.mark.asyncio
+async def test_http_heartbeat_marks_user_online_without_socket() -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    buffer = HeartbeatBuffer()
+    buffer.record(1, http=True)
+    buffer.record(2)
+
+    assert await buffer.flush_redis(redis) == 2
+    statuses = await PresenceService(redis).get_multiple_users_status([1, 2])
+    # Пинг по WebSocket без соединения в индексе online не продлевает
+    assert statuses[1]["status"] == "online"
+    assert statuses[2]["status"] == "offline"
+
+
+@pytest.mark.asyncio
+async def test_last_seen_falls_back_to_database(session) -> None:
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    buffer = HeartbeatBuffer()
+    buffer.record(1)
+    await buffer.flush_redis(redis)
+    await buffer.flush_db(session)
+    # Ключ last_seen в Redis потерян (например, после рестарта Redis)
+    await redis.delete("presence:last_seen:1")
+
+    statuses = await PresenceService(redis, session).get_multiple_users_status([1, 2])
+    user = await session.get(User, 1)
+    assert statuses[1]["last_seen"] == user.last_seen_at.replace(tzinfo=UTC)
+    assert statuses[2]["last_seen"] is None
+    # Без сессии БД запасного источника нет
+    assert (await PresenceService(redis).get_user_status(1))["last_seen"] is None
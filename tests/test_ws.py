@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("psycopg")
+pytest.importorskip("aiosqlite")
+pytest.importorskip("httpx")
+pytest.importorskip("fakeredis")
+
+import fakeredis
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.api import ws, ws_commands
+from app.core.security import create_access_token
+from app.domain.models import Chat, ChatMember, Friend, User
+from app.main import app
+from app.services.gateway import ConnectionRegistry, PubSubHub
+
+
+@pytest.fixture
+def gateway(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'ws.db'}")
+    checkouts = {"open": 0, "total": 0}
+
+    @event.listens_for(engine.sync_engine.pool, "checkout")
+    def on_checkout(*args) -> None:
+        checkouts["open"] += 1
+        checkouts["total"] += 1
+
+    @event.listens_for(engine.sync_engine.pool, "checkin")
+    def on_checkin(*args) -> None:
+        checkouts["open"] -= 1
+
+    hub = PubSubHub("redis://fake")
+    hub._redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(ws, "AsyncSessionMaker", async_sessionmaker(engine, class_=AsyncSession))
+    monkeypatch.setattr(ws, "hub", hub)
+    registry = ConnectionRegistry(hub)
+    monkeypatch.setattr(ws, "registry", registry)
+    monkeypatch.setattr(ws_commands, "hub", hub)
+    monkeypatch.setattr(ws_commands, "registry", registry)
+
+    with TestClient(app) as client:
+        client.portal.call(_create_user, engine)
+        yield client, checkouts
+        client.portal.call(hub.close)
+
+
+async def _create_user(engine) -> None:
+    async with engine.begin() as conn:
+        for table in (User.__table__, Chat.__table__, ChatMember.__table__, Friend.__table__):
+            await conn.run_sync(table.create)
+        await conn.execute(
+            User.__table__.insert(),
+            [
+                {"id": 1, "email": "a@example.com", "password_hash": "x", "display_name": "A", "tag": "a"},
+                {"id": 2, "email": "b@example.com", "password_hash": "x", "display_name": "B", "tag": "b"},
+            ],
+        )
+        await conn.execute(Chat.__table__.insert().values(id=1, title="Chat", is_group=True))
+        await conn.execute(
+            ChatMember.__table__.insert(),
+            [{"chat_id": 1, "user_id": 1, "role": "owner"}, {"chat_id": 1, "user_id": 2, "role": "member"}],
+        )
+
+
+def test_open_sockets_do_not_hold_db_connections(gateway) -> None:
+    client, checkouts = gateway
+    token = create_access_token(subject="1")
+
+    with client.websocket_connect(f"/ws?token={token}") as first:
+        with client.websocket_connect(f"/ws?token={token}") as second:
+            # Первый кадр (снимок presence) уходит, когда настройка сокета закончена
+            assert first.receive_json()["event"] == "presence.snapshot"
+            assert second.receive_json()["event"] == "presence.snapshot"
+            # Рукопожатия ходили в БД, но соединения уже вернулись в пул
+            assert checkouts["total"] >= 3
+            assert checkouts["open"] == 0
+        assert checkouts["open"] == 0
+
+
+def receive_ack(socket) -> dict:
+    """Следующий ответ на команду (события чатов, например typing, пропускаются)"""
+    while True:
+        frame = socket.receive_json()
+        if frame["event"] == "ack":
+            return frame["data"]
+
+
+def test_commands_are_acknowledged(gateway) -> None:
+    client, _ = gateway
+    token = create_access_token(subject="1")
+
+    with client.websocket_connect(f"/ws?token={token}") as socket:
+        socket.send_json({"id": "h1", "type": "heartbeat", "data": {}})
+        assert receive_ack(socket) == {"request_id": "h1", "ok": True, "result": None}
+
+        socket.send_json({"id": "t1", "type": "typing", "data": {"chat_id": 1, "is_typing": True}})
+        assert receive_ack(socket) == {"request_id": "t1", "ok": True, "result": None}
+
+        socket.send_json({"id": "t2", "type": "typing", "data": {"chat_id": 99, "is_typing": True}})
+        assert receive_ack(socket) == {"request_id": "t2", "ok": False, "error": "Access denied"}
+
+        socket.send_json({"id": "x1", "type": "unknown"})
+        assert receive_ack(socket)["ok"] is False
+
+        # Повтор с тем же id не выполняет команду заново, а возвращает прежний ответ
+        socket.send_json({"id": "t2", "type": "typing", "data": {"chat_id": 1, "is_typing": True}})
+        assert receive_ack(socket) == {"request_id": "t2", "ok": False, "error": "Access denied"}
+
+
+def test_presence_snapshot_is_the_first_frame(gateway) -> None:
+    client, _ = gateway
+
+    with client.websocket_connect(f"/ws?token={create_access_token(subject='2')}") as other:
+        # Отправка кадров начинается после set_presence: пользователь 2 уже онлайн
+        assert other.receive_json()["event"] == "presence.snapshot"
+        with client.websocket_connect(f"/ws?token={create_access_token(subject='1')}") as socket:
+            frame = socket.receive_json()
+            assert frame["event"] == "presence.snapshot"
+            assert frame["data"]["users"] == [{"user_id": 2, "status": "online", "last_seen": None}]